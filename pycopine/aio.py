@@ -0,0 +1,149 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+
+from . import metrics
+from .pool import PoolClosedError, QueueFullError
+
+__all__ = ['AsyncPool']
+
+
+class AsyncPool(object):
+    ''' Executor that runs commands as tasks in an asyncio event loop instead
+        of worker threads. Commands should implement run() (and fallback())
+        as coroutine functions. Plain run() methods block the event loop.
+
+        The pool binds to the event loop that submits the first command. Tasks
+        may also be submitted from other threads once the pool is bound (see
+        :meth:`bind`).
+
+        Register the pool with a command group to use it::
+
+            CommandGroup().add_executor(AsyncPool('async'))
+
+            class MyCommand(Command):
+                pool = 'async'
+                async def run(self, value):
+                    ...
+
+            result = await MyCommand('input')
+    '''
+    __instances = dict()
+
+    def __new__(cls, name='async'):
+        key = cls, name
+        if key not in cls.__instances:
+            obj = super(AsyncPool, cls).__new__(cls)
+            cls.__instances[key] = obj
+        return cls.__instances[key]
+
+    #: Maximum number of commands in queue
+    max_queue_size = 100
+    #: Maximum number of commands running at the same time
+    max_pool_size = 100
+    #: Collapsed commands (see :attr:`Command.collapse_window`) are not
+    #: supported. Batches are flushed from a timer thread, not the loop.
+    supports_batches = False
+
+    def __init__(self, name='async'):
+        if 'name' in self.__dict__:
+            return
+        self.name = name
+        self._shutdown = False
+        self.loop = None
+        self.semaphore = None
+        self.queue   = OrderedDict()
+        self.running = {}
+        self.metrics = metrics.PoolMetrics()
+        self.lock = threading.Lock()
+
+    def bind(self, loop):
+        ''' Run all future commands in `loop`. '''
+        with self.lock:
+            self.loop = loop
+            self.semaphore = None
+
+    def get_queue_size(self):
+        ''' Return the number of jobs waiting in the queue. '''
+        return len(self.queue)
+
+    def get_queue_space(self):
+        ''' Return the number of available slots in the pool queue '''
+        return self.max_queue_size - len(self.queue)
+
+    def get_active_count(self):
+        ''' Return the number of jobs currently running. '''
+        return len(self.running)
+
+    def _get_loop(self):
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        with self.lock:
+            if self.loop is None or self.loop.is_closed():
+                if running is None:
+                    raise PoolClosedError('No event loop')
+                self.loop = running
+                self.semaphore = None
+            return self.loop, self.loop is running
+
+    def enqueue(self, command):
+        loop, in_loop = self._get_loop()
+        with self.lock:
+            if self._shutdown:
+                raise PoolClosedError('Pool is closed')
+            if len(self.queue) >= self.max_queue_size:
+                self.metrics.increment('rejected')
+                raise QueueFullError('Queue full')
+            self.queue[command] = time.monotonic()
+        if in_loop:
+            self._start(command)
+        else:
+            loop.call_soon_threadsafe(self._start, command)
+
+    def dequeue(self, command):
+        ''' Remove a command from the queue. Return True if the command was
+            still waiting in the queue, False otherwise. Running coroutines
+            are canceled. '''
+        with self.lock:
+            if command in self.queue:
+                del self.queue[command]
+                return True
+            task = self.running.get(command)
+        if task is not None:
+            self.loop.call_soon_threadsafe(task.cancel)
+        return False
+
+    def _start(self, command):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_pool_size)
+        asyncio.ensure_future(self._execute(command, self.semaphore))
+
+    async def _execute(self, command, semaphore):
+        async with semaphore:
+            with self.lock:
+                if command not in self.queue:
+                    return # Dequeued while waiting for a slot
+                queued = self.queue.pop(command)
+                self.running[command] = asyncio.current_task()
+                active = len(self.running)
+            self.metrics.update_max('active', active)
+            start = time.monotonic()
+            try:
+                await command._arun()
+            finally:
+                with self.lock:
+                    del self.running[command]
+            self.metrics.increment('executed')
+            self.metrics.record('queue', start - queued)
+            self.metrics.record('run', time.monotonic() - start)
+
+    def shutdown(self, block=True):
+        ''' Reject new commands and cancel all running coroutines. '''
+        with self.lock:
+            self._shutdown = True
+            tasks = list(self.running.values())
+        for task in tasks:
+            self.loop.call_soon_threadsafe(task.cancel)
@@ -0,0 +1,387 @@
+''' Micro benchmarks for pycopine internals.
+
+    Run with ``python -m pycopine.bench`` (or ``make bench``). Numbers are
+    only meaningful when compared to each other on the same machine. Use
+    ``--json`` to get machine readable results that can be compared between
+    versions, e.g.::
+
+        python -m pycopine.bench --json > before.json
+'''
+
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import pycopine
+from .pool import Pool, SemaphorePool, QueueFullError
+from .metrics import HistogramCounter
+from .shared import SharedState, SharedCounter
+from .command import Command, CommandGroup
+from . import events
+
+
+class _Dummy(object):
+    ''' Stand-in for a command. The pool only needs something hashable. '''
+    def _run(self):
+        pass
+
+
+def _ops(n, start):
+    return n / max(time.perf_counter() - start, 1e-9)
+
+
+def bench_pool_queue(size):
+    ''' Measure enqueue, dequeue (worker side) and cancel throughput of a pool
+        with `size` queued commands. No worker threads are started. '''
+    pool = Pool('bench.queue.%d' % size)
+    pool.max_pool_size = 0
+    pool.max_queue_size = size
+
+    commands = [_Dummy() for _ in range(size)]
+
+    start = time.perf_counter()
+    for command in commands:
+        pool.enqueue(command)
+    enqueue = _ops(size, start)
+
+    start = time.perf_counter()
+    for _ in range(size):
+        with pool.cond:
+            pool._pop(0, None)
+    dequeue = _ops(size, start)
+
+    for command in commands:
+        pool.enqueue(command)
+    random.shuffle(commands)
+    start = time.perf_counter()
+    for command in commands:
+        pool.dequeue(command)
+    cancel = _ops(size, start)
+
+    pool.shutdown()
+    return dict(size=size, enqueue=enqueue, dequeue=dequeue, cancel=cancel)
+
+
+def bench_counter(threads=16, n=200000, shared=False):
+    ''' Measure HistogramCounter.increment() throughput with `threads`
+        concurrent threads, each counting `n` events. If `shared` is true,
+        measure a :class:`pycopine.shared.SharedCounter` instead. '''
+    if shared:
+        tmpdir = tempfile.mkdtemp()
+        state = SharedState(os.path.join(tmpdir, 'bench'))
+        counter = SharedCounter(state, ('bench',), window=3600, buckets=10)
+    else:
+        counter = HistogramCounter(window=3600, buckets=10)
+    barrier = threading.Barrier(threads + 1)
+
+    def work():
+        increment = counter.increment
+        barrier.wait()
+        for _ in range(n):
+            increment()
+
+    workers = [threading.Thread(target=work) for _ in range(threads)]
+    for t in workers:
+        t.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for t in workers:
+        t.join()
+    rate = _ops(threads * n, start)
+    lost = threads * n - counter.total()
+    if shared:
+        state.close()
+        shutil.rmtree(tmpdir)
+    return dict(threads=threads, shared=shared, increments=threads * n,
+                rate=rate, lost=lost)
+
+
+class _Job(object):
+    ''' Records the time between enqueue and completion. '''
+    def __init__(self):
+        self.done = threading.Event()
+        self.start = time.perf_counter()
+
+    def _run(self):
+        self.latency = time.perf_counter() - self.start
+        self.done.set()
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def bench_cold_start(n=1000, burst=10, prestart=False):
+    ''' Measure the latency (enqueue to start of execution, in microseconds)
+        of the first `n` commands of a new pool. Commands are enqueued in
+        bursts of `burst` commands. '''
+    pool = Pool('bench.cold.%s.%d' % (prestart, time.monotonic_ns()))
+    pool.max_pool_size = burst
+    pool.max_queue_size = burst
+    if prestart:
+        pool.core_pool_size = burst
+        pool.prestart()
+    latencies = []
+    for _ in range(n // burst):
+        jobs = [_Job() for _ in range(burst)]
+        for job in jobs:
+            job.start = time.perf_counter()
+            pool.enqueue(job)
+        for job in jobs:
+            job.done.wait()
+            latencies.append(job.latency * 1e6)
+    pool.shutdown()
+    return dict(requests=n, prestart=prestart, threads=burst,
+                p50=_percentile(latencies, 50), p99=_percentile(latencies, 99),
+                first=latencies[0], max=max(latencies))
+
+
+def bench_isolation(n=20000):
+    ''' Measure the per-call overhead of ``Command().result()`` with thread
+        pool isolation and with semaphore isolation, compared to a direct
+        function call. Results are microseconds per call. '''
+    group = CommandGroup('bench.isolation')
+    group.add_executor(SemaphorePool('bench.semaphore'))
+
+    def work():
+        return 1
+
+    class Threaded(Command):
+        group = 'bench.isolation'
+        def run(self): return work()
+
+    class Inline(Command):
+        group = 'bench.isolation'
+        pool = 'bench.semaphore'
+        def run(self): return work()
+
+    result = dict(calls=n)
+    for name, call in (('direct', work),
+                       ('thread', lambda: Threaded().result()),
+                       ('semaphore', lambda: Inline().result())):
+        start = time.perf_counter()
+        for _ in range(n):
+            call()
+        result[name] = (time.perf_counter() - start) / n * 1e6
+    group.clear()
+    return result
+
+
+def bench_result(n=20000, rounds=5):
+    ''' Measure the per-call cost (microseconds) of ``Command().result()``
+        with semaphore isolation, where result() runs plain tasks directly
+        (fast path), compared to ``Command().submit().result()``, which takes
+        the regular path through the executor. Both variants run alternately
+        in `rounds` rounds of `n` calls. The best round counts. '''
+    group = CommandGroup('bench.result')
+    group.add_executor(SemaphorePool('bench.result'))
+
+    class Inline(Command):
+        group = 'bench.result'
+        pool = 'bench.result'
+        def run(self, value): return value
+
+    variants = (('fast', lambda: Inline(1).result()),
+                ('regular', lambda: Inline(1).submit().result()))
+    result = dict(calls=n)
+    for _ in range(rounds):
+        for name, call in variants:
+            start = time.perf_counter()
+            for _ in range(n):
+                call()
+            took = (time.perf_counter() - start) / n * 1e6
+            result[name] = min(result.get(name, took), took)
+    group.clear()
+    return result
+
+
+def bench_throughput(pool_size, queue_size, n=20000):
+    ''' Measure how many commands per second a pool with `pool_size` workers
+        and `queue_size` queue slots executes, if the queue is kept full. '''
+    pool = Pool('bench.throughput.%d.%d' % (pool_size, queue_size))
+    pool.max_pool_size = pool_size
+    pool.max_queue_size = queue_size
+    jobs = [_Job() for _ in range(n)]
+    rejected = 0
+    start = time.perf_counter()
+    for job in jobs:
+        while True:
+            try:
+                pool.enqueue(job)
+                break
+            except QueueFullError:
+                rejected += 1
+                time.sleep(0)
+    for job in jobs:
+        job.done.wait()
+    rate = _ops(n, start)
+    pool.shutdown()
+    return dict(pool_size=pool_size, queue_size=queue_size, commands=n,
+                rate=rate, rejected=rejected)
+
+
+def bench_cancel(n=10000):
+    ''' Measure the cost (microseconds per task) of submitting and canceling
+        a queued task, and of a task that times out while queued. '''
+    group = CommandGroup('bench.cancel')
+    pool = Pool('bench.cancel')
+    pool.max_pool_size = 0 # Tasks stay in the queue
+    pool.max_queue_size = n
+    group.add_executor(pool)
+
+    class Stuck(Command):
+        group = 'bench.cancel'
+        pool = 'bench.cancel'
+        circuit_enabled = False
+        def run(self): pass
+
+    tasks = [Stuck() for _ in range(n)]
+    start = time.perf_counter()
+    for task in tasks:
+        task.submit()
+        task.cancel()
+    cancel = (time.perf_counter() - start) / n * 1e6
+
+    tasks = [Stuck() for _ in range(n)]
+    start = time.perf_counter()
+    for task in tasks:
+        task.exception(0)
+    timeout = (time.perf_counter() - start) / n * 1e6
+
+    group.clear()
+    pool.shutdown()
+    return dict(tasks=n, cancel=cancel, timeout=timeout)
+
+
+def bench_emit(sinks, n=100000):
+    ''' Measure EventManager.emit() throughput with `sinks` registered sinks,
+        and the rate at which the events are delivered to all sinks. '''
+    manager = events.EventManager(max_size=n)
+    for _ in range(sinks):
+        manager.add_sink(events.FuncSink(lambda event: None))
+    emit = manager.emit
+    start = time.perf_counter()
+    for i in range(n):
+        emit('bench', value=i)
+    rate = _ops(n, start)
+    manager.shutdown()
+    delivered = _ops(manager.delivered, start)
+    return dict(sinks=sinks, events=n, rate=rate, delivered=delivered,
+                dropped=manager.dropped)
+
+
+def bench_memory(n=10000):
+    ''' Measure memory (bytes per task) and allocations (blocks per task) of
+        `n` tasks that are created, and of `n` tasks that are executed (with
+        semaphore isolation) and waited for. '''
+    group = CommandGroup('bench.memory')
+    group.add_executor(SemaphorePool('bench.memory'))
+
+    class Noop(Command):
+        group = 'bench.memory'
+        pool = 'bench.memory'
+        def run(self): pass
+
+    def measure(make):
+        gc.collect()
+        tracemalloc.start()
+        start = tracemalloc.take_snapshot()
+        tasks = make()
+        stats = tracemalloc.take_snapshot().compare_to(start, 'filename')
+        tracemalloc.stop()
+        del tasks
+        size = sum(s.size_diff for s in stats)
+        blocks = sum(s.count_diff for s in stats)
+        return size / n, blocks / n
+
+    def completed():
+        tasks = [Noop() for _ in range(n)]
+        for task in tasks:
+            task.submit().wait()
+        return tasks
+
+    created = measure(lambda: [Noop() for _ in range(n)])
+    done = measure(completed)
+    group.clear()
+    return dict(tasks=n, created=created[0], created_blocks=created[1],
+                completed=done[0], completed_blocks=done[1])
+
+
+def run_all(out=sys.stdout):
+    ''' Run all benchmarks, print a summary to `out` and return a dict of
+        result lists. '''
+    results = {}
+    def add(name, result):
+        results.setdefault(name, []).append(result)
+        return result
+
+    for size in (10, 1000, 100000):
+        r = add('pool_queue', bench_pool_queue(size))
+        print('pool queue size={size:<7} enqueue={enqueue:>12,.0f}/s '
+              'dequeue={dequeue:>12,.0f}/s cancel={cancel:>12,.0f}/s'.format(**r),
+              file=out)
+    for pool_size, queue_size in ((1, 10), (10, 10), (10, 1000), (50, 1000)):
+        r = add('pool_throughput', bench_throughput(pool_size, queue_size))
+        print('pool throughput threads={pool_size:<3} queue={queue_size:<5} '
+              'rate={rate:>10,.0f}/s rejected={rejected}'.format(**r),
+              file=out)
+    for shared in (False, True):
+        for threads in (1, 16):
+            r = add('counter', bench_counter(threads, shared=shared))
+            print('counter shared={shared!s:<5} threads={threads:<4} '
+                  'increments={increments:,} rate={rate:>12,.0f}/s '
+                  'lost={lost}'.format(**r), file=out)
+    for sinks in (0, 1, 10):
+        r = add('emit', bench_emit(sinks))
+        print('emit sinks={sinks:<3} rate={rate:>12,.0f}/s '
+              'delivered={delivered:>12,.0f}/s dropped={dropped}'.format(**r),
+              file=out)
+    r = add('isolation', bench_isolation())
+    print('isolation calls={calls:,} direct={direct:.2f}us '
+          'thread={thread:.2f}us semaphore={semaphore:.2f}us'.format(**r),
+          file=out)
+    r = add('result', bench_result())
+    print('result calls={calls:,} fast={fast:.2f}us '
+          'regular={regular:.2f}us'.format(**r), file=out)
+    r = add('cancel', bench_cancel())
+    print('cancel tasks={tasks:,} cancel={cancel:.2f}us '
+          'timeout={timeout:.2f}us'.format(**r), file=out)
+    for prestart in (False, True):
+        r = add('cold_start', bench_cold_start(prestart=prestart))
+        print('cold start requests={requests} prestart={prestart!s:<5} '
+              'first={first:.0f}us p50={p50:.0f}us p99={p99:.0f}us '
+              'max={max:.0f}us'.format(**r), file=out)
+    r = add('memory', bench_memory())
+    print('memory tasks={tasks:,} created={created:.0f}B/task '
+          '({created_blocks:.1f} blocks) completed={completed:.0f}B/task '
+          '({completed_blocks:.1f} blocks)'.format(**r), file=out)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m pycopine.bench',
+                                     description=__doc__.split('\n')[0])
+    parser.add_argument('--json', action='store_true',
+                        help='print results as JSON to stdout')
+    args = parser.parse_args(argv)
+    results = run_all(sys.stderr if args.json else sys.stdout)
+    if args.json:
+        json.dump(dict(version=pycopine.__version__,
+                       python=platform.python_version(),
+                       implementation=platform.python_implementation(),
+                       results=results),
+                  sys.stdout, indent=2, sort_keys=True)
+        print()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+''' Process wide worker budget shared by multiple pools (bulkheads).
+
+    Without a budget, each :class:`pycopine.pool.Pool` starts up to
+    `max_pool_size` threads of its own. Pools that share a
+    :class:`WorkerBudget` do not start threads at all. Their commands are
+    executed by the budget's workers, which are reused across pools::
+
+        Pool.budget = WorkerBudget(max_workers=64) # Applies to all pools
+        Pool('search').min_pool_size = 8
+
+    Each pool still runs at most `max_pool_size` commands at a time (see
+    :meth:`Pool.get_pool_limit`). In addition, the budget guarantees
+    `min_pool_size` workers to each pool. Workers not guaranteed to any pool
+    form a shared reserve that busy pools may borrow. Free workers are
+    assigned to the pool with the lowest number of running commands relative
+    to its guaranteed minimum (fair share).
+'''
+
+import threading
+import time
+
+__all__ = ['WorkerBudget']
+
+
+class WorkerBudget(object):
+    ''' A bounded set of worker threads shared by multiple pools. '''
+
+    #: Idle workers are terminated after this timeout.
+    max_worker_idle = 60
+
+    def __init__(self, max_workers=100):
+        self.max_workers = max_workers
+        self.cond = threading.Condition(threading.Lock())
+        self.pools = []
+        #: Number of commands running per pool
+        self.active = {}
+        self.threads = []
+        self.idle = 0
+
+    def get_active_count(self):
+        ''' Return the number of commands currently running (all pools). '''
+        return sum(self.active.values())
+
+    def register(self, pool):
+        ''' Add a pool to the budget and reserve its guaranteed workers.
+            Pools created while :attr:`Pool.budget` is set are registered
+            automatically, others on first use. '''
+        with self.cond:
+            self._register(pool)
+
+    def _register(self, pool):
+        if pool not in self.active:
+            self.pools.append(pool)
+            self.active[pool] = 0
+
+    def wakeup(self, pool, count=1):
+        ''' Called by pools after `count` new commands were queued. Must not
+            be called while holding the pool lock. '''
+        with self.cond:
+            self._register(pool)
+            self.cond.notify(min(count, self.idle))
+            missing = min(count - self.idle,
+                          self.max_workers - len(self.threads))
+            if missing > 0 and self._select() is not None:
+                for _ in range(missing):
+                    self._spawn()
+
+    def _spawn(self):
+        ''' Start a new worker thread. The caller must hold the lock. '''
+        thread = threading.Thread(target=self._run_loop)
+        thread.daemon = True
+        self.threads.append(thread)
+        thread.start()
+
+    def _select(self):
+        ''' Return the pool that should run the next command, or None. The
+            caller must hold the lock. '''
+        active = self.active
+        reserve = 0 # Guaranteed but unused workers
+        for pool in self.pools:
+            reserve += max(0, pool.min_pool_size - active[pool])
+        can_borrow = sum(active.values()) + reserve < self.max_workers
+
+        best, best_share = None, None
+        for pool in self.pools:
+            running = active[pool]
+            if pool._shutdown or not pool.queue \
+            or running >= pool.get_pool_limit():
+                continue
+            if running >= pool.min_pool_size and not can_borrow:
+                continue
+            share = running / max(1, pool.min_pool_size)
+            if best is None or share < best_share:
+                best, best_share = pool, share
+        return best
+
+    def _run_loop(self):
+        current_thread = threading.current_thread()
+        expired = []
+        try:
+            while True:
+                with self.cond:
+                    pool = self._select()
+                    deadline = time.monotonic() + self.max_worker_idle
+                    while pool is None and time.monotonic() < deadline:
+                        self.idle += 1
+                        self.cond.wait(deadline - time.monotonic())
+                        self.idle -= 1
+                        pool = self._select()
+                    if pool is None:
+                        break
+                    self.active[pool] += 1
+
+                try:
+                    self._run_one(pool, expired)
+                finally:
+                    with self.cond:
+                        self.active[pool] -= 1
+        finally:
+            with self.cond:
+                self.threads.remove(current_thread)
+
+    def _run_one(self, pool, expired):
+        ''' Run the next command of `pool`, if any. '''
+        with pool.cond:
+            command, queued = pool._pop(time.monotonic(), expired)
+            if command is not None:
+                pool.running.add(command)
+        if expired:
+            pool._expire(expired)
+            del expired[:]
+        if command is None:
+            return
+
+        start = time.monotonic()
+        try:
+            pool._execute(command)
+        finally:
+            run_time = time.monotonic() - start
+            with pool.cond:
+                pool._release(command, start - queued, run_time)
+        pool.metrics.increment('executed')
+        pool.metrics.record('queue', start - queued)
+        pool.metrics.record('run', run_time)
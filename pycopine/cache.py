@@ -0,0 +1,128 @@
+from time import time as now
+from collections import OrderedDict
+import contextlib
+import contextvars
+import threading
+
+__all__ = ['LRUCache', 'CommandCache', 'request_cache']
+
+HIT    = 'HIT'     # Result found in cache
+LEAD   = 'LEAD'    # Cache miss. The task must be executed.
+FOLLOW = 'FOLLOW'  # Cache miss, but an equal task is already executing.
+
+_scope = contextvars.ContextVar('pycopine_request_cache', default=None)
+
+
+@contextlib.contextmanager
+def request_cache():
+    ''' Context manager that caches the results of all cache enabled commands
+        for its duration, regardless of the TTL of the process wide cache.
+        Tasks submitted within the block always see the same result for the
+        same command and cache key. '''
+    token = _scope.set({})
+    try:
+        yield
+    finally:
+        _scope.reset(token)
+
+
+class LRUCache(object):
+    ''' Thread-safe dictionary with a maximum size and an optional time to
+        live for each entry. The least recently used entry is evicted first.
+    '''
+
+    def __init__(self, max_size=1000, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key):
+        ''' Return a (found, value) tuple. '''
+        with self.lock:
+            try:
+                expires, value = self.data[key]
+            except KeyError:
+                return False, None
+            if expires is not None and expires < now():
+                del self.data[key]
+                return False, None
+            self.data.move_to_end(key)
+            return True, value
+
+    def set(self, key, value):
+        expires = now() + self.ttl if self.ttl is not None else None
+        with self.lock:
+            self.data[key] = expires, value
+            self.data.move_to_end(key)
+            while len(self.data) > self.max_size:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+
+class CommandCache(object):
+    ''' Result cache for a single command class.
+
+        Results are stored in a process wide :class:`LRUCache` (unless `ttl`
+        is 0) and in the active :func:`request_cache` scope, if any.
+        Concurrent cache misses for the same key are executed only once
+        (single-flight): The first task executes, all other tasks wait for its
+        result.
+    '''
+
+    def __init__(self, name, max_size=1000, ttl=60):
+        self.name = name
+        self.results = LRUCache(max_size, ttl) if ttl != 0 else None
+        self.inflight = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def begin(self, key, task):
+        ''' Look up a key for a task that is about to be executed. Return a
+            (HIT, result), (FOLLOW, leading_task) or (LEAD, scope) tuple. The
+            leading task must call :meth:`finish` with the returned scope
+            after it completed. '''
+        scope = _scope.get()
+        with self.lock:
+            if scope is not None and (self.name, key) in scope:
+                self.hits += 1
+                return HIT, scope[self.name, key]
+            if self.results is not None:
+                found, value = self.results.get(key)
+                if found:
+                    self.hits += 1
+                    if scope is not None:
+                        scope[self.name, key] = value
+                    return HIT, value
+            self.misses += 1
+            leader = self.inflight.get(key)
+            if leader is not None:
+                return FOLLOW, leader
+            self.inflight[key] = task
+            return LEAD, scope
+
+    def finish(self, key, task, scope=None):
+        ''' Store the result of a successful task. `scope` is the request
+            scope returned by :meth:`begin`. '''
+        value = task.result() if task.is_success() else None
+        with self.lock:
+            if self.inflight.get(key) is task:
+                del self.inflight[key]
+            if task.is_success():
+                if self.results is not None:
+                    self.results.set(key, value)
+                if scope is not None:
+                    scope[self.name, key] = value
+
+    def clear(self):
+        with self.lock:
+            self.hits = self.misses = 0
+            if self.results is not None:
+                self.results.clear()
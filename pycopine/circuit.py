@@ -0,0 +1,80 @@
+from time import time as now
+import threading
+
+__all__ = ['CircuitBreaker']
+
+# Possible circuit states
+CLOSED    = 'CLOSED'     # Requests pass through
+OPEN      = 'OPEN'       # Requests are short-circuited
+HALF_OPEN = 'HALF_OPEN'  # A single probe request is in flight
+
+
+class CircuitBreaker(object):
+    ''' Short-circuit requests to a command that fails too often.
+
+        The circuit trips OPEN if at least `volume` requests were observed in
+        the rolling window of `metrics` and `threshold` percent of them failed.
+        After `sleep_window` seconds a single probe request is let through
+        (HALF_OPEN). If it succeeds, the circuit is CLOSED again and the
+        metrics are reset. If it fails, the circuit stays OPEN for another
+        `sleep_window` seconds. If the probe does not report back at all, a
+        new probe is let through after another `sleep_window` seconds.
+
+        Checking a CLOSED circuit or marking a success on a CLOSED circuit
+        does not acquire any locks.
+    '''
+
+    def __init__(self, metrics, threshold=50, volume=20, sleep_window=5,
+                 enabled=True):
+        self.metrics = metrics
+        self.threshold = threshold
+        self.volume = volume
+        self.sleep_window = sleep_window
+        self.enabled = enabled
+        self.state = CLOSED
+        self.opened = 0
+        self.lock = threading.Lock()
+
+    def is_open(self):
+        return self.state != CLOSED
+
+    def allow_request(self):
+        ''' Return True if a request should be executed, False if it should be
+            short-circuited. '''
+        if self.state == CLOSED:
+            return True
+        if now() >= self.opened + self.sleep_window:
+            with self.lock:
+                if self.state != CLOSED \
+                and now() >= self.opened + self.sleep_window:
+                    self.state = HALF_OPEN
+                    self.opened = now()
+                    return True
+        return False
+
+    def mark(self, event):
+        ''' Count an event (see :attr:`CommandMetrics.events`) and update the
+            circuit state accordingly. '''
+        self.metrics.increment(event)
+        if event == 'success':
+            if self.state == HALF_OPEN:
+                self.close()
+        elif event in self.metrics.errors:
+            if self.state == HALF_OPEN:
+                self.trip()
+            elif self.state == CLOSED and self.enabled:
+                requests, errors = self.metrics.health()
+                if requests >= self.volume \
+                and errors * 100 >= self.threshold * requests:
+                    self.trip()
+
+    def trip(self):
+        with self.lock:
+            self.state = OPEN
+            self.opened = now()
+
+    def close(self):
+        with self.lock:
+            if self.state == HALF_OPEN:
+                self.metrics.reset()
+                self.state = CLOSED
@@ -0,0 +1,117 @@
+import threading
+from collections import OrderedDict
+
+from .pool import QueueFullError, PoolClosedError
+from . import timer
+
+__all__ = ['Collapser']
+
+
+def arguments_key(a, ka):
+    ''' Default collapse key: The command arguments, if they are hashable. '''
+    key = a, tuple(sorted(ka.items()))
+    try:
+        hash(key)
+    except TypeError:
+        return object() # Never equal to any other key
+    return key
+
+
+class Batch(object):
+    ''' A group of tasks executed by a single run_batch() call. Instances are
+        enqueued into the executor of the command instead of the tasks. '''
+
+    def __init__(self, CommandClass):
+        self.CommandClass = CommandClass
+        self.tasks = OrderedDict()
+
+    def _run(self):
+        tasks = [task for task in self.tasks if task._start()]
+        if not tasks:
+            return
+        self.CommandClass.metrics.increment('collapsed', len(tasks))
+
+        # Tasks with the same key share a single entry in the batch.
+        keys = OrderedDict()
+        for task in tasks:
+            a, ka = task.arguments
+            key = task.collapse_key(*a, **ka)
+            keys.setdefault(key, []).append(task)
+        arguments = [same[0].arguments for same in keys.values()]
+
+        try:
+            results = self.CommandClass.run_batch(arguments)
+            if len(results) != len(arguments):
+                raise ValueError('run_batch() returned %d results for %d '
+                                 'arguments' % (len(results), len(arguments)))
+        except Exception as e:
+            self.CommandClass.logger.exception("Batch failed")
+            for task in tasks:
+                task._finish(None, e)
+            return
+
+        for same, result in zip(keys.values(), results):
+            for task in same:
+                task._finish(result, None)
+
+
+class Collapser(object):
+    ''' Collects tasks of a single command class that arrive within
+        `window` seconds (or until `max_size` tasks are collected) and
+        executes them with a single :meth:`Command.run_batch` call.
+
+        The collapser acts as an executor for the tasks and sits in front of
+        the actual executor of the command, which receives one job per batch.
+        Each task can still be canceled or time out on its own.
+    '''
+
+    def __init__(self, CommandClass, window, max_size=100):
+        self.CommandClass = CommandClass
+        self.window = window
+        self.max_size = max_size
+        self.batch = None
+        self.lock = threading.Lock()
+
+    def get_queue_size(self):
+        ''' Return the number of tasks waiting for the current batch. '''
+        batch = self.batch
+        return len(batch.tasks) if batch else 0
+
+    def enqueue(self, task):
+        with self.lock:
+            batch = self.batch
+            if batch is None:
+                batch = self.batch = Batch(self.CommandClass)
+                timer.schedule_blocking(self.window, self.flush, batch)
+            batch.tasks[task] = None
+            if len(batch.tasks) < self.max_size:
+                return
+        self.flush(batch)
+
+    def dequeue(self, task):
+        ''' Remove a task from the current batch. Return True if the task was
+            still waiting, False otherwise. '''
+        with self.lock:
+            if self.batch and task in self.batch.tasks:
+                del self.batch.tasks[task]
+                return True
+            return False
+
+    def flush(self, batch):
+        ''' Close `batch` and hand it over to the executor. '''
+        with self.lock:
+            if self.batch is not batch:
+                return # Flushed already
+            self.batch = None
+        if not batch.tasks:
+            return
+        CommandClass = self.CommandClass
+        executor = CommandClass.group.get_executor(CommandClass.pool)
+        try:
+            if not getattr(executor, 'supports_batches', True):
+                # Added after the command was defined (see _register())
+                raise PoolClosedError('Executor does not support batches')
+            executor.enqueue(batch)
+        except (QueueFullError, PoolClosedError) as e:
+            for task in batch.tasks:
+                task._reject(e)
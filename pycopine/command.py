@@ -1,13 +1,29 @@
+import asyncio
 import logging
+import queue
+import random
 import threading
+from time import monotonic, sleep
 from . import pool
+from . import metrics
+from . import circuit
+from . import collapser
+from . import cache
+from . import process
+from . import timer
+from . import limits
+from . import events
+from . import hedge
 
 __all__ =  ['Command', 'CommandMeta']
 __all__ += ['CommandGroup']
 __all__ += ['CommandError', 'CommandSetupError', 'CommandTypeError',
             'CommandNameError', 'CommandCancelledError',
             'CommandIntegrityError', 'CommandExecutorNotFoundError',
-            'CommandNotFoundError', 'CommandTimeoutError']
+            'CommandNotFoundError', 'CommandTimeoutError',
+            'CommandRejectedError', 'CommandShortCircuitError',
+            'CommandThrottledError']
+__all__ += ['as_completed', 'gather']
 
 # Possible command states (for internal use only).
 NEW       = 'NEW'        # Initialized but not queued
@@ -35,6 +51,10 @@ class CommandTimeoutError(CommandError): pass
 
 class CommandExecutorError(CommandError): pass
 class CommandExecutorNotFoundError(CommandExecutorError): pass
+class CommandRejectedError(CommandExecutorError): pass
+
+class CommandShortCircuitError(CommandError): pass
+class CommandThrottledError(CommandError): pass
 
 class CommandNotFoundError(CommandError): pass
 
@@ -47,6 +67,11 @@ class CommandGroup(object):
             group.clear()
         CommandGroup.__instances.clear()
 
+    @staticmethod
+    def all_groups():
+        ''' Return a list of all command groups. '''
+        return list(CommandGroup.__instances.values())
+
     def __new__(cls, name='default'):
         if name not in cls.__instances:
             obj = super(CommandGroup, cls).__new__(cls)
@@ -60,7 +85,11 @@ class CommandGroup(object):
         self.commands = {}
         self.logger = logging.getLogger(name)
         self.executors = {}
+        #: Shared :class:`pycopine.limits.TokenBucket` for all commands of
+        #: this group without a :attr:`Command.rate_limit` of their own.
+        self.rate_limit = None
         self.add_executor(pool.Pool('default'))
+        self.add_executor(process.ProcessPool('procs'))
 
     def _register(self, CommandClass):
         assert issubclass(CommandClass, Command)
@@ -70,10 +99,60 @@ class CommandGroup(object):
         name = CommandClass.name or CommandClass.__name__
         if name in self.commands:
             raise CommandNameError("Command names must be unique per group.")
-        self.commands[name] = CommandClass
+        if CommandClass.collapse_window is not None \
+        and CommandClass.run_batch is NotImplementedMethod:
+            raise CommandSetupError("Collapsed commands must implement "
+                                    "run_batch().")
+        if CommandClass.collapse_window is not None \
+        and not getattr(self.executors.get(CommandClass.pool),
+                        'supports_batches', True):
+            raise CommandSetupError("Collapsed commands are not supported by "
+                                    "executor %r." % CommandClass.pool)
         CommandClass.group  = self
         CommandClass.name = name
         CommandClass.logger = self.logger.getChild(name)
+        circuit_options = dict(threshold=CommandClass.circuit_threshold,
+                               volume=CommandClass.circuit_volume,
+                               sleep_window=CommandClass.circuit_sleep,
+                               enabled=CommandClass.circuit_enabled)
+        shared = CommandClass.shared_state
+        if shared is None:
+            CommandClass.metrics = metrics.CommandMetrics(
+                CommandClass.metrics_window, CommandClass.metrics_buckets)
+            CommandClass.circuit = circuit.CircuitBreaker(
+                CommandClass.metrics, **circuit_options)
+        else:
+            key = self.name, name
+            CommandClass.metrics = shared.command_metrics(key,
+                CommandClass.metrics_window, CommandClass.metrics_buckets)
+            CommandClass.circuit = shared.circuit_breaker(key,
+                CommandClass.metrics, **circuit_options)
+        CommandClass.collapser = None
+        if CommandClass.collapse_window is not None:
+            CommandClass.collapser = collapser.Collapser(CommandClass,
+                CommandClass.collapse_window, CommandClass.collapse_max)
+        CommandClass.retry_budget = None
+        if CommandClass.retry_max:
+            CommandClass.retry_budget = limits.TokenBucket(
+                CommandClass.retry_rate, CommandClass.retry_burst)
+        CommandClass.rate_bucket = CommandClass.rate_limit
+        if isinstance(CommandClass.rate_limit, (int, float)):
+            CommandClass.rate_bucket = limits.TokenBucket(
+                CommandClass.rate_limit,
+                CommandClass.rate_burst or max(1, CommandClass.rate_limit))
+        CommandClass.hedger = None
+        if CommandClass.hedge_percentile is not None:
+            CommandClass.hedger = hedge.Hedger(CommandClass.metrics,
+                CommandClass.hedge_percentile, CommandClass.hedge_ratio,
+                CommandClass.hedge_min_delay)
+        CommandClass.cache = None
+        if CommandClass.cache_enabled:
+            CommandClass.cache = cache.CommandCache(
+                (self.name, name), CommandClass.cache_size,
+                CommandClass.cache_ttl)
+        # Only register commands that were set up completely (e.g. the
+        # shared state may be full).
+        self.commands[name] = CommandClass
 
     def get_command(self, name):
         try:
@@ -128,8 +207,8 @@ class Command(object, metaclass=CommandMeta):
         implements the (public) api of concurrent.futures.Future and adds some
         other methods. Instances of this class are called "tasks".
 
-        Subclasses MUST implement :meth:`run` and MAY implement :meth:`fallback`
-        and/or :meth:`cleanup`. Additional methods or attributes should be
+        Subclasses MUST implement :meth:`run` and MAY implement :meth:`fallback`,
+        :meth:`cleanup` and/or :meth:`run_batch`. Additional methods or attributes should be
         avoided or made private (prefixed with two underscores).
     '''
 
@@ -139,17 +218,143 @@ class Command(object, metaclass=CommandMeta):
     pool  = 'default'
     #: Command name. Defaults to class name.
     name = None
+    #: Seconds after submission before an unfinished task fails with a
+    #: CommandTimeoutError and is removed from its executor. Worker processes
+    #: (see :mod:`pycopine.process`) are terminated, worker threads cannot be
+    #: interrupted and their result is ignored. None disables the timeout.
+    timeout = None
+    #: Priority class. Queued tasks with lower values run first. Within a
+    #: class, tasks with earlier deadlines (see :attr:`timeout`) run first.
+    priority = 0
+
+    #: Length of the rolling metrics window (seconds).
+    metrics_window = 10
+    #: Number of buckets the rolling metrics window is divided into.
+    metrics_buckets = 10
+
+    #: :class:`pycopine.shared.SharedState` to share event counters and
+    #: circuit state with other processes. Must be set before the command is
+    #: defined. None keeps all state local to the current process.
+    shared_state = None
+
+    #: Trip the circuit breaker if the command fails too often.
+    circuit_enabled = True
+    #: Minimum number of requests in the rolling window to trip the circuit.
+    circuit_volume = 20
+    #: Error percentage (0-100) that trips the circuit.
+    circuit_threshold = 50
+    #: Seconds to short-circuit all requests before a probe is let through.
+    circuit_sleep = 5
+
+    #: Collect tasks submitted within this many seconds and execute them with
+    #: a single :meth:`run_batch` call. None disables request collapsing.
+    collapse_window = None
+    #: Maximum number of tasks per batch.
+    collapse_max = 100
+
+    #: Answer tasks with equal :meth:`cache_key` from a result cache instead
+    #: of executing them. Concurrent tasks with equal keys are executed once.
+    cache_enabled = False
+    #: Seconds a result is kept in the process wide cache. 0 disables the
+    #: process wide cache (results are still cached per request_cache() scope
+    #: and concurrent tasks are still executed once), None disables expiry.
+    cache_ttl = 60
+    #: Maximum number of results in the process wide cache.
+    cache_size = 1000
+
+    #: Number of times a failed run() is retried before the task fails.
+    #: 0 disables retries.
+    retry_max = 0
+    #: Exception types that are retried.
+    retry_on = (Exception,)
+    #: Delay before the first retry (seconds). Multiplied by
+    #: :attr:`retry_multiplier` for each further retry, up to
+    #: :attr:`retry_max_delay`. Tasks are re-queued after the delay, they do
+    #: not block a worker while waiting.
+    retry_delay = .1
+    retry_multiplier = 2
+    retry_max_delay = 10
+    #: Wait a random time between zero and the computed delay (full jitter).
+    retry_jitter = True
+    #: Retry budget: At most this many retries per second (on average) for
+    #: all tasks of this command, with bursts of up to :attr:`retry_burst`.
+    #: Failures are not retried while the budget is exhausted.
+    retry_rate = 10
+    retry_burst = 20
+
+    #: Start at most this many tasks per second (on average), with bursts of
+    #: up to :attr:`rate_burst` tasks. Either a number or a
+    #: :class:`pycopine.limits.TokenBucket` shared with other commands.
+    #: Defaults to the :attr:`CommandGroup.rate_limit` of the group. None
+    #: disables rate limiting.
+    rate_limit = None
+    #: Bucket size. Defaults to one second worth of tasks.
+    rate_burst = None
+    #: Behaviour if the rate limit is exceeded: 'reject' fails the task with
+    #: a CommandThrottledError (the fallback applies), 'block' blocks
+    #: submit() until the task may start, 'queue' delays the task without
+    #: blocking the caller.
+    rate_mode = 'reject'
+    #: In 'block' and 'queue' mode, tasks that would have to wait longer than
+    #: this (or past their deadline) are throttled.
+    rate_max_wait = 1
+
+    #: Hedged requests (see :mod:`pycopine.hedge`): Submit a copy of a task
+    #: that did not complete within this percentile of recent latencies. The
+    #: first successful result wins. None disables hedging.
+    hedge_percentile = None
+    #: Maximum number of copies per task.
+    hedge_max = 1
+    #: Hedge budget: Copies never exceed this fraction of all requests in
+    #: the rolling metrics window.
+    hedge_ratio = .05
+    #: Minimum delay (seconds) before a copy is submitted.
+    hedge_min_delay = .001
+
+    #: Lifecycle hook dispatcher, called as ``_trace(task, transition,
+    #: pool)``. Managed by :mod:`pycopine.trace`. None if no hooks are
+    #: installed.
+    _trace = None
 
     run = NotImplementedMethod
     fallback = NotImplementedMethod
     def cleanup(self): pass
 
+    #: Class method that receives a list of ``(args, kwargs)`` tuples and
+    #: returns a list of results in the same order. Required if
+    #: :attr:`collapse_window` is set.
+    run_batch = NotImplementedMethod
+
+    def cache_key(self, *a, **ka):
+        ''' Return a hashable key for the task arguments, or None to bypass
+            the cache. Only used if :attr:`cache_enabled` is true. Defaults to
+            the arguments themselves, if they are hashable. '''
+        key = a, tuple(sorted(ka.items()))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def collapse_key(self, *a, **ka):
+        ''' Return a hashable key for the task arguments. Collapsed tasks with
+            equal keys share a single entry in the batch (and the result).
+            Defaults to the arguments themselves. '''
+        return collapser.arguments_key(a, ka)
+
+    # Task state is kept in slots. Subclasses without __slots__ still get a
+    # __dict__ for their own attributes.
+    __slots__ = ('arguments', '__statelock', '__state', '__canceled',
+                 '__result', '__exception', '__waiters',
+                 '__fallback_state', '__fallback_result', '__fallback_exception',
+                 '__pool', '__callbacks', '__fallback_task', '__timer',
+                 '__hedge_timer',
+                 '__submitted', '__started', '__deadline', '__attempts',
+                 '__hedges', '__primary')
+
     def __init__(self, *a, **ka):
         self.arguments = a, ka
 
-        # This event is set if state changes to FINISHED, FAILED or CANCELLED
-        self.__completed = threading.Event()
-
         # The state is protected by a lock
         self.__statelock = threading.Lock()
         self.__state = NEW
@@ -158,6 +363,11 @@ class Command(object, metaclass=CommandMeta):
         self.__result = None
         self.__exception = None
 
+        # Threads waiting for completion. Each waiter is a locked lock that
+        # is released as soon as the task completes. None, a single waiter
+        # or a list of waiters.
+        self.__waiters = None
+
         # The fallback lock protects the fallback state, and ensures that
         # the fallback is only invoked once.
         self.__fallback_state = NEW
@@ -165,19 +375,243 @@ class Command(object, metaclass=CommandMeta):
         self.__fallback_exception = None
 
         self.__pool = None
+        self.__callbacks = None
+        self.__fallback_task = None
+        self.__timer = None
+        self.__hedge_timer = None
+
+        # Timestamps (monotonic clock) for latency metrics
+        self.__submitted = None
+        self.__started = None
+        # Tasks not started before this time (monotonic) are not run at all
+        self.__deadline = None
+        # Number of times run() was called
+        self.__attempts = 0
+        # Number of hedged copies of this task, and the original task if
+        # this task is a copy
+        self.__hedges = 0
+        self.__primary = None
 
     def submit(self):
         ''' Queue the task for execution. Submitting a task multiple times has
             no effect. The return value is the task itself to allow chained
             method calls.
+
+            If the result is cached, the task completes immediately. If the
+            circuit breaker for this command is open or the executor rejects
+            the task, the task fails immediately and result() returns the
+            fallback value without waiting.
         '''
-        with self.__statelock:
-            if self.__state == NEW:
-                self.__state = PENDING
-                self.__pool = self.group.get_executor(self.pool)
-                self.__pool.enqueue(self)
+        executor = self.__prepare()
+        if executor is not None:
+            self.__enqueue(executor)
         return self
 
+    @staticmethod
+    def submit_many(tasks):
+        ''' Submit multiple tasks at once and return them as a list. Tasks
+            for the same executor are enqueued with a single
+            ``enqueue_many()`` call, if the executor supports it. '''
+        tasks = list(tasks)
+        batches = {}
+        for task in tasks:
+            executor = task.__prepare()
+            if executor is not None:
+                batches.setdefault(executor, []).append(task)
+
+        for executor, batch in batches.items():
+            enqueue_many = getattr(executor, 'enqueue_many', None)
+            if enqueue_many is None:
+                for task in batch:
+                    task.__enqueue(executor)
+                continue
+            for task in batch:
+                task.__pool = executor
+            try:
+                rejected = enqueue_many(batch)
+                error = pool.QueueFullError('Queue full')
+            except pool.PoolClosedError as e:
+                rejected, error = batch, e
+            for task in rejected:
+                task._reject(error)
+        return tasks
+
+    @classmethod
+    def map(cls, *iterables, timeout=None):
+        ''' Create, submit and gather one task per set of arguments, similar
+            to the built-in map(). Return a list of results (see
+            :func:`gather`). '''
+        return gather([cls(*a) for a in zip(*iterables)], timeout)
+
+    def __prepare(self):
+        ''' Change state from NEW to PENDING and return the executor for the
+            task, or None if the task must not be enqueued (e.g. because
+            it was already submitted, the result is cached or the circuit
+            is open). '''
+        with self.__statelock:
+            if self.__state != NEW:
+                return None
+            executor = self.group.get_executor(self.pool)
+            if self.collapser:
+                executor = self.collapser
+            self.__state = PENDING
+            self.__submitted = monotonic()
+            if self.timeout is not None:
+                self.__timer = timer.schedule(self.timeout, self._expire)
+                deadline = self.__submitted + self.timeout
+                if self.__deadline is None or deadline < self.__deadline:
+                    self.__deadline = deadline
+            if self.hedger is not None and self.__primary is None \
+            and not self.collapser:
+                delay = self.hedger.delay()
+                if delay is not None:
+                    self.__hedge_timer = timer.schedule(delay,
+                                                        self.__hedge_due, delay)
+        if self._trace is not None:
+            self._trace(self, 'submit', self.pool)
+
+        # Hedge copies must run: The cache would attach them to the primary.
+        if self.cache is not None and self.__primary is None \
+        and self.__from_cache():
+            return None
+        return self.__admit(executor)
+
+    def __admit(self, executor):
+        ''' Apply the circuit breaker and the rate limit. Return the executor
+            if the task may be enqueued right now, None otherwise. '''
+        if not self.circuit.allow_request():
+            if self.__abort(CommandShortCircuitError(), canceled=False):
+                self.circuit.mark('short_circuited')
+            return None
+
+        bucket = self.rate_bucket or self.group.rate_limit
+        if bucket is not None:
+            return self.__throttle(bucket, executor)
+        return executor
+
+    def __throttle(self, bucket, executor):
+        ''' Apply the rate limit (see :attr:`rate_limit`). Return the executor
+            if the task may be enqueued right now, None otherwise. '''
+        max_wait = 0
+        if self.rate_mode != 'reject':
+            max_wait = self.rate_max_wait
+            if self.__deadline is not None:
+                max_wait = min(max_wait, self.__deadline - monotonic())
+        delay = bucket.reserve(1, max(0, max_wait))
+        if delay is None:
+            if self.__abort(CommandThrottledError(), canceled=False):
+                self.circuit.mark('throttled')
+            return None
+        if delay and self.rate_mode == 'queue':
+            timer.schedule_blocking(delay, self.__resubmit, executor)
+            return None
+        if delay:
+            sleep(delay)
+        return executor
+
+    def __hedge_due(self, delay):
+        ''' Called in the timer thread. Only unfinished tasks are handed off
+            to a helper thread to submit a copy. '''
+        if self.__state in (PENDING, RUNNING):
+            timer.call_blocking(self.__hedge, delay)
+
+    def __hedge(self, delay):
+        ''' Submit a copy of an unfinished task (see :attr:`hedge_percentile`)
+            and schedule the next one. '''
+        with self.__statelock:
+            if self.__state not in (PENDING, RUNNING) \
+            or self.__hedges >= self.hedge_max or not self.hedger.allow():
+                return
+            self.__hedges += 1
+        a, ka = self.arguments
+        copy = type(self)(*a, **ka)
+        copy.__primary = self
+        self.metrics.increment('hedge')
+        self.add_done_callback(lambda task: copy.cancel())
+        copy.add_done_callback(self.__adopt)
+        copy.submit()
+        if self.__hedges < self.hedge_max:
+            self.__hedge_timer = timer.schedule(delay, self.__hedge_due, delay)
+
+    def __adopt(self, copy):
+        ''' Complete the task with the result of a successful copy. '''
+        if not copy.is_success():
+            return
+        with self.__statelock:
+            if self.__state not in (PENDING, RUNNING):
+                return
+            self.__complete(SUCCEDED, result=copy.__result)
+        if self.__pool:
+            self.__pool.dequeue(self)
+        self.metrics.increment('hedge_win')
+        self.metrics.record('total', monotonic() - self.__submitted)
+        if self._trace is not None:
+            self._trace(self, 'success', self.pool)
+        self.__notify()
+
+    def __enqueue(self, executor):
+        self.__pool = executor
+        try:
+            executor.enqueue(self)
+        except (pool.QueueFullError, pool.PoolClosedError) as e:
+            self._reject(e)
+
+    def __from_cache(self):
+        ''' Complete the task from cache or attach it to an equal task that
+            is already running. Return False if the task must be executed. '''
+        a, ka = self.arguments
+        key = self.cache_key(*a, **ka)
+        if key is None:
+            return False
+
+        status, value = self.cache.begin(key, self)
+        if status == cache.HIT:
+            with self.__statelock:
+                if self.__state != PENDING:
+                    return True
+                self.__complete(SUCCEDED, result=value)
+            self.metrics.increment('cache_hit')
+            if self._trace is not None:
+                self._trace(self, 'success', self.pool)
+            self.__notify()
+            return True
+        if status == cache.FOLLOW:
+            value.add_done_callback(self.__follow)
+            return True
+        self.add_done_callback(lambda task: self.cache.finish(key, task, value))
+        return False
+
+    def __follow(self, leader):
+        ''' Copy the outcome of an equal task (see __from_cache()). If that
+            task was canceled or timed out, look up the cache again: One of
+            its followers becomes the new leader, the others follow it. '''
+        if leader.is_canceled():
+            # Usually called in the timer thread (see _expire()), which must
+            # not run the command (e.g. on a SemaphorePool).
+            timer.schedule_blocking(0, self.__reelect)
+            return
+        with self.__statelock:
+            if self.__state != PENDING:
+                return
+            if leader.__state == SUCCEDED:
+                self.__complete(SUCCEDED, result=leader.__result)
+            else:
+                self.__complete(FAILED, exception=leader.__exception)
+            event = 'success' if self.__state == SUCCEDED else 'failure'
+        # Not executed, so the outcome is not marked in the circuit again.
+        self.metrics.increment('cache_hit')
+        if self._trace is not None:
+            self._trace(self, event, self.pool)
+        self.__notify()
+
+    def __reelect(self):
+        ''' Execute a follower whose leader was canceled, or attach it to the
+            new leader (see __follow()). '''
+        if self.__state == PENDING and not self.__from_cache():
+            executor = self.__admit(self.group.get_executor(self.pool))
+            if executor is not None:
+                self.__enqueue(executor)
+
     def cancel(self, exception=None):
         ''' Abandon an unfinished task and immediately wake up all threads
             waiting for the result.
@@ -192,19 +626,103 @@ class Command(object, metaclass=CommandMeta):
             Return True if the task was canceled in a NEW or PENDING state,
               indicating that the run() method was not invoked.
         '''
+        self.__abort(exception or CommandCancelledError())
+        return self.__pool.dequeue(self) if self.__pool else True
+
+    def __abort(self, exception, canceled=True):
+        ''' Mark an unfinished task as FAILED (and canceled). Return True if
+            the state was changed by this call. '''
+        with self.__statelock:
+            if self.__state not in (NEW, PENDING, RUNNING):
+                return False
+            self.__canceled = canceled
+            self.__complete(FAILED, exception=exception)
+        if self._trace is not None:
+            self._trace(self, 'cancel', self.pool)
+        self.__notify()
+        return True
+
+    def __complete(self, state, result=None, exception=None):
+        ''' Set the final state and wake up waiting threads. The caller must
+            hold the state lock. '''
+        self.__state = state
+        self.__result = result
+        self.__exception = exception
+        waiters = self.__waiters
+        if waiters is not None:
+            if type(waiters) is list:
+                for waiter in waiters:
+                    waiter.release()
+            else:
+                waiters.release()
+            self.__waiters = None
+
+    def __notify(self):
+        ''' Invoke (and forget) all done-callbacks. Must be called after the
+            task completed, without holding the state lock. '''
+        if self.__timer is not None:
+            self.__timer.cancel()
+        if self.__hedge_timer is not None:
+            self.__hedge_timer.cancel()
+        if self.__callbacks is None:
+            return
+        with self.__statelock:
+            callbacks, self.__callbacks = self.__callbacks, None
+        for callback in callbacks or ():
+            try:
+                callback(self)
+            except Exception:
+                self.logger.exception('Done-callback failed')
+
+    def add_done_callback(self, fn):
+        ''' Call `fn(task)` as soon as the task completes (succeeds, fails or
+            is canceled). If the task is already completed, `fn` is called
+            immediately. Callbacks are invoked in the thread that completed
+            the task and should not block. '''
         with self.__statelock:
-            if self.__state in (NEW, PENDING, RUNNING):
-                self.__exception = exception or CommandCancelledError()
-                self.__state = FAILED
-                self.__canceled = True
-                self.__completed.set()
-            return self.__pool.dequeue(self) if self.__pool else True
+            if self.__state not in (SUCCEDED, FAILED):
+                if self.__callbacks is None:
+                    self.__callbacks = []
+                self.__callbacks.append(fn)
+                return
+        fn(self)
 
     def wait(self, timeout=None):
         ''' Wait for the task to complete. Return True if the task completed
             within timeout seconds regardless of the result, False otherwise.
         '''
-        return self.__completed.wait(timeout)
+        if self.__state in (SUCCEDED, FAILED):
+            return True
+        waiter = _take_waiter()
+        with self.__statelock:
+            if self.__state in (SUCCEDED, FAILED):
+                _local.waiter = waiter
+                return True
+            waiters = self.__waiters
+            if waiters is None:
+                self.__waiters = waiter
+            elif type(waiters) is list:
+                waiters.append(waiter)
+            else:
+                self.__waiters = [waiters, waiter]
+        if timeout is None:
+            done = waiter.acquire()
+        else:
+            done = waiter.acquire(timeout=max(0, timeout))
+        if not done:
+            with self.__statelock:
+                waiters = self.__waiters
+                if waiters is waiter:
+                    self.__waiters = None
+                elif type(waiters) is list and waiter in waiters:
+                    waiters.remove(waiter)
+                else:
+                    # Released by __complete() after the timeout. Lock it
+                    # again, so it can be reused.
+                    waiter.acquire()
+                    done = True
+        _local.waiter = waiter
+        return done
 
     def result(self, timeout=None):
         ''' Submit the task and return the result as soon as it is available.
@@ -217,13 +735,21 @@ class Command(object, metaclass=CommandMeta):
             If no result is available within ``timeout`` seconds, the task is
             canceled with a CommandTimeoutError. If you want to wait a limited
             time but not cancel the task early, use wait() instead.
+
+            Tasks for a :class:`pycopine.pool.SemaphorePool` that use no
+            optional features are run directly, without a round trip through
+            submit() and the executor.
         '''
-        self.submit()
+        if timeout is not None and self.__state == NEW:
+            self.__deadline = monotonic() + timeout
+        executor = self.__inline_executor() if self.__state == NEW else None
+        if executor is None or not self.__run_inline(executor):
+            self.submit()
 
         if self.__state in (PENDING, RUNNING):
-            self.__completed.wait(timeout)
+            self.wait(timeout)
             if self.__state in (PENDING, RUNNING):
-                self.cancel(CommandTimeoutError())
+                self._expire()
 
         if self.__state == SUCCEDED:
             return self.__result
@@ -233,14 +759,93 @@ class Command(object, metaclass=CommandMeta):
         else:
             raise self.__exception
 
-    def exception(self, timeout=None):
-        if self.__completed.is_set():
-            return self.__exception
-
+    def __inline_executor(self):
+        ''' Return the executor if result() may run the task directly (see
+            __run_inline()), None otherwise. This is the case for tasks on a
+            SemaphorePool that use none of the optional features (timeout,
+            collapsing, cache, hedging, retries, rate limits and tracing),
+            while the circuit is closed. '''
+        if self.timeout is None and self.collapser is None \
+        and self.cache is None and self.hedger is None \
+        and not self.retry_max and self.rate_bucket is None \
+        and self.group.rate_limit is None and self._trace is None \
+        and self.__callbacks is None \
+        and self.circuit.state == circuit.CLOSED:
+            executor = self.group.executors.get(self.pool)
+            if type(executor) is pool.SemaphorePool:
+                return executor
+        return None
+
+    def __run_inline(self, executor):
+        ''' Fast path of result(): Run a NEW task in the current thread,
+            without going through submit() and the executor. Return False
+            (and do nothing) if the task must take the regular path instead,
+            e.g. because the pool is full. '''
+        if not executor._acquire():
+            return False
+        with self.__statelock:
+            start = self.__state == NEW
+            if start:
+                self.__state = RUNNING
+                self.__submitted = self.__started = monotonic()
+                self.__attempts = 1
+                self.__pool = executor
+        if not start: # Canceled by another thread
+            executor._release(executed=False)
+            return False
+
+        # Not queued, so no queue time is recorded.
+        run_error, result = None, None
         try:
-            self.result(timeout)
-        except Exception:
-            return self.__exception
+            a, ka = self.arguments
+            result = self.run(*a, **ka)
+            if _is_coroutine(result):
+                result = asyncio.run(result)
+        except Exception as e:
+            self.logger.exception("Command failed")
+            run_error = e
+        finally:
+            executor._release()
+        self._finish(result, run_error)
+        return True
+
+    async def aresult(self, timeout=None):
+        ''' Coroutine version of :meth:`result`. Instead of blocking the
+            current thread, the coroutine is suspended until the task
+            completes. Coroutine fallback() methods are awaited. '''
+        self.submit()
+
+        if self.__state not in (SUCCEDED, FAILED):
+            loop = asyncio.get_running_loop()
+            waiter = loop.create_future()
+            def wakeup(task):
+                loop.call_soon_threadsafe(_set_future_done, waiter)
+            self.add_done_callback(wakeup)
+            try:
+                await asyncio.wait_for(waiter, timeout)
+            except asyncio.TimeoutError:
+                self._expire()
+
+        if self.__state == SUCCEDED:
+            return self.__result
+
+        if await self.__atry_fallback():
+            return self.__fallback_result
+        else:
+            raise self.__exception
+
+    def __await__(self):
+        return self.aresult().__await__()
+
+    def exception(self, timeout=None):
+        ''' Submit the task and return the exception that caused the failure,
+            or None if the task completed successfully. '''
+        if self.__state not in (SUCCEDED, FAILED):
+            try:
+                self.result(timeout)
+            except Exception:
+                pass
+        return self.__exception
 
     def has_result(self):
         ''' Returns True if a result is available. The next call to result()
@@ -275,49 +880,292 @@ class Command(object, metaclass=CommandMeta):
         return self.__state in (SUCCEDED, FAILED)
 
     def __try_fallback(self):
+        called = False
         with self.__statelock:
             if self.__state == FAILED and self.__fallback_state == NEW:
                 if self.fallback is NotImplementedMethod:
                     self.__fallback_state = FAILED
+                elif asyncio.iscoroutinefunction(self.fallback) \
+                and (self.__fallback_task or _in_event_loop()):
+                    pass # Must be awaited. See aresult()
                 else:
+                    called = True
                     try:
                         a, ka = self.arguments
-                        self.__fallback_result = self.fallback(*a, **ka)
-                        self.__fallback_state = SUCCEDED
+                        result = self.fallback(*a, **ka)
+                        if asyncio.iscoroutine(result):
+                            result = asyncio.run(result)
+                        self.__fallback_done(result, None)
                     except Exception as e:
-                        self.__fallback_exception = e
-                        self.__fallback_state = FAILED
-                        self.logger.exception('Fallback failed')
-            return self.__fallback_state == SUCCEDED
-
-    def _run(self):
-
+                        self.__fallback_done(None, e)
+        if called and self._trace is not None:
+            self._trace(self, 'fallback', self.pool)
+        return self.__fallback_state == SUCCEDED
+
+    async def __atry_fallback(self):
+        if not asyncio.iscoroutinefunction(self.fallback):
+            return self.__try_fallback()
         with self.__statelock:
-            if self.__state != PENDING: return
-            self.__state = RUNNING
-
-        run_error, result = None, None
+            if self.__state == FAILED and self.__fallback_state == NEW \
+            and self.__fallback_task is None:
+                self.__fallback_task = asyncio.ensure_future(self.__afallback())
+            task = self.__fallback_task
+        if task is not None:
+            await asyncio.shield(task)
+        return self.__fallback_state == SUCCEDED
+
+    async def __afallback(self):
         try:
             a, ka = self.arguments
-            result = self.run(*a, **ka)
+            result, error = await self.fallback(*a, **ka), None
         except Exception as e:
-            self.logger.exception("Command failed")
-            run_error = e
+            result, error = None, e
+        with self.__statelock:
+            self.__fallback_done(result, error)
+        if self._trace is not None:
+            self._trace(self, 'fallback', self.pool)
+
+    def __fallback_done(self, result, error):
+        ''' Store the fallback result. The caller must hold the state lock. '''
+        if error is None:
+            self.__fallback_result = result
+            self.__fallback_state = SUCCEDED
+            self.metrics.increment('fallback_success')
+        else:
+            self.__fallback_exception = error
+            self.__fallback_state = FAILED
+            self.metrics.increment('fallback_failure')
+            self.logger.error('Fallback failed', exc_info=error)
+
+    # The following methods are used by executors to drive the task through
+    # its states if they do not call _run() or _arun() directly.
 
+    def _start(self):
+        ''' Change state from PENDING to RUNNING. Return False if the task
+            must not run (e.g. because it was canceled). '''
+        with self.__statelock:
+            if self.__state != PENDING:
+                return False
+            self.__state = RUNNING
+            self.__started = monotonic()
+            self.__attempts += 1
+        self.metrics.record('queue', self.__started - self.__submitted)
+        if self._trace is not None:
+            self._trace(self, 'start', self.pool)
+        return True
+
+    def _deadline(self):
+        ''' Return the time (monotonic clock) after which the task should not
+            be started anymore, or None. '''
+        return self.__deadline
+
+    def _expire(self):
+        ''' Fail an unfinished task with a CommandTimeoutError and remove it
+            from its executor. '''
+        if self.__abort(CommandTimeoutError()):
+            self.circuit.mark('timeout')
+        if self.__pool:
+            self.__pool.dequeue(self)
+
+    def _reject(self, error):
+        ''' Fail a task that was not accepted by its executor. `error` is the
+            exception raised by the executor. '''
+        if self.__abort(CommandRejectedError(str(error))):
+            self.circuit.mark('rejected')
+
+    def _finish(self, result, run_error):
+        ''' Complete a RUNNING task with a result or an exception, update the
+            metrics and call cleanup(). Failures may be retried (see
+            :attr:`retry_max`). '''
+        event = None
         with self.__statelock:
             if self.__state == RUNNING:
-                if run_error:
-                    self.__state = FAILED
-                    self.__exception = run_error
+                delay = None
+                if run_error and self.retry_max:
+                    delay = self.__retry(run_error)
+                if delay is not None:
+                    self.__state = PENDING
+                    event = 'retry'
+                elif run_error:
+                    self.__complete(FAILED, exception=run_error)
+                    event = 'failure'
+                    if isinstance(run_error, CommandTimeoutError):
+                        event = 'timeout'
                 else:
-                    self.__state = SUCCEDED
-                    self.__result = result
-                self.__completed.set()
+                    self.__complete(SUCCEDED, result=result)
+                    event = 'success'
             elif self.__state == FAILED:
                 pass # Canceled while running
 
+        finished = monotonic()
+        self.metrics.record('run', finished - self.__started)
+        if event and self._trace is not None:
+            self._trace(self, event, self.pool)
+        if event == 'retry':
+            self.metrics.increment('retry')
+            events.emit('command.retry', group=self.group.name,
+                        command=self.name, attempt=self.__attempts,
+                        delay=delay, error=repr(run_error))
+            timer.schedule_blocking(delay, self.__requeue, self.__pool)
+        elif event:
+            self.metrics.record('total', finished - self.__submitted)
+            self.circuit.mark(event)
+            self.__notify()
+
         try:
             self.cleanup()
         except Exception:
             self.logger.exception("Command cleanup failed.")
+        if self._trace is not None:
+            self._trace(self, 'cleanup', self.pool)
+
+    def __retry(self, error):
+        ''' Return the delay before the next attempt, or None if the task
+            should not be retried. The caller must hold the state lock. '''
+        if self.__attempts > self.retry_max \
+        or not isinstance(error, self.retry_on) \
+        or self.circuit.is_open():
+            return None
+        delay = min(self.retry_max_delay,
+                    self.retry_delay * self.retry_multiplier
+                    ** (self.__attempts - 1))
+        if self.retry_jitter:
+            delay *= random.random()
+        if self.__deadline is not None \
+        and monotonic() + delay >= self.__deadline:
+            return None
+        if not self.retry_budget.try_acquire():
+            return None
+        return delay
+
+    def __requeue(self, executor):
+        ''' Queue a task again after a failed attempt (see
+            :attr:`retry_max`). Each attempt takes a token from the rate
+            limit, like the first one. '''
+        if self.__state != PENDING:
+            return
+        bucket = self.rate_bucket or self.group.rate_limit
+        if bucket is not None:
+            executor = self.__throttle(bucket, executor)
+        if executor is not None:
+            self.__enqueue(executor)
+
+    def __resubmit(self, executor):
+        ''' Queue a delayed task (see :attr:`rate_mode`), unless it was
+            canceled in the meantime. '''
+        if self.__state == PENDING:
+            self.__enqueue(executor)
+
+    def _run(self):
+        ''' Execute run() in the current thread. Coroutine run() methods are
+            executed in a new event loop. '''
+        if not self._start():
+            return
+
+        run_error, result = None, None
+        try:
+            a, ka = self.arguments
+            result = self.run(*a, **ka)
+            if _is_coroutine(result):
+                result = asyncio.run(result)
+        except Exception as e:
+            self.logger.exception("Command failed")
+            run_error = e
 
+        self._finish(result, run_error)
+
+    async def _arun(self):
+        ''' Execute run() in the running event loop. '''
+        if not self._start():
+            return
+
+        run_error, result = None, None
+        try:
+            a, ka = self.arguments
+            result = self.run(*a, **ka)
+            if asyncio.iscoroutine(result):
+                result = await result
+        except asyncio.CancelledError:
+            run_error = CommandCancelledError()
+        except Exception as e:
+            self.logger.exception("Command failed")
+            run_error = e
+
+        self._finish(result, run_error)
+
+
+def as_completed(tasks, timeout=None):
+    ''' Submit all tasks (see :meth:`Command.submit_many`) and yield them as
+        they complete. Tasks that did not complete within `timeout` seconds
+        are failed with a CommandTimeoutError (as with
+        :meth:`Command.result`) and yielded last. '''
+    tasks = list(tasks)
+    done = queue.SimpleQueue()
+    Command.submit_many(tasks)
+    for task in tasks:
+        task.add_done_callback(done.put)
+    deadline = None if timeout is None else monotonic() + timeout
+    for _ in range(len(tasks)):
+        try:
+            if deadline is None:
+                yield done.get()
+            else:
+                yield done.get(timeout=max(0, deadline - monotonic()))
+        except queue.Empty:
+            for task in tasks:
+                task._expire()
+            yield done.get()
+
+
+def gather(tasks, timeout=None):
+    ''' Submit all tasks, wait for them to complete and return a list of
+        results in the same order. The results are obtained by calling
+        :meth:`Command.result` on each task, so fallbacks apply and the first
+        unhandled exception is raised. '''
+    tasks = list(tasks)
+    for task in as_completed(tasks, timeout):
+        pass
+    return [task.result() for task in tasks]
+
+
+_local = threading.local()
+
+def _take_waiter():
+    ''' Return a locked lock to wait for a task. Each thread reuses the same
+        lock for all tasks. It must be put back into `_local.waiter` (in
+        locked state) after use. '''
+    waiter = getattr(_local, 'waiter', None)
+    if waiter is None:
+        waiter = threading.Lock()
+        waiter.acquire()
+    else:
+        _local.waiter = None # Not available to nested calls
+    return waiter
+
+
+#: Types of run() results that are known not to be coroutines
+_plain_types = set()
+
+def _is_coroutine(obj):
+    ''' Like asyncio.iscoroutine(), but cheaper for plain return values. '''
+    cls = type(obj)
+    if cls in _plain_types:
+        return False
+    if asyncio.iscoroutine(obj):
+        return True
+    if len(_plain_types) < 100:
+        _plain_types.add(cls)
+    return False
+
+
+def _in_event_loop():
+    try:
+        asyncio.get_running_loop()
+        return True
+    except RuntimeError:
+        return False
+
+
+def _set_future_done(future):
+    if not future.done():
+        future.set_result(None)
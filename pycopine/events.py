@@ -1,11 +1,17 @@
 from time import time as now
+from collections import deque
 import itertools
-import queue
 import atexit
 import sys
 import threading
 
-__all__ = ['sink', 'BaseSink', 'EventManager']
+__all__ = ['sink', 'BaseSink', 'EventManager',
+           'DROP_OLDEST', 'DROP_NEWEST', 'SAMPLE']
+
+# Overflow policies
+DROP_OLDEST = 'DROP_OLDEST' # Make room for new events
+DROP_NEWEST = 'DROP_NEWEST' # Keep old events, reject new ones
+SAMPLE      = 'SAMPLE'      # Accept every n-th new event, dropping old ones
 
 def _stderr(msg):
     sys.stderr.write(msg.strip()+'\n')
@@ -15,14 +21,25 @@ class BaseSink(object):
     def consume(self, event):
         raise NotImplementedError()
 
+    def consume_batch(self, events):
+        ''' Consume a list of events. The default implementation calls
+            :meth:`consume` for each event. '''
+        for event in events:
+            self.consume(event)
+
     def __eq__(self, other):
         return self.consume is other.consume
 
+    __hash__ = object.__hash__
 
-class FuncSink(object):
+
+class FuncSink(BaseSink):
     def __init__(self, func):
         self.consume = func
 
+    def __hash__(self):
+        return hash(self.consume)
+
     def __repr__(self):
         return '<FuncSink of {}>'.format(self.consume)
 
@@ -37,64 +54,114 @@ def sink(func):
 _getid = iter(itertools.count()).__next__
 
 class EventManager(object):
-    def __init__(self):
+    ''' Collects events in a bounded buffer and delivers them in batches to
+        all registered sinks, using a background thread.
+
+        Emitting an event does not block and does not acquire any locks as
+        long as the buffer has room. If the buffer is full, the `policy`
+        decides which events are dropped (see DROP_OLDEST, DROP_NEWEST and
+        SAMPLE). The number of dropped and delivered events is available as
+        :attr:`dropped` and :attr:`delivered`.
+    '''
+
+    def __init__(self, max_size=10000, policy=DROP_OLDEST, sample_rate=10,
+                 batch_size=100):
         self.lock = threading.Lock()
         self.sinks = []
         self._sink_callbacks = []
-        self.queue = queue.Queue()
+        self.max_size = max_size
+        self.policy = policy
+        self.sample_rate = sample_rate
+        self.batch_size = batch_size
+        self.buffer = deque(maxlen=max_size)
+        self.dropped = 0
+        self.delivered = 0
+        self._sample = itertools.count().__next__
+        self._wakeup = threading.Event()
+        self._closed = False
         self.thread = threading.Thread(target=self._sink_loop)
         self.thread.daemon = True
         self.thread.start()
-    
+
     def add_sink(self, sink):
         with self.lock:
             if sink in self.sinks: return
             self.sinks.append(sink)
-            self._sink_callbacks = [s.consume for s in self.sinks]
+            self._update_callbacks()
         return sink
 
+    def _update_callbacks(self):
+        callbacks = []
+        for sink in self.sinks:
+            batch = getattr(sink, 'consume_batch', None)
+            if batch is None:
+                batch = BaseSink.consume_batch.__get__(sink)
+            callbacks.append((sink, batch))
+        self._sink_callbacks = callbacks
+
     def clear(self):
         with self.lock:
             del self.sinks[:]
-            del self._sink_callbacks[:]
+            self._sink_callbacks = []
 
     def emit(self, _name, **event):
         event['_ts'] = now()
         event['name'] = _name
-        with self.lock:
-            event['_id'] = _getid()
-        self.queue.put(event)
+        event['_id'] = _getid()
+        self.consume(event)
 
     def consume(self, event):
-        self.queue.put(event)
+        buffer = self.buffer
+        if len(buffer) >= self.max_size:
+            if self.policy == DROP_NEWEST \
+            or self.policy == SAMPLE and self._sample() % self.sample_rate:
+                self._count_dropped()
+                return
+            self._count_dropped() # The oldest event is dropped by append()
+        buffer.append(event)
+        if not self._wakeup.is_set():
+            self._wakeup.set()
+
+    def _count_dropped(self):
+        with self.lock:
+            self.dropped += 1
 
-    def _remove_sink_after_error(self, consume_callback, e):
-        sink = None
+    def _remove_sink_after_error(self, sink, e):
         with self.lock:
-            for sink in list(self.sinks):
-                if sink.consume is consume_callback:
-                    self.sinks.remove(sink)
-                    self._sink_callbacks = [s.consume for s in self.sinks]
-                    break
-        if sink:
-            self.emit('pool.sinkfailed', sink=repr(sink), error=repr(e))
+            if sink not in self.sinks:
+                return
+            self.sinks.remove(sink)
+            self._update_callbacks()
+        self.emit('pool.sinkfailed', sink=repr(sink), error=repr(e))
 
     def _sink_loop(self):
+        buffer = self.buffer
         while True:
-            event = self.queue.get()
-            if event is None:
-                break
-            for consume in self._sink_callbacks:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            while buffer:
+                batch = []
                 try:
-                    consume(event)
-                except Exception as e:
-                    self._remove_sink_after_error(consume, e)
-    
+                    for _ in range(self.batch_size):
+                        batch.append(buffer.popleft())
+                except IndexError:
+                    pass
+                for sink, consume_batch in self._sink_callbacks:
+                    try:
+                        consume_batch(batch)
+                    except Exception as e:
+                        self._remove_sink_after_error(sink, e)
+                self.delivered += len(batch)
+            if self._closed:
+                break
+
     def shutdown(self):
-        self.queue.put(None)
+        ''' Deliver all pending events and stop the background thread. '''
+        self._closed = True
+        self._wakeup.set()
         self.thread.join()
 
 root = EventManager()
 emit = root.emit
-        
-        
+
+
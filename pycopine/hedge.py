@@ -0,0 +1,58 @@
+''' Hedged requests: speculative copies of slow tasks.
+
+    If a task of a command with :attr:`Command.hedge_percentile` set did not
+    complete within that percentile of recent (total) latencies, a copy of the
+    task is submitted. The first successful result completes the original
+    task and all remaining copies are canceled. This cuts tail latency if
+    single backends or replicas stall, at the cost of some extra load::
+
+        class GetProfile(Command):
+            hedge_percentile = 95  # Hedge the slowest 5% of tasks
+            hedge_ratio = .05      # but never more than 5% of all requests
+            def run(self, user_id):
+                ...
+
+    Only use this for idempotent commands.
+'''
+
+from time import monotonic
+
+__all__ = ['Hedger']
+
+
+class Hedger(object):
+    ''' Computes hedge delays and enforces the hedge budget for a single
+        command class, based on its :class:`pycopine.metrics.CommandMetrics`.
+    '''
+
+    def __init__(self, metrics, percentile=95, ratio=.05, min_delay=.001,
+                 update_interval=1):
+        self.metrics = metrics
+        self.percentile = percentile
+        self.ratio = ratio
+        self.min_delay = min_delay
+        #: The delay is re-computed at most once per interval (seconds).
+        self.update_interval = update_interval
+        self.updated = None
+        self.current = None
+
+    def delay(self):
+        ''' Return the number of seconds after which a copy of an unfinished
+            task should be submitted, or None if there are not enough
+            latency samples yet. '''
+        now = monotonic()
+        if self.current is None or now - self.updated >= self.update_interval:
+            snapshot = self.metrics.latency['total'].snapshot()
+            self.current = None
+            if snapshot.count:
+                self.current = max(self.min_delay,
+                                   snapshot.percentile(self.percentile))
+            self.updated = now
+        return self.current
+
+    def allow(self):
+        ''' Return True if the hedge budget allows another copy. Copies never
+            exceed `ratio` times the number of requests in the rolling
+            metrics window. '''
+        requests, errors = self.metrics.health()
+        return self.metrics.count('hedge') < requests * self.ratio
@@ -0,0 +1,152 @@
+''' Adaptive concurrency limits for :class:`pycopine.pool.Pool`.
+
+    A limiter receives a sample for each command executed by a pool and
+    adjusts the number of commands the pool may run concurrently. Assign an
+    instance to a pool to enable adaptive sizing::
+
+        Pool('backend').limiter = AIMDLimit(initial=10, max_limit=100)
+
+    The effective limit never exceeds :attr:`Pool.max_pool_size`.
+
+    The :class:`TokenBucket` limits rates instead of concurrency (e.g. for
+    command retries or :attr:`Command.rate_limit`).
+'''
+
+from time import monotonic
+import math
+import threading
+
+__all__ = ['AIMDLimit', 'GradientLimit', 'TokenBucket']
+
+
+class AIMDLimit(object):
+    ''' Additive increase, multiplicative decrease.
+
+        The limit is multiplied by `backoff` whenever a command fails or
+        its run time exceeds `latency_target` (if set). It is increased by
+        one if commands are waiting in the queue, a command waited longer
+        than `queue_target` seconds for a worker, or at least half of the
+        limit is in use.
+    '''
+
+    def __init__(self, initial=10, min_limit=1, max_limit=200, backoff=.9,
+                 latency_target=None, queue_target=.01):
+        self.value = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.latency_target = latency_target
+        self.queue_target = queue_target
+
+    @property
+    def limit(self):
+        return int(self.value)
+
+    def update(self, run_time, queue_time, in_flight, queued, dropped):
+        ''' Process a sample and return the new limit. '''
+        if dropped or (self.latency_target is not None
+                       and run_time > self.latency_target):
+            self.value = max(self.min_limit, self.value * self.backoff)
+        elif queued or queue_time > self.queue_target \
+        or in_flight * 2 >= self.value:
+            self.value = min(self.max_limit, self.value + 1)
+        return self.limit
+
+
+class GradientLimit(object):
+    ''' Latency gradient (TCP Vegas style) limit.
+
+        The limit follows the ratio between the long term (exponentially
+        smoothed) run time and the current run time: If latency grows, the
+        backend is probably saturated and the limit shrinks. A headroom of
+        sqrt(limit) is added to allow growth while latency is stable.
+
+        The limit is only adjusted while it is in use: At least half of it is
+        busy, commands are waiting in the queue, or a command waited longer
+        than `queue_target` seconds for a worker.
+    '''
+
+    def __init__(self, initial=10, min_limit=1, max_limit=200, smoothing=.2,
+                 long_window=600, queue_target=.01):
+        self.value = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.smoothing = smoothing
+        self.long_window = long_window
+        self.queue_target = queue_target
+        self.long_rtt = None
+
+    @property
+    def limit(self):
+        return int(self.value)
+
+    def update(self, run_time, queue_time, in_flight, queued, dropped):
+        ''' Process a sample and return the new limit. '''
+        if self.long_rtt is None:
+            self.long_rtt = run_time
+        else:
+            self.long_rtt += (run_time - self.long_rtt) / self.long_window
+
+        # Do not grow the limit if it is not used.
+        if in_flight * 2 < self.value and not queued \
+        and queue_time <= self.queue_target:
+            return self.limit
+
+        gradient = 1.0
+        if run_time > 0:
+            gradient = max(.5, min(1.0, self.long_rtt / run_time))
+        if dropped:
+            gradient = .5
+        target = self.value * gradient + math.sqrt(self.value)
+        value = self.value * (1 - self.smoothing) + target * self.smoothing
+        self.value = max(self.min_limit, min(self.max_limit, value))
+        return self.limit
+
+
+class TokenBucket(object):
+    ''' Allow `rate` operations per second on average, and bursts of up to
+        `burst` operations. The bucket starts full. '''
+
+    def __init__(self, rate, burst, clock=monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = burst
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, tokens=1):
+        ''' Take `tokens` tokens from the bucket and return True, or return
+            False (and take nothing) if there are not enough tokens. '''
+        with self.lock:
+            self._refill()
+            if self.tokens < tokens:
+                return False
+            self.tokens -= tokens
+            return True
+
+    def reserve(self, tokens=1, max_wait=None):
+        ''' Take `tokens` tokens from the bucket, even if they are not
+            available yet, and return the number of seconds until they are
+            (0 if they are available right now). Later reservations wait
+            for earlier ones (leaky bucket). If the wait would be longer than
+            `max_wait` seconds, take nothing and return None. '''
+        with self.lock:
+            self._refill()
+            remaining = self.tokens - tokens
+            if remaining >= 0:
+                self.tokens = remaining
+                return 0
+            if not self.rate:
+                return None
+            wait = -remaining / self.rate
+            if max_wait is not None and wait > max_wait:
+                return None
+            self.tokens = remaining
+            return wait
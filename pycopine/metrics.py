@@ -1,62 +1,170 @@
 from collections import deque
-from time import time as now
+from time import monotonic
+import math
+import operator
 import threading
- 
-class HistogramCounter(object):
-    ''' Histogram to measure events over time in a rolling time window.
 
-        Example: If 10 buckets are used to measure a time window of one second,
-            each buckets covers 1/10 seconds (100ms). A new bucket is added and
-            an old one removed every 100ms.
- 
-        This data structure is optimized for fast updates as well as constant
-        and low memory usage. Read performance and memory usage depend on the
-        number of buckets used.        
+
+class RollingWindow(object):
+    ''' Base class for statistics over a rolling time window, divided into a
+        fixed number of buckets.
+
+        Each thread records data for the current bucket in a private cell
+        without locking. Cells are merged into the shared buckets when the
+        thread moves on to the next bucket (once per bucket and thread), and
+        on read. No updates are lost under contention.
+
+        Subclasses define how bucket values are created and combined.
     '''
 
-    def __init__(self, window=1, buckets=10):
+    def __init__(self, window=1, buckets=10, clock=monotonic):
         self.window = window
         self.buckets = buckets
         self.dt = window / buckets
-        self.bucket_list = deque([0]*buckets, maxlen=buckets)
-        self.bucket_value = 0
-        self.bucket_lifetime = now() + self.dt 
+        # Bucket index for a point in time: int(clock() * scale)
+        self.scale = buckets / window
+        self.clock = clock
         self.lock = threading.Lock()
+        self.reset()
 
-    def increment(self, value=1):
-        if now() <= self.bucket_lifetime:
-            self.bucket_value += value
-            return
+    def _empty(self):
+        ''' Return the value of an empty bucket. '''
+        raise NotImplementedError()
+
+    def _combine(self, total, value):
+        ''' Add `value` to `total` and return the result. `total` may be None
+            and may be modified in place. `value` must not be modified. '''
+        raise NotImplementedError()
 
+    def _copy(self, value):
+        return value
+
+    def reset(self):
+        ''' Forget all data recorded so far. '''
+        with self.lock:
+            # Bucket index -> value merged from retired cells
+            self.merged = {}
+            # Thread id -> [bucket index, value] (active cells)
+            self.cells = {}
+            self.local = threading.local()
+
+    def _cell(self):
+        ''' Return the cell of the current thread for the current bucket. '''
+        try:
+            cell = self.local.cell
+        except AttributeError:
+            cell = None
+        index = int(self.clock() * self.scale)
+        if cell is not None and cell[0] == index:
+            return cell
+        return self._replace_cell(cell, index)
+
+    def _replace_cell(self, cell, index):
+        ''' Retire the current cell of this thread and start a new one. '''
+        ident = threading.get_ident()
+        with self.lock:
+            if cell is None:
+                # First update (or a previous thread with the same id died).
+                cell = self.cells.get(ident)
+            if cell is not None:
+                self.merged[cell[0]] = self._combine(self.merged.get(cell[0]),
+                                                     cell[1])
+            self.local.cell = self.cells[ident] = [index, self._empty()]
+            self._prune(index)
+            return self.local.cell
+
+    def _prune(self, index):
+        ''' Drop buckets and idle cells that are older than the window. The
+            caller must hold the lock. '''
+        oldest = index - self.buckets
+        for i in [i for i in self.merged if i < oldest]:
+            del self.merged[i]
+        for ident in [i for i, c in self.cells.items() if c[0] < oldest]:
+            del self.cells[ident]
+
+    def _counts(self):
+        ''' Return the current bucket index and a dict of bucket values. '''
+        index = int(self.clock() * self.scale)
+        with self.lock:
+            self._prune(index)
+            counts = dict((i, self._copy(v)) for i, v in self.merged.items())
+            for i, value in list(self.cells.values()):
+                counts[i] = self._combine(counts.get(i), value)
+        return index, counts
+
+    def _bucket(self, index):
+        ''' Return the value of a single bucket (retired and active cells).
+            The result is a new value and may be modified by the caller. '''
         with self.lock:
-            age = now() - self.bucket_lifetime
-            if age > 0:
-                self.bucket_list.append(self.bucket_value)
-                self.bucket_value = value
-                self.bucket_lifetime += self.dt
-                if age > self.dt:
-                    skipped = int(age / self.dt)
-                    zeros = (0 for _ in range(min(skipped, self.buckets-1)))
-                    self.bucket_list.extend(zeros)
-                    self.bucket_lifetime += skipped * self.dt
+            total = self.merged.get(index)
+            if total is not None:
+                total = self._combine(None, total)
+            for i, value in list(self.cells.values()):
+                if i == index:
+                    total = self._combine(total, value)
+        return self._empty() if total is None else total
 
     def sync(self):
-        ''' Make sure that the histogram is up to date. This is basically 
-            an update that does not change the current bucket. '''
-        self.increment(0)
+        ''' Make sure that the histogram is up to date. This drops buckets
+            that are no longer part of the time window. '''
+        with self.lock:
+            self._prune(int(self.clock() * self.scale))
 
     def freeze(self):
-        ''' Return a synced copy of the counter. This can be used to recieve
-            statistics while the original counter may be updated in a background
-            thread. '''
-        obj = self.__class__(self.window, self.buckets)
-        with self.lock:
-            obj.bucket_list = deque(self.bucket_list, maxlen=self.buckets)
-            obj.bucket_value = self.bucket_value
-            obj.bucket_lifetime = self.bucket_lifetime
-        obj.sync()
+        ''' Return a synced copy. This can be used to recieve statistics while
+            the original may be updated in a background thread. The copy does
+            not change over time. '''
+        t = self.clock()
+        obj = self.__class__(self.window, self.buckets, clock=lambda: t)
+        obj.merged = self._counts()[1]
         return obj
 
+
+class HistogramCounter(RollingWindow):
+    ''' Histogram to measure events over time in a rolling time window.
+
+        Example: If 10 buckets are used to measure a time window of one second,
+            each buckets covers 1/10 seconds (100ms). A new bucket is added and
+            an old one removed every 100ms.
+ 
+        This data structure is optimized for fast updates as well as constant
+        and low memory usage. Read performance and memory usage depend on the
+        number of buckets and the number of threads that update the counter.
+    '''
+
+    def _empty(self):
+        return 0
+
+    def _combine(self, total, value):
+        return (total or 0) + value
+
+    def increment(self, value=1):
+        try:
+            cell = self.local.cell
+        except AttributeError:
+            cell = None
+        index = int(self.clock() * self.scale)
+        if cell is None or cell[0] != index:
+            cell = self._replace_cell(cell, index)
+        # Only the owning thread writes to a cell.
+        cell[1] += value
+
+    def increment_many(self, values):
+        ''' Count a batch of values with a single clock and cell lookup. '''
+        self.increment(sum(values))
+
+    @property
+    def bucket_list(self):
+        ''' List of completed buckets, oldest first. '''
+        index, counts = self._counts()
+        return [counts.get(i, 0) for i in range(index - self.buckets, index)]
+
+    def total(self):
+        ''' Return the number of events during the observed time window plus
+            the events counted in the current (not yet completed) bucket. '''
+        index, counts = self._counts()
+        return sum(v for i, v in counts.items() if i >= index - self.buckets)
+
     def sum(self):
         ''' Return the total number of events during the observed time window.
            (equals: sum(buckets)) '''
@@ -80,7 +188,7 @@ class HistogramCounter(object):
 
     def stdev(self):
         ''' Return the standard deviation '''
-        c = list(self.bucket_list)
+        c = self.bucket_list
         n = len(c)
         sum_x = sum(c)
         sum_x2 = sum(x**2 for x in c)
@@ -94,3 +202,319 @@ class HistogramCounter(object):
         tr = t % 1
         return c[int(t)] * tr + c[int(t+1)] * (1-tr)
 
+
+class RollingMax(RollingWindow):
+    ''' Highest value observed during a rolling time window (e.g. the
+        number of busy workers). '''
+
+    def _empty(self):
+        return 0
+
+    def _combine(self, total, value):
+        return value if total is None else max(total, value)
+
+    def update(self, value):
+        cell = self._cell()
+        if value > cell[1]:
+            cell[1] = value
+
+    def max(self):
+        ''' Return the highest value during the time window, including the
+            current bucket. '''
+        index, counts = self._counts()
+        return max([v for i, v in counts.items() if i >= index - self.buckets]
+                   or [0])
+
+
+class LatencyHistogram(object):
+    ''' Fixed memory histogram of durations (in seconds).
+
+        Values are counted in logarithmic buckets: Each power of two between
+        2**min_exp (about 1 microsecond) and 2**max_exp (about 17 minutes) is
+        divided into `sub_buckets` linear buckets. Percentiles are accurate
+        within 1/(2*sub_buckets) (about 3%). Smaller or larger values are
+        counted in the first or last bucket. Recording a value is O(1).
+    '''
+
+    sub_buckets = 16
+    min_exp = -20
+    max_exp = 10
+
+    def __init__(self):
+        self.counts = [0] * ((self.max_exp - self.min_exp) * self.sub_buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def _index(self, value):
+        m, e = math.frexp(value) # value = m * 2**e with .5 <= m < 1
+        if value <= 0 or e <= self.min_exp:
+            return 0
+        if e > self.max_exp:
+            return len(self.counts) - 1
+        sub = self.sub_buckets
+        return (e - self.min_exp - 1) * sub + int((m - .5) * 2 * sub)
+
+    def _value(self, index):
+        ''' Return the value in the middle of a bucket. '''
+        sub = self.sub_buckets
+        e = index // sub + self.min_exp + 1
+        return math.ldexp(.5 + (index % sub + .5) / (2 * sub), e)
+
+    def record(self, value):
+        # Same as self._index(value), inlined for speed.
+        m, e = math.frexp(value)
+        if value <= 0 or e <= self.min_exp:
+            index = 0
+        elif e > self.max_exp:
+            index = len(self.counts) - 1
+        else:
+            sub = self.sub_buckets
+            index = (e - self.min_exp - 1) * sub + int((m - .5) * 2 * sub)
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        ''' Add all values recorded by `other` to this histogram. '''
+        self.counts[:] = map(operator.add, self.counts, other.counts)
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def subtract(self, other):
+        ''' Remove all values recorded by `other` (which must have been
+            merged before). :attr:`max` is not changed. '''
+        self.counts[:] = map(operator.sub, self.counts, other.counts)
+        self.count -= other.count
+        self.sum -= other.sum
+
+    def copy(self):
+        obj = self.__class__()
+        obj.merge(self)
+        return obj
+
+    def mean(self):
+        return self.sum / self.count if self.count else 0.0
+
+    def percentile(self, p):
+        ''' Return the value below which `p` percent of the values fall. '''
+        if not self.count:
+            return 0.0
+        rank = max(1, math.ceil(self.count * p / 100))
+        last = len(self.counts) - 1
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return self.max if i == last else min(self._value(i), self.max)
+        return self.max
+
+    def percentiles(self, ps=(50, 90, 99, 99.9)):
+        ''' Return a dict that maps percentiles to values. All percentiles
+            are computed in a single pass over the buckets. '''
+        if not self.count:
+            return dict((p, 0.0) for p in ps)
+        ranks = sorted((max(1, math.ceil(self.count * p / 100)), p)
+                       for p in ps)
+        last = len(self.counts) - 1
+        result = {}
+        seen = j = 0
+        for i, n in enumerate(self.counts):
+            if not n:
+                continue
+            seen += n
+            while j < len(ranks) and seen >= ranks[j][0]:
+                result[ranks[j][1]] = self.max if i == last \
+                                      else min(self._value(i), self.max)
+                j += 1
+            if j == len(ranks):
+                break
+        for rank, p in ranks[j:]:
+            result[p] = self.max
+        return result
+
+
+class RollingLatency(RollingWindow):
+    ''' Latency distribution over a rolling time window. Each bucket holds a
+        :class:`LatencyHistogram`. '''
+
+    def _empty(self):
+        return LatencyHistogram()
+
+    def _combine(self, total, value):
+        if total is None:
+            total = LatencyHistogram()
+        total.merge(value)
+        return total
+
+    def _copy(self, value):
+        return value.copy()
+
+    def record(self, value):
+        ''' Record a duration (in seconds). '''
+        try:
+            cell = self.local.cell
+        except AttributeError:
+            cell = None
+        index = int(self.clock() * self.scale)
+        if cell is None or cell[0] != index:
+            cell = self._replace_cell(cell, index)
+        # Only the owning thread writes to a cell.
+        cell[1].record(value)
+
+    def snapshot(self):
+        ''' Return a :class:`LatencyHistogram` with all values recorded
+            during the time window (including the current bucket). '''
+        index, counts = self._counts()
+        result = LatencyHistogram()
+        for i, histogram in counts.items():
+            if i >= index - self.buckets:
+                result.merge(histogram)
+        return result
+
+    def percentiles(self, ps=(50, 90, 99, 99.9)):
+        ''' Return a dict that maps percentiles to durations. '''
+        return self.snapshot().percentiles(ps)
+
+
+class RollingSnapshot(object):
+    ''' Incrementally updated snapshot of a :class:`RollingLatency`.
+
+        Consumers that read the same window over and over (e.g.
+        :mod:`pycopine.stream`) combine each completed bucket once, when it
+        completes, and subtract it again when it drops out of the window.
+        Only the current bucket is combined on every read. '''
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.cells = None
+
+    def _restart(self, index):
+        self.cells = self.latency.cells
+        #: Completed buckets in the window (index, histogram), oldest first
+        self.completed = deque()
+        self.total = LatencyHistogram()
+        #: First bucket index not yet combined
+        self.index = index
+
+    def snapshot(self):
+        ''' Return a :class:`LatencyHistogram` equal to
+            :meth:`RollingLatency.snapshot`. The result must not be modified.
+        '''
+        latency = self.latency
+        index = int(latency.clock() * latency.scale)
+        oldest = index - latency.buckets
+        if self.cells is not latency.cells: # First use or reset()
+            self._restart(oldest)
+        completed, total = self.completed, self.total
+        if completed and completed[0][0] < oldest:
+            while completed and completed[0][0] < oldest:
+                total.subtract(completed.popleft()[1])
+            total.max = max([h.max for i, h in completed] or [0.0])
+        for i in range(max(self.index, oldest), index):
+            histogram = latency._bucket(i)
+            if histogram.count:
+                completed.append((i, histogram))
+                total.merge(histogram)
+        self.index = index
+        current = latency._bucket(index)
+        if not current.count:
+            return total
+        current.merge(total)
+        return current
+
+
+def _new_counter(event, window, buckets):
+    return HistogramCounter(window, buckets)
+
+
+class Metrics(object):
+    ''' Collection of rolling event counters (see :class:`HistogramCounter`)
+        and latency distributions (see :class:`RollingLatency`). '''
+
+    #: Counted events
+    events = ()
+    #: Measured durations
+    latencies = ()
+    #: Values tracked as a rolling maximum
+    maxima = ()
+
+    def __init__(self, window=10, buckets=10, new_counter=None):
+        self.window = window
+        self.buckets = buckets
+        # Callable that returns a counter for an (event, window, buckets)
+        # tuple (see :mod:`pycopine.shared`).
+        new_counter = new_counter or _new_counter
+        self.counters = dict((e, new_counter(e, window, buckets))
+                             for e in self.events)
+        self.latency = dict((name, RollingLatency(window, buckets))
+                            for name in self.latencies)
+        self.maximum = dict((name, RollingMax(window, buckets))
+                            for name in self.maxima)
+        #: Set on every change. Consumers (e.g. :mod:`pycopine.stream`) may
+        #: reset this flag to detect changes since their last visit.
+        self.touched = False
+
+    def increment(self, event, value=1):
+        self.touched = True
+        self.counters[event].increment(value)
+
+    def count(self, event):
+        ''' Return the number of `event` events in the rolling window. '''
+        return self.counters[event].total()
+
+    def record(self, name, duration):
+        self.touched = True
+        self.latency[name].record(duration)
+
+    def update_max(self, name, value):
+        self.maximum[name].update(value)
+
+    def max(self, name):
+        ''' Return the rolling maximum of one of the :attr:`maxima`. '''
+        return self.maximum[name].max()
+
+    def percentiles(self, name, ps=(50, 90, 99, 99.9)):
+        ''' Return percentiles for one of the measured :attr:`latencies`. '''
+        return self.latency[name].percentiles(ps)
+
+    def reset(self):
+        ''' Reset all event counters. Latencies are not affected. '''
+        for counter in self.counters.values():
+            counter.reset()
+
+
+class CommandMetrics(Metrics):
+    ''' Rolling event counters and latencies for a single command class. '''
+
+    events = ('success', 'failure', 'timeout', 'rejected', 'short_circuited',
+              'fallback_success', 'fallback_failure', 'cache_hit', 'retry',
+              'throttled', 'hedge', 'hedge_win', 'collapsed')
+    #: Events that count as errors (e.g. for the circuit breaker).
+    errors = ('failure', 'timeout', 'rejected')
+    #: Time spent in the queue, in run() and in total (submit to completion).
+    #: Tasks that :meth:`Command.result` runs directly (without an executor
+    #: round trip) record no queue time.
+    latencies = ('queue', 'run', 'total')
+
+    def health(self):
+        ''' Return a (requests, errors) tuple for the rolling window. Short
+            circuited requests are not counted. '''
+        errors = sum(self.count(e) for e in self.errors)
+        return self.count('success') + errors, errors
+
+    def error_percentage(self):
+        requests, errors = self.health()
+        return errors * 100 / requests if requests else 0
+
+
+class PoolMetrics(Metrics):
+    ''' Rolling event counters and latencies for a single executor pool. '''
+
+    events = ('executed', 'rejected', 'expired')
+    latencies = ('queue', 'run')
+    #: Number of commands running at the same time
+    maxima = ('active',)
@@ -1,17 +1,33 @@
 import time
 import threading
 import atexit
+import heapq
+import itertools
+from . import events
+from . import metrics
+
+__all__ = ['Pool', 'SemaphorePool', 'PoolClosedError', 'QueueFullError']
+
+class PoolClosedError(RuntimeError): pass
+class QueueFullError(RuntimeError): pass
+
+_thread_ids = itertools.count(1)
+
+def _thread_factory(target, name):
+    thread = threading.Thread(target=target, name=name)
+    thread.daemon = True
+    return thread
 
-__all__ = ['Pool']
 
 class Pool(object):
     __instances = dict()
 
     def __new__(cls, name='default'):
-        if name not in cls.__instances:
-            obj = super(cls, cls).__new__(cls)
-            cls.__instances[name] = obj
-        return cls.__instances[name]
+        key = cls, name
+        if key not in cls.__instances:
+            obj = super(Pool, cls).__new__(cls)
+            cls.__instances[key] = obj
+        return cls.__instances[key]
 
     #: Maximum number of commands in queue
     max_queue_size = 10
@@ -19,16 +35,49 @@ class Pool(object):
     max_pool_size = 10
     #: Idle worker threads are terminated after this timeout.
     max_worker_idle = 60
+    #: Number of worker threads kept alive even if idle (see
+    #: :meth:`prestart`). Ignored if the pool uses a :attr:`budget`.
+    core_pool_size = 0
+    #: Callable that returns a new (not started) daemon thread for a given
+    #: `target` and `name`. May be set on a subclass (it is not bound to the
+    #: pool, as with a staticmethod) or on a pool instance.
+    thread_factory = None
+    #: Adaptive concurrency limiter (see :mod:`pycopine.limits`). If set, the
+    #: number of concurrently running commands follows the limit computed by
+    #: the limiter, but never exceeds max_pool_size.
+    limiter = None
+    #: If more than this many commands are waiting, the most recently queued
+    #: command runs first (ignoring priorities), because its caller is the
+    #: least likely to have given up already. None disables LIFO scheduling.
+    lifo_threshold = None
+    #: Shared :class:`pycopine.budget.WorkerBudget`. If set, commands are
+    #: executed by the workers of the budget and the pool does not start
+    #: threads of its own.
+    budget = None
+    #: Number of workers the budget guarantees to this pool.
+    min_pool_size = 0
 
     def __init__(self, name='default'):
         if 'name' in self.__dict__:
             return
         self.name = name
         self._shutdown = False
-        self.queue    = []
-        self.running  = []
+        # Queued commands are kept in a heap of [priority, deadline, seq,
+        # command, enqueue time] entries. Lower priorities and earlier
+        # deadlines run first, commands with equal priority and without
+        # deadlines run in FIFO order. The queue dict maps commands to their
+        # (live) heap entry in insertion order. Removed commands are left in
+        # the heap and skipped when popped.
+        self.queue    = {}
+        self.heap     = []
+        self.seq      = itertools.count()
+        self.running  = set()
         self.threads  = []
+        self.idle     = 0 # Number of workers waiting for commands
+        self.metrics  = metrics.PoolMetrics()
         self.cond = threading.Condition(threading.Lock())
+        if self.budget is not None:
+            self.budget.register(self)
         atexit.register(self.shutdown)
 
     def get_queue_size(self):
@@ -39,44 +88,229 @@ class Pool(object):
         ''' Return the number of available slots in the pool queue '''
         return self.max_queue_size - len(self.queue)
 
+    def get_active_count(self):
+        ''' Return the number of jobs currently running. '''
+        return len(self.running)
+
+    def get_pool_limit(self):
+        ''' Return the current maximum number of jobs running concurrently. '''
+        if self.limiter is None:
+            return self.max_pool_size
+        return max(1, min(self.max_pool_size, self.limiter.limit))
+
     def dequeue(self, command):
+        ''' Remove a command from the queue. Return True if the command was
+            still waiting in the queue, False otherwise. '''
         with self.cond:
             if command in self.queue:
-                self.queue.remove(command)
-    
+                del self.queue[command]
+                self._compact()
+                return True
+            return False
+
     def enqueue(self, command):
         with self.cond:
             if self._shutdown:
-                raise RuntimeError('Pool is closed')
+                raise PoolClosedError('Pool is closed')
             if len(self.queue) >= self.max_queue_size:
-                raise RuntimeError('Queue full')
-            self.queue.append(command)
-            if len(self.threads) < self.max_pool_size:
-                thread = threading.Thread(target=self._run_loop)
-                thread.daemon = True
-                self.threads.append(thread)
-                thread.start()
-            self.cond.notify()
+                self.metrics.increment('rejected')
+                raise QueueFullError('Queue full')
+            self._push(command, time.monotonic())
+            if self.budget is None:
+                self._spawn_ahead()
+                self.cond.notify()
+        if self.budget is not None:
+            self.budget.wakeup(self)
+
+    def enqueue_many(self, commands):
+        ''' Enqueue multiple commands with a single lock acquisition. Return a
+            list of commands that did not fit into the queue. '''
+        commands = list(commands)
+        with self.cond:
+            if self._shutdown:
+                raise PoolClosedError('Pool is closed')
+            space = max(0, self.max_queue_size - len(self.queue))
+            accepted, rejected = commands[:space], commands[space:]
+            now = time.monotonic()
+            for command in accepted:
+                self._push(command, now)
+            if rejected:
+                self.metrics.increment('rejected', len(rejected))
+            if self.budget is None:
+                self._spawn_ahead()
+                self.cond.notify(len(accepted))
+        if self.budget is not None and accepted:
+            self.budget.wakeup(self, len(accepted))
+        return rejected
+
+    def _push(self, command, now):
+        ''' Add a command to the queue. The caller must hold the lock. '''
+        deadline = getattr(command, '_deadline', None)
+        deadline = deadline() if deadline else None
+        entry = [getattr(command, 'priority', 0),
+                 float('inf') if deadline is None else deadline,
+                 next(self.seq), command, now]
+        self.queue[command] = entry
+        heapq.heappush(self.heap, entry)
+
+    def _pop(self, now, expired):
+        ''' Remove the next command from the queue and return a (command,
+            enqueue time) tuple, or (None, None) if the queue is empty.
+            Commands with a deadline before `now` are removed and appended to
+            `expired` instead. The caller must hold the lock. '''
+        queue = self.queue
+        while queue:
+            if self.lifo_threshold is not None \
+            and len(queue) > self.lifo_threshold:
+                command = next(reversed(queue))
+                entry = queue.pop(command)
+            else:
+                entry = heapq.heappop(self.heap)
+                command = entry[3]
+                if queue.get(command) is not entry:
+                    continue # Removed or re-queued
+                del queue[command]
+            if entry[1] <= now:
+                expired.append(command)
+                continue
+            self._compact()
+            return command, entry[4]
+        self._compact()
+        return None, None
+
+    def _compact(self):
+        ''' Drop removed entries from the heap if they dominate it. '''
+        if not self.queue:
+            del self.heap[:]
+        elif len(self.heap) > 2 * len(self.queue) + 64:
+            self.heap = [e for e in self.heap if self.queue.get(e[3]) is e]
+            heapq.heapify(self.heap)
+
+    def prestart(self, count=None):
+        ''' Start `count` worker threads (default: :attr:`core_pool_size`)
+            ahead of time, so that the first commands do not have to wait for
+            new threads. Return the number of started threads.
+
+            Pools with a :attr:`budget` do not start threads of their own,
+            so this does nothing and returns 0. '''
+        if self.budget is not None:
+            return 0
+        if count is None:
+            count = self.core_pool_size
+        with self.cond:
+            count = min(count, self.get_pool_limit()) - len(self.threads)
+            for _ in range(count):
+                self._spawn()
+        return max(0, count)
+
+    def _spawn_ahead(self):
+        ''' Start workers for all queued commands that no idle worker will
+            pick up, plus one spare worker for the next command. The caller
+            must hold the lock. '''
+        missing = len(self.queue) - self.idle + 1
+        missing = min(missing, self.get_pool_limit() - len(self.threads))
+        for _ in range(missing):
+            self._spawn()
+
+    def _spawn(self):
+        ''' Start a new worker thread. The caller must hold the lock. '''
+        name = 'pycopine-%s-%d' % (self.name, next(_thread_ids))
+        factory = self.__dict__.get('thread_factory',
+                                    type(self).thread_factory)
+        factory = factory or _thread_factory
+        thread = factory(target=self._run_loop, name=name)
+        self.threads.append(thread)
+        thread.start()
+
+    def _update_limit(self, command, queue_time, run_time):
+        ''' Feed a sample to the limiter. The caller must hold the lock. '''
+        is_failure = getattr(command, 'is_failure', None)
+        old = self.get_pool_limit()
+        self.limiter.update(run_time, queue_time, len(self.running) + 1,
+                            len(self.queue), bool(is_failure and is_failure()))
+        new = self.get_pool_limit()
+        if new == old:
+            return
+        if self.budget is None:
+            for _ in range(min(new - len(self.threads), len(self.queue))):
+                self._spawn()
+        events.emit('pool.limit', pool=self.name, old=old, limit=new,
+                    run_time=run_time, queue_time=queue_time)
+
+    def _release(self, command, queue_time, run_time):
+        ''' Mark a command as finished. The caller must hold the lock. '''
+        self.running.discard(command)
+        if self.limiter is not None:
+            self._update_limit(command, queue_time, run_time)
 
     def _run_loop(self):
         current_thread = threading.current_thread()
+        command = None
+        expired = []
         try:
             while True:
                 with self.cond:
+                    if command is not None:
+                        self._release(command, queue_time, run_time)
+                        command = None
                     if self._shutdown:
                         break
+                    # Terminate surplus workers if the limit was lowered.
+                    if len(self.threads) > self.get_pool_limit():
+                        self.threads.remove(current_thread)
+                        break
                     if not self.queue:
-                        self.cond.wait(self.max_worker_idle)
+                        core = len(self.threads) <= self.core_pool_size
+                        self.idle += 1
+                        woken = self.cond.wait(
+                            None if core else self.max_worker_idle)
+                        self.idle -= 1
+                        if not self.queue:
+                            # Another worker was faster. Wait again.
+                            if core or woken \
+                            or len(self.threads) <= self.core_pool_size:
+                                continue
+                            self.threads.remove(current_thread)
+                            break
                     if self._shutdown or not self.queue:
                         break
-                    command = self.queue.pop(0)
-                try:
-                    self.running.append(command)
-                    command._run()
-                finally:
-                    self.running.remove(command)
+                    command, queued = self._pop(time.monotonic(), expired)
+                    if command is not None:
+                        self.running.add(command)
+                        active = len(self.running)
+
+                if expired:
+                    self._expire(expired)
+                    del expired[:]
+                if command is None:
+                    continue
+
+                self.metrics.update_max('active', active)
+                start = time.monotonic()
+                queue_time = start - queued
+                self._execute(command)
+                run_time = time.monotonic() - start
+                self.metrics.increment('executed')
+                self.metrics.record('queue', queue_time)
+                self.metrics.record('run', run_time)
         finally:
-            self.threads.remove(current_thread)
+            with self.cond:
+                self.running.discard(command)
+                if current_thread in self.threads:
+                    self.threads.remove(current_thread)
+
+    def _expire(self, commands):
+        ''' Fail commands that missed their deadline while waiting in the
+            queue. '''
+        self.metrics.increment('expired', len(commands))
+        for command in commands:
+            expire = getattr(command, '_expire', None)
+            if expire:
+                expire()
+
+    def _execute(self, command):
+        ''' Run a command in the current worker thread. '''
+        command._run()
 
     def shutdown(self, block=True):
         with self.cond:
@@ -87,3 +321,97 @@ class Pool(object):
                 t.join()
 
 
+class SemaphorePool(object):
+    ''' Executor that runs commands in the thread that submits them, without
+        a queue or a thread hand-off. At most `max_pool_size` commands run at
+        the same time. Additional commands are rejected (and fall back)
+        immediately.
+
+        This avoids the thread hand-off and is suited for fast local calls
+        that only need concurrency limiting and fallbacks. The per-call
+        overhead is roughly a third of that of a thread pool (see
+        ``bench_isolation`` in :mod:`pycopine.bench`), but not negligible:
+        Each task still updates the command metrics (latencies and event
+        counters) the circuit breaker and the metrics stream rely on. The
+        pool itself only counts executed and rejected commands and the
+        rolling maximum of active commands, run latencies are recorded per
+        command. Note that :meth:`Command.submit` blocks until the command
+        completes and a timeout passed to :meth:`Command.result` has no
+        effect.
+
+        Register the pool with a command group to use it::
+
+            CommandGroup().add_executor(SemaphorePool('inline'))
+    '''
+    __instances = dict()
+
+    def __new__(cls, name='semaphore'):
+        key = cls, name
+        if key not in cls.__instances:
+            obj = super(SemaphorePool, cls).__new__(cls)
+            cls.__instances[key] = obj
+        return cls.__instances[key]
+
+    #: Always 0. Commands are never queued.
+    max_queue_size = 0
+    #: Maximum number of commands running at the same time
+    max_pool_size = 10
+
+    def __init__(self, name='semaphore'):
+        if 'name' in self.__dict__:
+            return
+        self.name = name
+        self._shutdown = False
+        self.active = 0
+        self.metrics = metrics.PoolMetrics()
+        self.lock = threading.Lock()
+
+    def get_queue_size(self):
+        ''' Return the number of jobs waiting in the queue (always 0). '''
+        return 0
+
+    def get_queue_space(self):
+        ''' Return the number of commands that could start right now. '''
+        return self.max_pool_size - self.active
+
+    def get_active_count(self):
+        ''' Return the number of jobs currently running. '''
+        return self.active
+
+    def enqueue(self, command):
+        if not self._acquire():
+            if self._shutdown:
+                raise PoolClosedError('Pool is closed')
+            self.metrics.increment('rejected')
+            raise QueueFullError('Concurrency limit reached')
+        try:
+            command._run()
+        finally:
+            self._release()
+
+    def _acquire(self):
+        ''' Take a slot for a command that runs in the current thread. Return
+            False if the pool is full or closed. '''
+        with self.lock:
+            if self._shutdown or self.active >= self.max_pool_size:
+                return False
+            self.active += 1
+            active = self.active
+        self.metrics.update_max('active', active)
+        return True
+
+    def _release(self, executed=True):
+        ''' Give back a slot taken with :meth:`_acquire`. '''
+        with self.lock:
+            self.active -= 1
+        if executed:
+            self.metrics.increment('executed')
+
+    def dequeue(self, command):
+        ''' Commands are never queued. Always return False. '''
+        return False
+
+    def shutdown(self, block=True):
+        ''' Reject new commands. Running commands are not affected. '''
+        with self.lock:
+            self._shutdown = True
@@ -0,0 +1,187 @@
+''' Executor that runs commands in worker processes.
+
+    Use this for CPU bound commands or commands that hold the GIL. Each
+    command runs in a separate process, so commands scale across cores and
+    stuck commands can be terminated::
+
+        class Render(Command):
+            pool = 'procs'
+            timeout = 10
+            def run(self, document):
+                ...
+
+    A pool named 'procs' is registered with every command group. Commands
+    must be defined at module level, because worker processes import them by
+    name. Arguments, results and exceptions must be picklable.
+'''
+
+import asyncio
+import importlib
+import multiprocessing
+import os
+import pickle
+
+from . import pool
+from . import command as _command
+
+__all__ = ['ProcessPool', 'WorkerError']
+
+
+class WorkerError(RuntimeError):
+    ''' A worker process died or a result could not be transferred. '''
+
+
+def _locate(module, qualname):
+    obj = importlib.import_module(module)
+    for name in qualname.split('.'):
+        obj = getattr(obj, name)
+    return obj
+
+
+def _worker_main(conn):
+    ''' Main loop of a worker process. Receive (module, qualname, args,
+        kwargs) jobs and reply with (True, result) or (False, exception). '''
+    while True:
+        try:
+            job = conn.recv_bytes()
+        except (EOFError, OSError):
+            break
+        try:
+            module, qualname, a, ka = pickle.loads(job)
+            task = _locate(module, qualname)(*a, **ka)
+            result = task.run(*a, **ka)
+            if asyncio.iscoroutine(result):
+                result = asyncio.run(result)
+            reply = True, result
+        except Exception as e:
+            reply = False, e
+        try:
+            data = pickle.dumps(reply, pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            error = WorkerError('Result could not be pickled: %r' % e)
+            data = pickle.dumps((False, error), pickle.HIGHEST_PROTOCOL)
+        conn.send_bytes(data)
+
+
+class _Worker(object):
+    ''' A worker process and the parent end of its pipe. '''
+
+    def __init__(self, context):
+        self.conn, child = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child,))
+        self.process.daemon = True
+        self.process.start()
+        child.close()
+
+    def close(self):
+        ''' Ask the worker to exit (by closing the pipe). '''
+        self.conn.close()
+        self.process.join(1)
+        if self.process.is_alive():
+            self.kill()
+
+    def kill(self):
+        self.process.terminate()
+        self.process.join(1)
+        self.conn.close()
+
+
+class ProcessPool(pool.Pool):
+    ''' Thread pool that hands commands over to worker processes. Each worker
+        thread uses one process at a time. Processes are reused for many
+        commands and only replaced if they die, time out or the task is
+        canceled while running.
+    '''
+
+    def __new__(cls, name='procs'):
+        return pool.Pool.__new__(cls, name)
+
+    #: Maximum number of commands (and processes) running at the same time
+    max_pool_size = os.cpu_count() or 1
+    #: Start method for worker processes ('fork', 'spawn' or 'forkserver').
+    #: Workers are started from pool threads while other threads (timers,
+    #: event delivery, other pools) are running, so the default avoids 'fork'.
+    #: None uses the platform default.
+    start_method = ('forkserver' if 'forkserver'
+                    in multiprocessing.get_all_start_methods() else 'spawn')
+    #: Seconds between checks whether a running task was canceled or timed
+    #: out. Stuck workers are terminated within this interval.
+    poll_interval = .05
+    #: Collapsed commands (see :attr:`Command.collapse_window`) are not
+    #: supported. Batches are run by the collapser, not by a worker process.
+    supports_batches = False
+
+    def __init__(self, name='procs'):
+        if 'name' in self.__dict__:
+            return
+        pool.Pool.__init__(self, name)
+        self.workers = [] # Idle worker processes
+
+    def _execute(self, command):
+        if not command._start():
+            return
+        result, error = self._call(command)
+        if error is not None:
+            command.logger.error("Command failed in worker process: %r",
+                                 error)
+        command._finish(result, error)
+
+    def _call(self, command):
+        ''' Run a command in a worker process. Return a (result, exception)
+            tuple. '''
+        cls = type(command)
+        if '<locals>' in cls.__qualname__:
+            return None, _command.CommandSetupError(
+                'Commands executed in worker processes must be defined at '
+                'module level.')
+        a, ka = command.arguments
+        try:
+            job = pickle.dumps((cls.__module__, cls.__qualname__, a, ka),
+                               pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            return None, e
+
+        worker = self._checkout()
+        try:
+            worker.conn.send_bytes(job)
+            while not worker.conn.poll(self.poll_interval):
+                if command.is_completed():
+                    # Canceled or timed out (see Command.timeout)
+                    worker.kill()
+                    return None, _command.CommandCancelledError()
+            data = worker.conn.recv_bytes()
+        except (EOFError, OSError) as e:
+            worker.kill()
+            return None, WorkerError('Worker process died: %r' % e)
+
+        self._checkin(worker)
+        try:
+            ok, value = pickle.loads(data)
+        except Exception as e:
+            return None, WorkerError('Result could not be unpickled: %r' % e)
+        return (value, None) if ok else (None, value)
+
+    def _get_context(self):
+        return multiprocessing.get_context(self.start_method)
+
+    def _checkout(self):
+        with self.cond:
+            if self.workers:
+                return self.workers.pop()
+        return _Worker(self._get_context())
+
+    def _checkin(self, worker):
+        with self.cond:
+            if not self._shutdown:
+                self.workers.append(worker)
+                return
+        worker.close()
+
+    def shutdown(self, block=True):
+        ''' Reject new commands and stop all idle worker processes. Busy
+            processes are stopped as soon as their command completes. '''
+        pool.Pool.shutdown(self, block)
+        with self.cond:
+            workers, self.workers = self.workers, []
+        for worker in workers:
+            worker.close()
@@ -0,0 +1,469 @@
+''' Command metrics and circuit state shared between processes.
+
+    Pre-forked servers run many worker processes per host. By default each
+    process keeps its own metrics and circuit breakers, so each process has
+    to discover a failing dependency on its own. With a :class:`SharedState`,
+    event counters and circuit states are kept in a memory mapped file and
+    aggregated over all processes on the host::
+
+        Command.shared_state = SharedState('/dev/shm/myapp.pycopine')
+
+    Set this before any commands are defined (e.g. at import time, before
+    forking). Processes that use the same file share state. Latency
+    histograms stay local to each process.
+
+    Each command uses one slot for its circuit, and one slot for each type of
+    event that actually occurred. Each thread writes to its own row of
+    counters, so increments do not need any locking. Readers sum up the rows
+    of all threads, including threads and processes that have already
+    exited. A file lock is only used to allocate slots and rows and to change
+    circuit states. POSIX only.
+'''
+
+from time import monotonic, time as now
+import fcntl
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import threading
+import weakref
+
+from . import circuit
+from . import metrics
+from .circuit import CLOSED, OPEN, HALF_OPEN
+
+__all__ = ['SharedState', 'SharedCounter', 'SharedCircuitBreaker',
+           'SharedStateError']
+
+log = logging.getLogger(__name__)
+
+
+class SharedStateError(RuntimeError):
+    ''' The shared state file is full or has an incompatible layout. '''
+
+
+_MAGIC = b'PYCOPIN2'
+# magic, max_threads, max_slots, ring size, number of allocated slots
+_HEADER = struct.Struct('8sqqqq')
+# Index of the number of allocated slots (in SharedState.q)
+_ALLOCATED = 4
+# Row owner of a row that was released by its thread
+_RELEASED = -1
+# key digest, generation, circuit state, circuit opened (wall clock time)
+_SLOT = struct.Struct('20s4xqqd')
+_PID = struct.Struct('q')
+# bucket index, generation, count
+_ENTRY = struct.Struct('qqq')
+
+_STATES = (CLOSED, OPEN, HALF_OPEN)
+
+
+class SharedState(object):
+    ''' A memory mapped file with room for `max_slots` counters and circuits
+        and `max_threads` concurrently counting threads (of all processes).
+        Rolling windows may have up to `ring - 1` buckets. '''
+
+    #: Seconds a thread without a row waits before it looks for a free row
+    #: again (see :meth:`get_row`).
+    row_retry = 1
+
+    def __init__(self, path, max_threads=128, max_slots=512, ring=16):
+        self.path = path
+        self.max_threads = max_threads
+        self.max_slots = max_slots
+        self.ring = ring
+        self.slots_offset = 64
+        self.owners_offset = self.slots_offset + max_slots * _SLOT.size
+        self.rows_offset = self.owners_offset + max_threads * _PID.size
+        self.row_size = max_slots * ring * _ENTRY.size
+        size = self.rows_offset + max_threads * self.row_size
+
+        self.lock = threading.Lock()
+        self.fd = self._open()
+        with self._locked():
+            if os.fstat(self.fd).st_size == 0:
+                os.ftruncate(self.fd, size)
+                os.pwrite(self.fd, _HEADER.pack(_MAGIC, max_threads,
+                                                max_slots, ring, 0), 0)
+            self.mm = mmap.mmap(self.fd, 0)
+            header = _HEADER.unpack_from(self.mm, 0)
+            if header[:4] != (_MAGIC, max_threads, max_slots, ring) \
+            or len(self.mm) != size:
+                raise SharedStateError('Incompatible shared state file: %r'
+                                       % path)
+        # The file as an array of 64 bit integers. Counters are accessed
+        # by index (all offsets are multiples of 8).
+        self.q = memoryview(self.mm).cast('q')
+
+        self.slots = {} # Key -> slot number
+        self.local = threading.local() # Row of the current thread
+        self.full = False # True after the first thread found no free row
+        _instances.add(self)
+
+    def _open(self):
+        return os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+
+    def _locked(self):
+        ''' Context manager that holds the file lock (for all threads of all
+            processes). Not reentrant. '''
+        return _FileLock(self)
+
+    def _after_fork(self):
+        # File locks belong to the open file, which is shared with the
+        # parent process after a fork. Re-open it to get a lock of our own.
+        os.close(self.fd)
+        self.fd = self._open()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def slot(self, key):
+        ''' Return the slot number for a key (a tuple of strings). Allocate a
+            new slot if no process did so yet. '''
+        slot = self.find(key)
+        if slot is not None:
+            return slot
+        digest = _digest(key)
+        with self._locked():
+            allocated = self.q[_ALLOCATED]
+            for slot in range(allocated):
+                if self._digest_at(slot) == digest:
+                    break
+            else:
+                if allocated >= self.max_slots:
+                    raise SharedStateError('No free slots in %r' % self.path)
+                slot = allocated
+                _SLOT.pack_into(self.mm, self._slot_offset(slot),
+                                digest, 0, 0, 0.0)
+                self.q[_ALLOCATED] = allocated + 1
+        self.slots[key] = slot
+        return slot
+
+    def find(self, key):
+        ''' Return the slot number for a key, or None if no slot was
+            allocated for it yet. '''
+        slot = self.slots.get(key)
+        if slot is not None:
+            return slot
+        digest = _digest(key)
+        for slot in range(self.q[_ALLOCATED]):
+            if self._digest_at(slot) == digest:
+                self.slots[key] = slot
+                return slot
+        return None
+
+    def allocated(self):
+        ''' Return the number of allocated slots. '''
+        return self.q[_ALLOCATED]
+
+    def _digest_at(self, slot):
+        return _SLOT.unpack_from(self.mm, self._slot_offset(slot))[0]
+
+    def _slot_offset(self, slot):
+        return self.slots_offset + slot * _SLOT.size
+
+    def get_row(self):
+        ''' Return the index (in :attr:`q`) of the counter row of the
+            current thread. Rows of threads or processes that are no longer
+            running are reused. Return None if all rows are in use: The
+            thread then counts in process local memory (a warning is logged
+            once) and looks for a free row again after :attr:`row_retry`
+            seconds. '''
+        local = self.local
+        row = getattr(local, 'row', None)
+        if row is not None or monotonic() < getattr(local, 'retry', 0):
+            return row
+        pid = os.getpid()
+        with self._locked():
+            for i in range(self.max_threads):
+                offset = self.owners_offset + i * _PID.size
+                owner = _PID.unpack_from(self.mm, offset)[0]
+                if owner == 0 or owner == _RELEASED \
+                or (owner != pid and not _is_alive(owner)):
+                    _PID.pack_into(self.mm, offset, pid)
+                    break
+            else:
+                offset = None
+        if offset is None:
+            if not self.full:
+                self.full = True
+                log.warning('No free rows in %r (max_threads=%d), counting '
+                            'locally.', self.path, self.max_threads)
+            local.row = None
+            local.retry = monotonic() + self.row_retry
+            return None
+        # Released as soon as the thread exits and the local is cleared.
+        local.owner = _RowOwner(self.mm, offset, pid)
+        local.row = (self.rows_offset + i * self.row_size) // 8
+        return local.row
+
+    def rows(self):
+        ''' Return the indices (in :attr:`q`) of all rows that were ever
+            used. '''
+        rows = []
+        for i in range(self.max_threads):
+            if _PID.unpack_from(self.mm, self.owners_offset + i * _PID.size)[0]:
+                rows.append((self.rows_offset + i * self.row_size) // 8)
+        return rows
+
+    def command_metrics(self, key, window=10, buckets=10):
+        ''' Return a :class:`pycopine.metrics.CommandMetrics` instance with
+            shared event counters. '''
+        def new_counter(event, window, buckets):
+            return SharedCounter(self, key + (event,), window, buckets)
+        return metrics.CommandMetrics(window, buckets, new_counter)
+
+    def circuit_breaker(self, key, metrics, **options):
+        ''' Return a :class:`SharedCircuitBreaker` for a command. '''
+        return SharedCircuitBreaker(self, key + ('circuit',), metrics,
+                                    **options)
+
+    def close(self):
+        _instances.discard(self)
+        self.local = threading.local()
+        self.q.release()
+        self.mm.close()
+        os.close(self.fd)
+
+
+#: Open SharedState instances (see _after_fork())
+_instances = weakref.WeakSet()
+
+def _after_fork():
+    for shared in list(_instances):
+        shared._after_fork()
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+class _FileLock(object):
+    def __init__(self, shared):
+        self.shared = shared
+
+    def __enter__(self):
+        # File locks do not exclude threads of the same process.
+        self.lock = self.shared.lock
+        self.lock.acquire()
+        self.fd = self.shared.fd
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+
+    def __exit__(self, *exc):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.lock.release()
+
+
+class _RowOwner(object):
+    ''' Kept in a thread local. Releases the row of a thread when the thread
+        exits. The counts in the row are kept. '''
+
+    def __init__(self, mm, offset, pid):
+        self.mm = mm
+        self.offset = offset
+        self.pid = pid
+
+    def __del__(self):
+        # Thread locals of a parent process are cleared after a fork, but
+        # the rows are still in use by the parent.
+        if os.getpid() == self.pid and not self.mm.closed:
+            _PID.pack_into(self.mm, self.offset, _RELEASED)
+
+
+def _digest(key):
+    return hashlib.sha1('\0'.join(key).encode('utf8')).digest()
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class SharedCounter(metrics.HistogramCounter):
+    ''' A :class:`pycopine.metrics.HistogramCounter` that counts events of
+        all processes using the same :class:`SharedState`.
+
+        The slot for the counter is allocated on the first increment. If
+        there is no free slot left, the counter only counts the events of the
+        current process (and logs a warning). '''
+
+    def __init__(self, shared, key, window=1, buckets=10, clock=monotonic):
+        if buckets >= shared.ring:
+            raise SharedStateError('Too many buckets for shared counters.')
+        self.window = window
+        self.buckets = buckets
+        self.dt = window / buckets
+        self.scale = buckets / window
+        self.clock = clock
+        self.lock = threading.Lock()
+        metrics.RollingWindow.reset(self) # Local fallback
+        self.shared = shared
+        self.key = key
+        self.ring = shared.ring
+        # Index of the first entry in each row, None if not allocated (yet)
+        self.entries = None
+        self.generation = None
+        # Number of allocated slots at the last failed find()
+        self.checked = None
+        self.full = False
+        self._find()
+
+    def _use(self, slot):
+        self.generation = (self.shared._slot_offset(slot) + 24) // 8
+        self.entries = slot * self.ring * 3
+
+    def _find(self):
+        ''' Look for a slot allocated by any process. Return True if found. '''
+        if self.entries is not None:
+            return True
+        allocated = self.shared.allocated()
+        if allocated != self.checked:
+            slot = self.shared.find(self.key)
+            if slot is not None:
+                self._use(slot)
+                return True
+            self.checked = allocated
+        return False
+
+    def _allocate(self):
+        ''' Allocate a slot. Return False if the file is full. '''
+        if self.full:
+            return False
+        try:
+            self._use(self.shared.slot(self.key))
+        except SharedStateError:
+            self.full = True
+            log.warning('No free slots in %r, counting %r locally.',
+                        self.shared.path, self.key)
+            return False
+        return True
+
+    def increment(self, value=1):
+        entries = self.entries
+        if entries is None:
+            if not self._allocate():
+                return metrics.HistogramCounter.increment(self, value)
+            entries = self.entries
+        shared = self.shared
+        try:
+            row = shared.local.row
+        except AttributeError:
+            row = None
+        if row is None:
+            row = shared.get_row()
+            if row is None:
+                return metrics.HistogramCounter.increment(self, value)
+        q = shared.q
+        index = int(self.clock() * self.scale)
+        generation = q[self.generation]
+        # Only the owning thread writes to a row.
+        i = row + entries + index % self.ring * 3
+        if q[i] == index and q[i + 1] == generation:
+            q[i + 2] += value
+        else:
+            q[i + 1] = generation
+            q[i + 2] = value
+            q[i] = index
+
+    def _counts(self):
+        if not self._find():
+            return metrics.HistogramCounter._counts(self)
+        shared = self.shared
+        q = shared.q
+        size = self.ring * 3
+        index = int(self.clock() * self.scale)
+        oldest = index - self.buckets
+        generation = q[self.generation]
+        # Threads without a row count locally (see SharedState.get_row())
+        counts = metrics.HistogramCounter._counts(self)[1]
+        for row in shared.rows():
+            start = row + self.entries
+            entries = q[start:start + size].tolist()
+            for j in range(0, size, 3):
+                i, g, count = entries[j:j + 3]
+                if g == generation and oldest <= i <= index and count:
+                    counts[i] = counts.get(i, 0) + count
+        return index, counts
+
+    def reset(self):
+        ''' Forget all data recorded so far (in all processes). '''
+        metrics.RollingWindow.reset(self)
+        if not self._find():
+            return
+        shared = self.shared
+        with shared._locked():
+            shared.q[self.generation] += 1
+
+    def sync(self):
+        pass
+
+    def freeze(self):
+        t = self.clock()
+        obj = metrics.HistogramCounter(self.window, self.buckets,
+                                       clock=lambda: t)
+        obj.merged = self._counts()[1]
+        return obj
+
+
+class SharedCircuitBreaker(circuit.CircuitBreaker):
+    ''' A :class:`pycopine.circuit.CircuitBreaker` with its state shared by
+        all processes using the same :class:`SharedState`. If the circuit
+        trips in one process, it is open in all processes, and only a single
+        process sends a probe request. '''
+
+    def __init__(self, shared, key, metrics, threshold=50, volume=20,
+                 sleep_window=5, enabled=True):
+        self.metrics = metrics
+        self.threshold = threshold
+        self.volume = volume
+        self.sleep_window = sleep_window
+        self.enabled = enabled
+        self.shared = shared
+        self.offset = shared._slot_offset(shared.slot(key)) + 32
+
+    @property
+    def state(self):
+        return _STATES[struct.unpack_from('q', self.shared.mm, self.offset)[0]]
+
+    @state.setter
+    def state(self, state):
+        struct.pack_into('q', self.shared.mm, self.offset,
+                         _STATES.index(state))
+
+    @property
+    def opened(self):
+        return struct.unpack_from('d', self.shared.mm, self.offset + 8)[0]
+
+    @opened.setter
+    def opened(self, opened):
+        struct.pack_into('d', self.shared.mm, self.offset + 8, opened)
+
+    def allow_request(self):
+        if self.state == CLOSED:
+            return True
+        if now() >= self.opened + self.sleep_window:
+            with self.shared._locked():
+                if self.state != CLOSED \
+                and now() >= self.opened + self.sleep_window:
+                    self.state = HALF_OPEN
+                    self.opened = now()
+                    return True
+        return False
+
+    def trip(self):
+        with self.shared._locked():
+            self.state = OPEN
+            self.opened = now()
+
+    def close(self):
+        if self.state != HALF_OPEN:
+            return
+        # Resetting the counters takes the file lock as well.
+        self.metrics.reset()
+        with self.shared._locked():
+            if self.state == HALF_OPEN:
+                self.state = CLOSED
@@ -0,0 +1,269 @@
+''' Live metrics in the format of the Hystrix event stream.
+
+    Start a local server and point a Hystrix dashboard (or Turbine) to
+    ``http://127.0.0.1:8081/hystrix.stream``::
+
+        from pycopine import stream
+        server = stream.start_server(port=8081)
+
+    Every `interval` seconds the server sends a ``HystrixCommand`` event for
+    each registered command and a ``HystrixThreadPool`` event for each pool as
+    server sent events. Events are cached per command and only rebuilt if
+    the command was idle and has new events, if its circuit changed state,
+    or once per bucket of its rolling window while it has events in the
+    window. Latency distributions are updated incrementally (see
+    :class:`pycopine.metrics.RollingSnapshot`), so a rebuild only combines
+    the buckets that completed since the last one. The cost per snapshot
+    does not grow with the request rate.
+'''
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+import time
+
+from . import circuit
+from .pool import SemaphorePool
+from .metrics import RollingSnapshot
+from .command import CommandGroup
+
+__all__ = ['MetricsStream', 'StreamServer', 'start_server']
+
+#: Percentiles reported for latency distributions (Hystrix naming)
+PERCENTILES = (0, 25, 50, 75, 90, 95, 99, 99.5, 100)
+
+
+def _ms(seconds):
+    return int(seconds * 1000)
+
+
+def _latency(snapshot):
+    percentiles = snapshot.percentiles(PERCENTILES)
+    return _ms(snapshot.mean()), dict(
+        ('%g' % p, _ms(percentiles[p])) for p in PERCENTILES)
+
+
+class MetricsStream(object):
+    ''' Build Hystrix compatible JSON snapshots of all commands and pools.
+        Snapshots are computed at most once per `interval` seconds and shared
+        between all clients. '''
+
+    def __init__(self, interval=.5):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.lines = []
+        self.updated = 0
+        #: Cached (active, json, bucket index, circuit state) tuples per
+        #: command class
+        self.cache = {}
+        #: Incrementally updated latency snapshots per (command class, name)
+        self.latencies = {}
+
+    def snapshot(self):
+        ''' Return a list of JSON encoded events. '''
+        with self.lock:
+            if time.monotonic() - self.updated >= self.interval / 2:
+                self.lines = self._build()
+                self.updated = time.monotonic()
+            return self.lines
+
+    def _build(self):
+        stamp = '{"currentTime": %d, ' % (time.time() * 1000)
+        lines = []
+        pools = {}
+        seen = set()
+        for group in CommandGroup.all_groups():
+            for executor in group.executors.values():
+                pools[id(executor)] = executor
+            for CommandClass in list(group.commands.values()):
+                seen.add(CommandClass)
+                lines.append(stamp + self._command_json(CommandClass)[1:])
+        for CommandClass in list(self.cache):
+            if CommandClass not in seen:
+                del self.cache[CommandClass]
+        for key in list(self.latencies):
+            if key[0] not in seen:
+                del self.latencies[key]
+        for executor in pools.values():
+            if hasattr(executor, 'metrics'):
+                lines.append(stamp + self._pool_json(executor)[1:])
+        return lines
+
+    def _command_json(self, CommandClass):
+        metrics = CommandClass.metrics
+        bucket = int(time.monotonic() * metrics.buckets / metrics.window)
+        state = CommandClass.circuit.state
+        cached = self.cache.get(CommandClass)
+        if cached and cached[3] == state:
+            active, encoded = cached[:2]
+            if (not active and not metrics.touched) \
+            or (active and cached[2] == bucket):
+                return encoded
+        metrics.touched = False
+        data = self.command_data(CommandClass)
+        active = data['requestCount'] or data['rollingCountShortCircuited'] \
+              or data['latencyTotal']['100'] or data['isCircuitBreakerOpen']
+        encoded = json.dumps(data)
+        self.cache[CommandClass] = (bool(active), encoded, bucket, state)
+        return encoded
+
+    def _latency(self, CommandClass, name):
+        key = CommandClass, name
+        latency = CommandClass.metrics.latency[name]
+        rolling = self.latencies.get(key)
+        if rolling is None or rolling.latency is not latency:
+            rolling = self.latencies[key] = RollingSnapshot(latency)
+        return _latency(rolling.snapshot())
+
+    def _pool_json(self, executor):
+        return json.dumps(self.pool_data(executor))
+
+    def command_data(self, CommandClass):
+        ''' Return a HystrixCommand event (without currentTime) as a dict. '''
+        metrics = CommandClass.metrics
+        breaker = CommandClass.circuit
+        count = metrics.count
+        requests, errors = metrics.health()
+        execute_mean, execute = self._latency(CommandClass, 'run')
+        total_mean, total = self._latency(CommandClass, 'total')
+        timeout = getattr(CommandClass, 'timeout', None)
+        executor = CommandClass.group.executors.get(CommandClass.pool)
+        semaphore = isinstance(executor, SemaphorePool)
+        rejected = count('rejected')
+        return {
+            'type': 'HystrixCommand',
+            'name': CommandClass.name,
+            'group': CommandClass.group.name,
+            'isCircuitBreakerOpen': breaker.state != circuit.CLOSED,
+            'errorPercentage': int(metrics.error_percentage()),
+            'errorCount': errors,
+            'requestCount': requests,
+            'rollingCountCollapsedRequests': count('collapsed'),
+            'rollingCountExceptionsThrown': 0,
+            'rollingCountFailure': count('failure'),
+            'rollingCountFallbackFailure': count('fallback_failure'),
+            'rollingCountFallbackRejection': 0,
+            'rollingCountFallbackSuccess': count('fallback_success'),
+            'rollingCountResponsesFromCache': count('cache_hit'),
+            'rollingCountSemaphoreRejected': rejected if semaphore else 0,
+            'rollingCountShortCircuited': count('short_circuited'),
+            'rollingCountSuccess': count('success'),
+            'rollingCountThreadPoolRejected': 0 if semaphore else rejected,
+            'rollingCountTimeout': count('timeout'),
+            'latencyExecute_mean': execute_mean,
+            'latencyExecute': execute,
+            'latencyTotal_mean': total_mean,
+            'latencyTotal': total,
+            'propertyValue_circuitBreakerRequestVolumeThreshold':
+                breaker.volume,
+            'propertyValue_circuitBreakerSleepWindowInMilliseconds':
+                _ms(breaker.sleep_window),
+            'propertyValue_circuitBreakerErrorThresholdPercentage':
+                breaker.threshold,
+            'propertyValue_circuitBreakerForceOpen': False,
+            'propertyValue_circuitBreakerForceClosed': False,
+            'propertyValue_circuitBreakerEnabled': breaker.enabled,
+            'propertyValue_executionIsolationStrategy':
+                'SEMAPHORE' if semaphore else 'THREAD',
+            'propertyValue_executionIsolationThreadTimeoutInMilliseconds':
+                _ms(timeout) if timeout else 0,
+            'propertyValue_executionIsolationThreadInterruptOnTimeout': False,
+            'propertyValue_executionIsolationThreadPoolKeyOverride': None,
+            'propertyValue_executionIsolationSemaphoreMaxConcurrentRequests':
+                executor.max_pool_size if semaphore else 0,
+            'propertyValue_fallbackIsolationSemaphoreMaxConcurrentRequests':
+                0,
+            'propertyValue_metricsRollingStatisticalWindowInMilliseconds':
+                _ms(metrics.window),
+            'propertyValue_requestCacheEnabled': CommandClass.cache_enabled,
+            'propertyValue_requestLogEnabled': False,
+            'reportingHosts': 1,
+            'threadPool': CommandClass.pool,
+        }
+
+    def pool_data(self, executor):
+        ''' Return a HystrixThreadPool event (without currentTime) as a dict.
+        '''
+        metrics = executor.metrics
+        size = executor.max_pool_size
+        threads = len(executor.threads) if hasattr(executor, 'threads') \
+                  else size
+        active = executor.get_active_count()
+        queued = executor.get_queue_size()
+        executed = metrics.count('executed')
+        return {
+            'type': 'HystrixThreadPool',
+            'name': executor.name,
+            'currentActiveCount': active,
+            'currentCompletedTaskCount': executed,
+            'currentCorePoolSize': size,
+            'currentLargestPoolSize': threads,
+            'currentMaximumPoolSize': size,
+            'currentPoolSize': threads,
+            'currentQueueSize': queued,
+            'currentTaskCount': executed + active + queued,
+            'rollingMaxActiveThreads': max(active, metrics.max('active')),
+            'rollingCountThreadsExecuted': executed,
+            'rollingCountCommandRejections': metrics.count('rejected'),
+            'propertyValue_queueSizeRejectionThreshold':
+                executor.max_queue_size,
+            'propertyValue_metricsRollingStatisticalWindowInMilliseconds':
+                _ms(metrics.window),
+            'reportingHosts': 1,
+        }
+
+
+class StreamHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != self.server.path:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream;charset=UTF-8')
+        self.send_header('Cache-Control',
+                         'no-cache, no-store, max-age=0, must-revalidate')
+        self.send_header('Pragma', 'no-cache')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        stream = self.server.stream
+        try:
+            while not self.server.closed:
+                lines = stream.snapshot()
+                if lines:
+                    chunk = ''.join('data: %s\n\n' % l for l in lines)
+                else:
+                    chunk = 'ping: \n\n'
+                self.wfile.write(chunk.encode('utf8'))
+                self.wfile.flush()
+                time.sleep(stream.interval)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StreamServer(ThreadingHTTPServer):
+    ''' HTTP server that serves a :class:`MetricsStream` at `path`. '''
+    daemon_threads = True
+
+    def __init__(self, address, interval=.5, path='/hystrix.stream'):
+        ThreadingHTTPServer.__init__(self, address, StreamHandler)
+        self.stream = MetricsStream(interval)
+        self.path = path
+        self.closed = False
+
+    def shutdown(self):
+        self.closed = True
+        ThreadingHTTPServer.shutdown(self)
+        self.server_close()
+
+
+def start_server(port=8081, host='127.0.0.1', interval=.5):
+    ''' Start a :class:`StreamServer` in a background thread and return it.
+        Use port 0 to pick a free port (see ``server.server_address``). '''
+    server = StreamServer((host, port), interval)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
@@ -0,0 +1,204 @@
+''' A shared timer service based on a hashed timing wheel.
+
+    Timers are placed in one of `slots` buckets depending on their deadline
+    (rounded up to the next `tick`). Scheduling and canceling a timer is O(1),
+    independent of the number of pending timers. A single background thread
+    advances the wheel once per tick and calls expired timers. It only runs
+    while there are pending timers.
+
+    Callbacks run in the timer thread and should return quickly. Callbacks
+    that may block (e.g. because they submit a command to an executor that
+    runs it in the calling thread) must be scheduled with
+    :func:`schedule_blocking`, which calls them in a helper thread instead,
+    or hand off the blocking part with :func:`call_blocking`.
+'''
+
+from time import monotonic
+import logging
+import math
+import os
+import queue
+import threading
+import weakref
+
+__all__ = ['TimerWheel', 'schedule', 'schedule_blocking', 'call_blocking']
+
+log = logging.getLogger(__name__)
+
+
+class Timeout(object):
+    ''' Handle for a scheduled callback (see :meth:`TimerWheel.schedule`). '''
+    __slots__ = ('wheel', 'target', 'callback', 'args', 'slot')
+
+    def __init__(self, wheel, target, callback, args):
+        self.wheel = wheel
+        self.target = target
+        self.callback = callback
+        self.args = args
+        self.slot = None
+
+    def cancel(self):
+        ''' Cancel the timer. Return True if it was still pending. '''
+        with self.wheel.lock:
+            if self.slot is None:
+                return False
+            self.slot.discard(self)
+            self.slot = None
+            self.wheel.pending -= 1
+            return True
+
+    def is_pending(self):
+        return self.slot is not None
+
+
+class TimerWheel(object):
+    ''' Hashed timing wheel with `slots` buckets of `tick` seconds each. '''
+
+    #: Idle helper threads (see :meth:`schedule_blocking`) exit after this
+    #: many seconds.
+    helper_idle = 10
+
+    def __init__(self, tick=.01, slots=512, clock=monotonic):
+        self.tick = tick
+        self.slots = slots
+        self.clock = clock
+        self._reset()
+        _instances.add(self)
+
+    def _reset(self):
+        ''' Initialize (or, after a fork, forget) all timers and threads. '''
+        self.wheel = [set() for _ in range(self.slots)]
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.pending = 0
+        self.current = self._now()
+        self.thread = None
+        # Callbacks for helper threads, and the number of idle helpers
+        self.jobs = queue.SimpleQueue()
+        self.helper_lock = threading.Lock()
+        self.idle = 0
+
+    def _now(self):
+        return int(self.clock() / self.tick)
+
+    def schedule(self, delay, callback, *args):
+        ''' Call `callback(*args)` after `delay` seconds and return a
+            :class:`Timeout` handle. The callback may run up to two ticks
+            late, but never early. '''
+        # One extra tick because the current tick has already started.
+        ticks = max(0, int(math.ceil(delay / self.tick))) + 1
+        with self.lock:
+            if not self.pending:
+                self.current = self._now()
+            target = self._now() + ticks
+            timeout = Timeout(self, target, callback, args)
+            timeout.slot = self.wheel[target % self.slots]
+            timeout.slot.add(timeout)
+            self.pending += 1
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run_loop)
+                self.thread.daemon = True
+                self.thread.start()
+            elif self.pending == 1:
+                self.cond.notify()
+        return timeout
+
+    def schedule_blocking(self, delay, callback, *args):
+        ''' Like :meth:`schedule`, but call the callback in a helper thread,
+            so that it may block without delaying other timers. Idle helper
+            threads are reused. '''
+        return self.schedule(delay, self._handoff, callback, args)
+
+    def call_blocking(self, callback, *args):
+        ''' Call `callback(*args)` in a helper thread right away. Timer
+            callbacks may use this to do cheap checks in the timer thread and
+            only hand off the work that may block. '''
+        self._handoff(callback, args)
+
+    def _handoff(self, callback, args):
+        ''' Pass a callback to an idle helper thread or start a new one. '''
+        with self.helper_lock:
+            self.jobs.put((callback, args))
+            if self.idle:
+                self.idle -= 1
+                return
+        thread = threading.Thread(target=self._helper_loop,
+                                  name='pycopine-timer-helper')
+        thread.daemon = True
+        thread.start()
+
+    def _helper_loop(self):
+        jobs = self.jobs
+        while True:
+            try:
+                callback, args = jobs.get(timeout=self.helper_idle)
+            except queue.Empty:
+                with self.helper_lock:
+                    if jobs.empty():
+                        self.idle -= 1
+                        return
+                continue # Handed to this thread while timing out
+            try:
+                callback(*args)
+            except Exception:
+                log.exception('Timer callback failed')
+            with self.helper_lock:
+                self.idle += 1
+
+    def advance(self):
+        ''' Move the wheel forward to the current time and call all expired
+            timers. Return the number of expired timers. '''
+        now = self._now()
+        expired = []
+        with self.lock:
+            if now - self.current > self.slots:
+                ticks = range(self.slots) # Visit each slot only once
+            else:
+                ticks = range(self.current + 1, now + 1)
+            for tick in ticks:
+                slot = self.wheel[tick % self.slots]
+                if not slot:
+                    continue
+                due = [t for t in slot if t.target <= now]
+                for timeout in due:
+                    slot.discard(timeout)
+                    timeout.slot = None
+                expired.extend(due)
+            self.current = max(self.current, now)
+            self.pending -= len(expired)
+
+        for timeout in expired:
+            try:
+                timeout.callback(*timeout.args)
+            except Exception:
+                log.exception('Timer callback failed')
+        return len(expired)
+
+    def _run_loop(self):
+        while True:
+            with self.lock:
+                while not self.pending:
+                    self.cond.wait()
+                delay = (self.current + 1) * self.tick - self.clock()
+                if delay > 0:
+                    self.cond.wait(delay)
+            self.advance()
+
+
+#: All TimerWheel instances (see _after_fork())
+_instances = weakref.WeakSet()
+
+def _after_fork():
+    # Only the forking thread survives a fork. Timers of the parent process
+    # belong to tasks of the parent and are dropped.
+    for wheel in list(_instances):
+        wheel._reset()
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+#: Shared timer wheel for all commands
+wheel = TimerWheel()
+schedule = wheel.schedule
+schedule_blocking = wheel.schedule_blocking
+call_blocking = wheel.call_blocking
@@ -0,0 +1,234 @@
+''' Instrumentation hooks for the command lifecycle, with a span exporter and
+    a sampling profiler built on top of them.
+
+    A hook is a callable that is invoked on every state transition of every
+    task, as ``hook(task, transition, pool, timestamp)``. `pool` is the name
+    of the executor and `timestamp` is :func:`time.monotonic_ns`. Transitions
+    are:
+
+    * ``submit``: The task was submitted (NEW to PENDING).
+    * ``start``: run() is about to be called (PENDING to RUNNING).
+    * ``success``, ``failure``, ``timeout``: run() completed.
+    * ``retry``: run() failed and the task will be retried (RUNNING to
+      PENDING).
+    * ``cancel``: The task was canceled, timed out, short-circuited, throttled
+      or rejected before run() completed.
+    * ``fallback``: fallback() was called.
+    * ``cleanup``: cleanup() was called after run() returned.
+
+    Hooks are called without holding any locks, but from many threads at the
+    same time, and should return quickly. If no hooks are installed, the only
+    cost is a single attribute check per transition::
+
+        def log_slow_starts(task, transition, pool, timestamp):
+            ...
+        trace.add_hook(log_slow_starts)
+
+    :class:`SpanTracer` turns transitions into spans, similar to OpenTelemetry
+    spans, and hands them to an exporter. :class:`Profiler` samples which
+    commands keep the workers of each pool busy.
+'''
+
+from collections import Counter
+import itertools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+__all__ = ['add_hook', 'remove_hook', 'SpanTracer', 'MemoryExporter',
+           'FileExporter', 'Profiler']
+
+log = logging.getLogger(__name__)
+
+hooks = []
+
+
+def add_hook(hook):
+    ''' Install a lifecycle hook. Return the hook. '''
+    if hook not in hooks:
+        hooks.append(hook)
+    _install()
+    return hook
+
+
+def remove_hook(hook):
+    ''' Remove a lifecycle hook. Removing the last hook disables tracing. '''
+    if hook in hooks:
+        hooks.remove(hook)
+    _install()
+
+
+def _install():
+    from .command import Command
+    Command._trace = staticmethod(_dispatch) if hooks else None
+
+
+def _dispatch(task, transition, pool):
+    timestamp = time.monotonic_ns()
+    for hook in hooks:
+        try:
+            hook(task, transition, pool, timestamp)
+        except Exception:
+            log.exception('Trace hook failed')
+
+
+#: Transitions that end a span
+_END = {'success': 'OK', 'failure': 'ERROR', 'timeout': 'ERROR',
+        'cancel': 'ERROR'}
+
+
+class SpanTracer(object):
+    ''' Lifecycle hook that creates one span per task (from submit to
+        completion) and passes it to `exporter` as a dict. Times are
+        nanoseconds since the epoch. Only a fraction of `sample_rate` tasks
+        (0 to 1) is traced. Use :meth:`start` and :meth:`stop` to install or
+        remove the tracer. '''
+
+    def __init__(self, exporter, sample_rate=1.0):
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+        self.spans = {} # Task -> span (open spans only)
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.sampled = itertools.count()
+        # Difference between the wall clock and the monotonic clock
+        self.offset = time.time_ns() - time.monotonic_ns()
+
+    def start(self):
+        add_hook(self)
+        return self
+
+    def stop(self):
+        remove_hook(self)
+
+    def __call__(self, task, transition, pool, timestamp):
+        if transition == 'submit':
+            if self.sample_rate < 1 \
+            and next(self.sampled) * self.sample_rate % 1 >= self.sample_rate:
+                return
+            span = {
+                'name': '%s.%s' % (task.group.name, task.name),
+                'trace_id': os.urandom(16).hex(),
+                'span_id': '%016x' % next(self.ids),
+                'start_time': timestamp + self.offset,
+                'end_time': None,
+                'status': None,
+                'attributes': {'pycopine.group': task.group.name,
+                               'pycopine.command': task.name,
+                               'pycopine.pool': pool},
+                'events': [],
+            }
+            with self.lock:
+                self.spans[task] = span
+            return
+        with self.lock:
+            span = self.spans.get(task)
+            if span is not None and transition in _END:
+                del self.spans[task]
+        if span is None:
+            return
+        span['events'].append({'name': transition,
+                               'time': timestamp + self.offset})
+        if transition in _END:
+            span['end_time'] = timestamp + self.offset
+            span['status'] = _END[transition]
+            error = task.exception() if span['status'] == 'ERROR' else None
+            if error is not None:
+                span['attributes']['exception.type'] = type(error).__name__
+            try:
+                self.exporter.export(span)
+            except Exception:
+                log.exception('Span export failed')
+
+
+class MemoryExporter(object):
+    ''' Keep finished spans in a list (e.g. for tests). '''
+
+    def __init__(self):
+        self.spans = []
+
+    def export(self, span):
+        self.spans.append(span)
+
+
+class FileExporter(object):
+    ''' Write finished spans as JSON lines to a file (or a file name).
+        Defaults to stdout. '''
+
+    def __init__(self, file=None):
+        if isinstance(file, str):
+            file = open(file, 'a')
+        self.file = file or sys.stdout
+        self.lock = threading.Lock()
+
+    def export(self, span):
+        line = json.dumps(span, sort_keys=True) + '\n'
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+
+
+class Profiler(object):
+    ''' Sampling profiler for pool time. A background thread looks at the
+        tasks that are currently running every `interval` seconds and counts
+        one sample per task for its pool and command. Commands with many
+        samples dominate the time of their pool. '''
+
+    def __init__(self, interval=.01):
+        self.interval = interval
+        self.running = {} # Task -> pool name
+        self.samples = Counter() # (pool, command) -> number of samples
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        ''' Install the hook and start sampling. '''
+        add_hook(self)
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self._run_loop)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        ''' Stop sampling and remove the hook. Samples are kept. '''
+        remove_hook(self)
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        with self.lock:
+            self.running.clear()
+
+    def __call__(self, task, transition, pool, timestamp):
+        if transition == 'start':
+            with self.lock:
+                self.running[task] = pool
+        elif transition == 'cleanup':
+            with self.lock:
+                self.running.pop(task, None)
+
+    def sample(self):
+        ''' Take a single sample. '''
+        with self.lock:
+            running = [(pool, '%s.%s' % (task.group.name, task.name))
+                       for task, pool in self.running.items()]
+        self.samples.update(running)
+
+    def _run_loop(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def report(self):
+        ''' Return a list of (pool, command, samples, share) tuples, sorted
+            by the number of samples. `share` is the fraction of samples of
+            the pool that belong to the command. '''
+        per_pool = Counter()
+        for (pool, command), count in self.samples.items():
+            per_pool[pool] += count
+        return [(pool, command, count, count / per_pool[pool])
+                for (pool, command), count in self.samples.most_common()]
@@ -0,0 +1,155 @@
+from pycopine import *
+from pycopine.aio import AsyncPool
+import asyncio
+import time
+
+
+class CleanupMixin(object):
+    def setUp(self):
+        CommandGroup.clear_all()
+        CommandGroup().add_executor(AsyncPool('test.async'))
+
+    def tearDown(self):
+        CommandGroup.clear_all()
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+class TestAwaitCommand(CleanupMixin):
+
+    def test_await(self):
+        class MyCommand(Command):
+            pool = 'test.async'
+            async def run(self, value):
+                await asyncio.sleep(0)
+                return value
+
+        async def main():
+            return await MyCommand(5), await MyCommand(6).aresult()
+        assert run(main()) == (5, 6)
+
+    def test_await_thread_pool(self):
+        class MyCommand(Command):
+            def run(self, value):
+                return value
+
+        async def main():
+            return await MyCommand(5)
+        assert run(main()) == 5
+
+    def test_async_run_in_thread_pool(self):
+        class MyCommand(Command):
+            async def run(self, value):
+                return value
+        assert MyCommand(5).result() == 5
+
+    def test_async_fallback(self):
+        class MyCommand(Command):
+            pool = 'test.async'
+            async def run(self, value):
+                raise RuntimeError()
+            async def fallback(self, value):
+                return 'fallback'
+
+        async def main():
+            cmd = MyCommand(5)
+            return await cmd, cmd.is_fallback()
+        assert run(main()) == ('fallback', True)
+
+    def test_timeout(self):
+        class MyCommand(Command):
+            pool = 'test.async'
+            async def run(self):
+                await asyncio.sleep(1)
+            async def fallback(self):
+                return 'fallback'
+
+        async def main():
+            cmd = MyCommand()
+            start = time.time()
+            result = await cmd.aresult(.05)
+            assert time.time() - start < .5
+            assert cmd.is_timeout()
+            return result
+        assert run(main()) == 'fallback'
+
+    def test_cancel_running(self):
+        cleaned = []
+        class MyCommand(Command):
+            pool = 'test.async'
+            async def run(self):
+                await asyncio.sleep(1)
+            def cleanup(self):
+                cleaned.append(None)
+
+        async def main():
+            cmd = MyCommand().submit()
+            await asyncio.sleep(.01)
+            assert cmd.is_running()
+            cmd.cancel()
+            await asyncio.sleep(.01)
+            assert cleaned
+            assert cmd.is_canceled()
+        run(main())
+
+
+class TestAsyncPool(CleanupMixin):
+
+    def test_concurrency_limit(self):
+        executor = AsyncPool('test.async.limit')
+        executor.max_pool_size = 2
+        CommandGroup().add_executor(executor)
+        active = []
+
+        class MyCommand(Command):
+            pool = 'test.async.limit'
+            async def run(self):
+                active.append(executor.get_active_count())
+                await asyncio.sleep(.01)
+
+        async def main():
+            await asyncio.gather(*[MyCommand().aresult() for _ in range(6)])
+        run(main())
+        assert max(active) == 2
+        assert executor.get_queue_size() == 0
+
+    def test_queue_full(self):
+        executor = AsyncPool('test.async.full')
+        executor.max_pool_size = 1
+        executor.max_queue_size = 1
+        CommandGroup().add_executor(executor)
+
+        class MyCommand(Command):
+            pool = 'test.async.full'
+            async def run(self):
+                await asyncio.sleep(.01)
+
+        async def main():
+            MyCommand().submit()
+            rejected = MyCommand().submit()
+            assert isinstance(rejected.exception(), CommandRejectedError)
+        run(main())
+
+    def test_result_from_thread(self):
+        class MyCommand(Command):
+            pool = 'test.async'
+            async def run(self, value):
+                return value
+
+        async def main():
+            loop = asyncio.get_running_loop()
+            AsyncPool('test.async').bind(loop)
+            return await loop.run_in_executor(None,
+                                              lambda: MyCommand(5).result(1))
+        assert run(main()) == 5
+
+    def test_subclass(self):
+        class MyAsyncPool(AsyncPool):
+            max_pool_size = 2
+        pool = MyAsyncPool('test.async.sub')
+        assert isinstance(pool, MyAsyncPool)
+        assert pool.max_pool_size == 2
+        assert MyAsyncPool('test.async.sub') is pool
+        assert AsyncPool('test.async.sub') is not pool
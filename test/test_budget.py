@@ -0,0 +1,96 @@
+from pycopine.pool import Pool
+from pycopine.budget import WorkerBudget
+import threading
+import time
+
+
+class Job(object):
+    def __init__(self, release=None):
+        self.release = release
+        self.done = threading.Event()
+        self.thread = None
+
+    def _run(self):
+        self.thread = threading.current_thread()
+        if self.release is not None:
+            self.release.wait(2)
+        self.done.set()
+
+
+def make_pool(name, budget, size=10, minimum=0):
+    pool = Pool(name)
+    pool.budget = budget
+    pool.max_pool_size = size
+    pool.max_queue_size = 100
+    pool.min_pool_size = minimum
+    budget.register(pool)
+    return pool
+
+
+class TestWorkerBudget(object):
+
+    def test_shared_workers(self):
+        budget = WorkerBudget(max_workers=2)
+        a = make_pool('test.budget.a', budget)
+        b = make_pool('test.budget.b', budget)
+        jobs = [Job() for _ in range(10)]
+        for i, job in enumerate(jobs):
+            (a if i % 2 else b).enqueue(job)
+        assert all(job.done.wait(1) for job in jobs)
+        assert not a.threads and not b.threads
+        assert len(set(job.thread for job in jobs)) <= 2
+        assert a.metrics.count('executed') == 5
+
+    def test_prestart_ignored(self):
+        budget = WorkerBudget(max_workers=2)
+        pool = make_pool('test.budget.prestart', budget)
+        pool.core_pool_size = 5
+        assert pool.prestart() == 0
+        assert pool.prestart(3) == 0
+        assert not pool.threads and not budget.threads
+        job = Job()
+        pool.enqueue(job)
+        assert job.done.wait(1)
+        assert not pool.threads
+
+    def test_max_workers(self):
+        budget = WorkerBudget(max_workers=3)
+        pool = make_pool('test.budget.max', budget)
+        release = threading.Event()
+        jobs = [Job(release) for _ in range(6)]
+        for job in jobs:
+            pool.enqueue(job)
+        time.sleep(.05)
+        assert budget.get_active_count() == 3
+        assert pool.get_active_count() == 3
+        release.set()
+        assert all(job.done.wait(1) for job in jobs)
+
+    def test_minimum(self):
+        budget = WorkerBudget(max_workers=3)
+        busy = make_pool('test.budget.busy', budget)
+        quiet = make_pool('test.budget.quiet', budget, minimum=1)
+        release = threading.Event()
+        blocked = [Job(release) for _ in range(5)]
+        for job in blocked:
+            busy.enqueue(job)
+        time.sleep(.05)
+        # The busy pool may only borrow 2 workers, 1 is reserved
+        assert budget.active[busy] == 2
+        job = Job()
+        quiet.enqueue(job)
+        assert job.done.wait(1)
+        release.set()
+        assert all(job.done.wait(1) for job in blocked)
+
+    def test_pool_limit(self):
+        budget = WorkerBudget(max_workers=10)
+        pool = make_pool('test.budget.limit', budget, size=1)
+        release = threading.Event()
+        jobs = [Job(release) for _ in range(3)]
+        for job in jobs:
+            pool.enqueue(job)
+        time.sleep(.05)
+        assert pool.get_active_count() == 1
+        release.set()
+        assert all(job.done.wait(1) for job in jobs)
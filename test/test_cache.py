@@ -0,0 +1,220 @@
+from pycopine import *
+from pycopine.cache import LRUCache, request_cache
+import threading
+import time
+
+
+class CleanupMixin(object):
+    def setUp(self):
+        CommandGroup.clear_all()
+
+    def tearDown(self):
+        CommandGroup.clear_all()
+
+
+class TestLRUCache(object):
+
+    def test_evict(self):
+        c = LRUCache(max_size=2)
+        c.set('a', 1)
+        c.set('b', 2)
+        assert c.get('a') == (True, 1)
+        c.set('c', 3)
+        assert c.get('b') == (False, None)
+        assert c.get('a') == (True, 1)
+        assert len(c) == 2
+
+    def test_ttl(self):
+        c = LRUCache(ttl=.01)
+        c.set('a', 1)
+        assert c.get('a') == (True, 1)
+        time.sleep(.02)
+        assert c.get('a') == (False, None)
+        assert len(c) == 0
+
+
+class TestCommandCache(CleanupMixin):
+
+    def test_disabled(self):
+        calls = []
+        class MyCommand(Command):
+            def run(self, value):
+                calls.append(value)
+                return value
+
+        assert MyCommand.cache is None
+        MyCommand(1).result()
+        MyCommand(1).result()
+        assert len(calls) == 2
+
+    def test_hit(self):
+        calls = []
+        class MyCommand(Command):
+            cache_enabled = True
+            def run(self, value):
+                calls.append(value)
+                return value
+
+        assert MyCommand(1).result() == 1
+        cmd = MyCommand(1).submit()
+        assert cmd.is_success()
+        assert cmd.result() == 1
+        assert MyCommand(2).result() == 2
+        assert calls == [1, 2]
+        assert (MyCommand.cache.hits, MyCommand.cache.misses) == (1, 2)
+        assert MyCommand.metrics.count('cache_hit') == 1
+
+    def test_failures_not_cached(self):
+        calls = []
+        class MyCommand(Command):
+            cache_enabled = True
+            def run(self, value):
+                calls.append(value)
+                raise RuntimeError()
+            def fallback(self, value): return 'fallback'
+
+        assert MyCommand(1).result() == 'fallback'
+        assert MyCommand(1).result() == 'fallback'
+        assert len(calls) == 2
+
+    def test_cache_key(self):
+        calls = []
+        class MyCommand(Command):
+            cache_enabled = True
+            def run(self, value, extra=None):
+                calls.append(value)
+                return value
+            def cache_key(self, value, extra=None):
+                return value
+
+        MyCommand(1, extra=[]).result()
+        MyCommand(1, extra=[1]).result()
+        assert len(calls) == 1
+
+    def test_unhashable_bypass(self):
+        calls = []
+        class MyCommand(Command):
+            cache_enabled = True
+            def run(self, value):
+                calls.append(value)
+
+        MyCommand([]).result()
+        MyCommand([]).result()
+        assert len(calls) == 2
+
+    def test_single_flight(self):
+        calls = []
+        release = threading.Event()
+        class MyCommand(Command):
+            cache_enabled = True
+            def run(self, value):
+                calls.append(value)
+                release.wait(1)
+                return value
+
+        tasks = [MyCommand(1).submit() for i in range(5)]
+        release.set()
+        assert [t.result(1) for t in tasks] == [1] * 5
+        assert calls == [1]
+
+    def test_single_flight_leader_canceled(self):
+        calls = []
+        release = threading.Event()
+        class MyCommand(Command):
+            cache_enabled = True
+            def run(self, value):
+                calls.append(value)
+                release.wait(1)
+                return value
+
+        leader = MyCommand(1).submit()
+        follower = MyCommand(1).submit()
+        leader.cancel()
+        release.set()
+        assert follower.result(1) == 1
+        assert leader.is_canceled()
+
+    def test_single_flight_failure(self):
+        release = threading.Event()
+        class MyCommand(Command):
+            cache_enabled = True
+            def run(self, value):
+                release.wait(1)
+                raise IOError()
+
+        tasks = [MyCommand(1).submit() for i in range(5)]
+        release.set()
+        assert all(isinstance(t.exception(1), IOError) for t in tasks)
+        # Followers do not count as failures (e.g. for the circuit).
+        assert MyCommand.metrics.count('failure') == 1
+        assert MyCommand.metrics.count('cache_hit') == 4
+
+    def test_single_flight_leader_timeout(self):
+        calls = []
+        release = threading.Event()
+        class MyCommand(Command):
+            cache_enabled = True
+            def run(self, value):
+                calls.append(value)
+                release.wait(1)
+                return value
+
+        leader = MyCommand(1).submit()
+        followers = [MyCommand(1).submit() for i in range(5)]
+        while not calls:
+            time.sleep(.001)
+        leader._expire()
+        release.set()
+        assert [t.result(1) for t in followers] == [1] * 5
+        # A single follower took over.
+        assert calls == [1, 1]
+        assert MyCommand(1).result(1) == 1
+        assert calls == [1, 1]
+
+    def test_single_flight_leader_timeout_inline(self):
+        # The new leader must not run in the timer thread that expired the
+        # old one, and must still honor its own timeout.
+        from pycopine.pool import SemaphorePool
+        CommandGroup().add_executor(SemaphorePool('test.inline'))
+        threads = []
+        class MyCommand(Command):
+            pool = 'test.inline'
+            cache_enabled = True
+            timeout = .1
+            def run(self, value):
+                threads.append(threading.current_thread())
+                time.sleep(.3)
+                return value
+            def fallback(self, value):
+                return -1
+
+        leader = MyCommand(1)
+        runner = threading.Thread(target=leader.result)
+        runner.start()
+        while not threads:
+            time.sleep(.001)
+        time.sleep(.05) # Leader expires first
+        follower = MyCommand(1)
+        start = time.monotonic()
+        assert follower.result() == -1
+        assert time.monotonic() - start < .25
+        assert leader.is_timeout() and follower.is_timeout()
+        runner.join()
+        assert len(threads) == 2
+        assert threads[1] is not runner
+        assert threads[1].name == 'pycopine-timer-helper'
+
+    def test_request_scope(self):
+        calls = []
+        class MyCommand(Command):
+            cache_enabled = True
+            cache_ttl = 0
+            def run(self, value):
+                calls.append(value)
+                return value
+
+        with request_cache():
+            MyCommand(1).result()
+            MyCommand(1).result()
+        MyCommand(1).result()
+        assert len(calls) == 2
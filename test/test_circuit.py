@@ -0,0 +1,121 @@
+from pycopine import *
+from pycopine.circuit import CircuitBreaker, CLOSED, OPEN, HALF_OPEN
+from pycopine.metrics import CommandMetrics
+import time
+
+
+class CleanupMixin(object):
+    def setUp(self):
+        CommandGroup.clear_all()
+
+    def tearDown(self):
+        CommandGroup.clear_all()
+
+
+class TestCircuitBreaker(object):
+
+    def test_volume(self):
+        cb = CircuitBreaker(CommandMetrics(), volume=5)
+        for i in range(4):
+            cb.mark('failure')
+            assert cb.state == CLOSED
+        cb.mark('failure')
+        assert cb.state == OPEN
+        assert not cb.allow_request()
+
+    def test_threshold(self):
+        cb = CircuitBreaker(CommandMetrics(), volume=1, threshold=50)
+        cb.mark('success')
+        cb.mark('success')
+        cb.mark('timeout')
+        assert cb.state == CLOSED
+        cb.mark('rejected')
+        assert cb.state == OPEN
+
+    def test_short_circuit_is_no_error(self):
+        cb = CircuitBreaker(CommandMetrics(), volume=1)
+        cb.mark('short_circuited')
+        assert cb.state == CLOSED
+
+    def test_disabled(self):
+        cb = CircuitBreaker(CommandMetrics(), volume=1, enabled=False)
+        cb.mark('failure')
+        assert cb.allow_request()
+
+    def test_half_open(self):
+        cb = CircuitBreaker(CommandMetrics(), volume=1, sleep_window=.05)
+        cb.mark('failure')
+        assert not cb.allow_request()
+        time.sleep(.06)
+        assert cb.allow_request()
+        assert cb.state == HALF_OPEN
+        assert not cb.allow_request()
+        cb.mark('failure')
+        assert cb.state == OPEN
+        time.sleep(.06)
+        assert cb.allow_request()
+        cb.mark('success')
+        assert cb.state == CLOSED
+        assert cb.metrics.health() == (0, 0)
+
+
+class TestCommandCircuit(CleanupMixin):
+
+    def test_short_circuit(self):
+        calls = []
+        class MyCommand(Command):
+            circuit_volume = 3
+            def run(self):
+                calls.append(None)
+                raise RuntimeError()
+            def fallback(self):
+                return 'fallback'
+
+        for i in range(3):
+            assert MyCommand().result() == 'fallback'
+        assert MyCommand.circuit.is_open()
+
+        cmd = MyCommand().submit()
+        assert cmd.is_completed()
+        assert isinstance(cmd.exception(), CommandShortCircuitError)
+        assert cmd.result() == 'fallback'
+        assert len(calls) == 3
+        assert MyCommand.metrics.count('short_circuited') == 1
+        assert MyCommand.metrics.count('fallback_success') == 4
+
+    def test_metrics_per_command(self):
+        class MyCommand(Command):
+            def run(self): pass
+        class MyOtherCommand(Command):
+            def run(self): pass
+
+        MyCommand().result()
+        assert MyCommand.metrics.count('success') == 1
+        assert MyOtherCommand.metrics.count('success') == 0
+
+    def test_timeout_counted(self):
+        class MyCommand(Command):
+            def run(self): time.sleep(.2)
+            def fallback(self): return 'fallback'
+
+        assert MyCommand().result(.01) == 'fallback'
+        assert MyCommand.metrics.count('timeout') == 1
+        time.sleep(.2)
+        assert MyCommand.metrics.count('success') == 0
+
+    def test_rejected(self):
+        executor = Pool('test.rejected')
+        executor.max_pool_size = 0
+        executor.max_queue_size = 1
+
+        class MyCommand(Command):
+            pool = 'test.rejected'
+            def run(self): pass
+            def fallback(self): return 'fallback'
+        MyCommand.group.add_executor(executor)
+
+        first = MyCommand().submit()
+        assert MyCommand().result() == 'fallback'
+        assert isinstance(MyCommand().exception(), CommandRejectedError)
+        assert MyCommand.metrics.count('rejected') == 2
+        first.cancel()
@@ -0,0 +1,151 @@
+from pycopine import *
+from pycopine import timer
+from pycopine.pool import SemaphorePool
+from nose.tools import raises
+import threading
+
+
+class CleanupMixin(object):
+    def setUp(self):
+        CommandGroup.clear_all()
+
+    def tearDown(self):
+        CommandGroup.clear_all()
+
+
+class TestCollapser(CleanupMixin):
+
+    def test_batch(self):
+        batches = []
+        class MyCommand(Command):
+            collapse_window = .05
+            def run(self, value): pass
+            @classmethod
+            def run_batch(cls, arguments):
+                batches.append(arguments)
+                return [a[0] * 2 for a, ka in arguments]
+
+        tasks = [MyCommand(i).submit() for i in range(5)]
+        assert [t.result(1) for t in tasks] == [0, 2, 4, 6, 8]
+        assert len(batches) == 1
+        assert MyCommand.metrics.count('success') == 5
+
+    def test_inline_executor(self):
+        CommandGroup().add_executor(SemaphorePool('test.collapse.inline'))
+        threads = []
+        class MyCommand(Command):
+            pool = 'test.collapse.inline'
+            collapse_window = .01
+            def run(self, value): pass
+            @classmethod
+            def run_batch(cls, arguments):
+                threads.append(threading.current_thread())
+                return [a[0] for a, ka in arguments]
+
+        assert MyCommand(1).result(1) == 1
+        assert threads and threads[0] is not timer.wheel.thread
+
+    @raises(CommandSetupError)
+    def test_async_executor(self):
+        from pycopine.aio import AsyncPool
+        CommandGroup().add_executor(AsyncPool('test.collapse.async'))
+        class MyCommand(Command):
+            pool = 'test.collapse.async'
+            collapse_window = .01
+            async def run(self, value): pass
+            @classmethod
+            def run_batch(cls, arguments): pass
+
+    def test_async_executor_added_later(self):
+        from pycopine.aio import AsyncPool
+        class MyCommand(Command):
+            pool = 'test.collapse.async.later'
+            collapse_window = .01
+            async def run(self, value): pass
+            @classmethod
+            def run_batch(cls, arguments): pass
+        CommandGroup().add_executor(AsyncPool('test.collapse.async.later'))
+        assert isinstance(MyCommand(1).exception(1), CommandRejectedError)
+
+    def test_same_key(self):
+        batches = []
+        class MyCommand(Command):
+            collapse_window = .05
+            def run(self, value): pass
+            def collapse_key(self, value):
+                return value.lower()
+            @classmethod
+            def run_batch(cls, arguments):
+                batches.append(arguments)
+                return [a[0] for a, ka in arguments]
+
+        tasks = [MyCommand(v).submit() for v in ('A', 'a', 'B')]
+        assert [t.result(1) for t in tasks] == ['A', 'A', 'B']
+        assert batches == [[(('A',), {}), (('B',), {})]]
+
+    def test_max_size(self):
+        batches = []
+        class MyCommand(Command):
+            collapse_window = 10
+            collapse_max = 2
+            def run(self, value): pass
+            @classmethod
+            def run_batch(cls, arguments):
+                batches.append(arguments)
+                return [None] * len(arguments)
+
+        tasks = [MyCommand(i).submit() for i in range(2)]
+        assert all(t.wait(1) for t in tasks)
+        assert len(batches) == 1
+
+    def test_batch_error(self):
+        class MyCommand(Command):
+            collapse_window = .01
+            def run(self, value): pass
+            def fallback(self, value): return 'fallback'
+            @classmethod
+            def run_batch(cls, arguments):
+                raise RuntimeError()
+
+        tasks = [MyCommand(i).submit() for i in range(2)]
+        assert [t.result(1) for t in tasks] == ['fallback', 'fallback']
+        assert isinstance(tasks[0].exception(), RuntimeError)
+
+    def test_cancel_single(self):
+        batches = []
+        class MyCommand(Command):
+            collapse_window = .05
+            def run(self, value): pass
+            @classmethod
+            def run_batch(cls, arguments):
+                batches.append(arguments)
+                return [a[0] for a, ka in arguments]
+
+        a, b = MyCommand(1).submit(), MyCommand(2).submit()
+        assert a.cancel()
+        assert b.result(1) == 2
+        assert a.is_canceled()
+        assert batches == [[((2,), {})]]
+
+    def test_timeout_single(self):
+        release = threading.Event()
+        class MyCommand(Command):
+            collapse_window = .01
+            def run(self, value): pass
+            @classmethod
+            def run_batch(cls, arguments):
+                release.wait(1)
+                return [a[0] for a, ka in arguments]
+
+        a, b = MyCommand(1).submit(), MyCommand(2).submit()
+        try:
+            assert isinstance(a.exception(.05), CommandTimeoutError)
+        finally:
+            release.set()
+        assert b.result(1) == 2
+
+    @raises(CommandSetupError)
+    def test_run_batch_required(self):
+        class MyCommand(Command):
+            collapse_window = .01
+            def run(self, value): pass
@@ -166,6 +166,37 @@ class TestCommandRunnable(CleanupMixin):
         assert cmd.is_canceled()
         assert not cmd.is_running()
 
+    def test_wait(self):
+        class MyCommand(Command):
+            def run(self, wakeup):
+                wakeup.wait(1)
+
+        wakeup = threading.Event()
+        cmd = MyCommand(wakeup).submit()
+        assert not cmd.wait(.01)
+        results = []
+        waiters = [threading.Thread(target=lambda: results.append(cmd.wait()))
+                   for _ in range(3)]
+        for t in waiters: t.start()
+        wakeup.set()
+        for t in waiters: t.join(1)
+        assert results == [True] * 3
+        assert cmd.wait(0)
+
+    def test_wait_timeout_reuse(self):
+        class MyCommand(Command):
+            def run(self, wakeup):
+                wakeup.wait(1)
+                return 5
+
+        wakeup = threading.Event()
+        cmd = MyCommand(wakeup).submit()
+        for _ in range(3):
+            assert not cmd.wait(.01)
+        wakeup.set()
+        assert cmd.wait(1)
+        assert MyCommand(wakeup).submit().wait(1)
+
     @raises(CommandTimeoutError)
     def test_timeout(self):
         class MyCommand(Command):
@@ -275,3 +306,388 @@ class TestCommandCleanup(CleanupMixin):
         assert MyCommand().result() is None
 
 
+
+
+class TestCommandBulk(CleanupMixin):
+
+    def test_submit_many(self):
+        class MyCommand(Command):
+            def run(self, value): return value
+        Pool('default').max_queue_size = 5
+        try:
+            tasks = Command.submit_many(MyCommand(i) for i in range(8))
+            for task in tasks:
+                task.wait(1)
+            assert len([t for t in tasks if t.is_success()]) >= 5
+            for task in tasks:
+                if not task.is_success():
+                    assert isinstance(task.exception(), CommandRejectedError)
+        finally:
+            Pool('default').max_queue_size = 10
+
+    def test_as_completed(self):
+        class MyCommand(Command):
+            def run(self, delay):
+                time.sleep(delay)
+                return delay
+        tasks = [MyCommand(.05), MyCommand(0)]
+        done = list(as_completed(tasks, 1))
+        assert done == tasks[::-1]
+
+    def test_as_completed_timeout(self):
+        class MyCommand(Command):
+            def run(self, delay):
+                time.sleep(delay)
+                return delay
+        tasks = [MyCommand(0), MyCommand(1)]
+        done = list(as_completed(tasks, .1))
+        assert done == tasks
+        assert tasks[0].is_success()
+        assert tasks[1].is_timeout()
+
+    def test_gather(self):
+        class MyCommand(Command):
+            def run(self, value): return value * 2
+            def fallback(self, value): return -1
+        assert gather([MyCommand(1), MyCommand(2)]) == [2, 4]
+        assert MyCommand.map([3, 4]) == [6, 8]
+
+
+class TestCommandRetry(CleanupMixin):
+
+    def test_retry(self):
+        calls = []
+        class MyCommand(Command):
+            retry_max = 3
+            retry_delay = .01
+            def run(self):
+                calls.append(None)
+                if len(calls) < 3:
+                    raise IOError()
+                return len(calls)
+
+        assert MyCommand().result(1) == 3
+        assert MyCommand.metrics.count('retry') == 2
+        assert MyCommand.metrics.count('success') == 1
+        assert MyCommand.metrics.count('failure') == 0
+
+    def test_retry_max(self):
+        calls = []
+        class MyCommand(Command):
+            retry_max = 2
+            retry_delay = .01
+            def run(self):
+                calls.append(None)
+                raise IOError()
+
+        assert isinstance(MyCommand().exception(1), IOError)
+        assert len(calls) == 3
+
+    def test_retry_on(self):
+        calls = []
+        class MyCommand(Command):
+            retry_max = 2
+            retry_on = (IOError,)
+            def run(self):
+                calls.append(None)
+                raise ValueError()
+
+        assert isinstance(MyCommand().exception(1), ValueError)
+        assert len(calls) == 1
+
+    def test_retry_budget(self):
+        class MyCommand(Command):
+            retry_max = 1
+            retry_delay = .01
+            retry_rate = 0
+            retry_burst = 2
+            def run(self):
+                raise IOError()
+
+        for _ in range(4):
+            assert isinstance(MyCommand().exception(1), IOError)
+        assert MyCommand.metrics.count('retry') == 2
+
+    def test_retry_cached(self):
+        calls = []
+        wakeup = threading.Event()
+        class MyCommand(Command):
+            cache_enabled = True
+            retry_max = 2
+            retry_delay = .01
+            def run(self):
+                calls.append(None)
+                wakeup.wait(1)
+                raise IOError()
+
+        leader = MyCommand().submit()
+        follower = MyCommand().submit()
+        wakeup.set()
+        assert isinstance(leader.exception(1), IOError)
+        # The follower takes the final outcome of the leader as is.
+        assert follower.wait(1)
+        assert isinstance(follower.exception(), IOError)
+        assert len(calls) == 3
+
+    def test_retry_inline(self):
+        from pycopine.pool import SemaphorePool
+        CommandGroup().add_executor(SemaphorePool('test.retry.inline'))
+        calls = []
+        class MyCommand(Command):
+            pool = 'test.retry.inline'
+            retry_max = 1
+            retry_delay = .01
+            retry_jitter = False
+            def run(self):
+                calls.append(None)
+                if len(calls) == 1:
+                    raise IOError()
+                time.sleep(.3)
+                return 'ok'
+        class Slow(Command):
+            timeout = .05
+            def run(self): time.sleep(1)
+
+        task = MyCommand().submit()
+        time.sleep(.05) # The retry is running now
+        start = time.monotonic()
+        assert Slow().submit().wait(1)
+        assert time.monotonic() - start < .2
+        assert task.result(1) == 'ok'
+
+
+
+class TestCommandRateLimit(CleanupMixin):
+
+    def test_reject(self):
+        class MyCommand(Command):
+            rate_limit = 1
+            rate_burst = 2
+            def run(self): return 'ok'
+            def fallback(self): return 'fallback'
+
+        results = [MyCommand().result(1) for _ in range(3)]
+        assert results == ['ok', 'ok', 'fallback']
+        assert MyCommand.metrics.count('throttled') == 1
+        assert MyCommand.metrics.count('failure') == 0
+
+    def test_block(self):
+        class MyCommand(Command):
+            rate_limit = 20
+            rate_burst = 1
+            rate_mode = 'block'
+            def run(self): return 'ok'
+
+        start = time.monotonic()
+        assert [MyCommand().result(1) for _ in range(3)] == ['ok'] * 3
+        assert time.monotonic() - start >= .09
+
+    def test_queue(self):
+        class MyCommand(Command):
+            rate_limit = 20
+            rate_burst = 1
+            rate_mode = 'queue'
+            def run(self): return 'ok'
+
+        start = time.monotonic()
+        tasks = [MyCommand().submit() for _ in range(3)]
+        assert time.monotonic() - start < .05
+        assert [task.result(1) for task in tasks] == ['ok'] * 3
+        assert time.monotonic() - start >= .09
+
+    def test_queue_inline(self):
+        from pycopine.pool import SemaphorePool
+        CommandGroup().add_executor(SemaphorePool('test.rate.inline'))
+        class MyCommand(Command):
+            pool = 'test.rate.inline'
+            rate_limit = 20
+            rate_burst = 1
+            rate_mode = 'queue'
+            def run(self, delay): time.sleep(delay)
+        class Slow(Command):
+            timeout = .05
+            def run(self): time.sleep(1)
+
+        MyCommand(0).submit()
+        task = MyCommand(.3).submit() # Runs after .05 seconds
+        time.sleep(.1)
+        start = time.monotonic()
+        assert Slow().submit().wait(1)
+        assert time.monotonic() - start < .2
+        assert task.wait(1)
+
+    def test_queue_deadline(self):
+        class MyCommand(Command):
+            rate_limit = 1
+            rate_burst = 1
+            rate_mode = 'queue'
+            timeout = .1
+            def run(self): return 'ok'
+
+        assert MyCommand().result() == 'ok'
+        assert isinstance(MyCommand().exception(), CommandThrottledError)
+
+    def test_group_limit(self):
+        from pycopine.limits import TokenBucket
+        class MyCommand(Command):
+            group = 'limited'
+            def run(self): return 'ok'
+        class MyOtherCommand(Command):
+            group = 'limited'
+            def run(self): return 'ok'
+        CommandGroup('limited').rate_limit = TokenBucket(1, 1)
+
+        assert MyCommand().result(1) == 'ok'
+        assert isinstance(MyOtherCommand().exception(1), CommandThrottledError)
+
+    def test_retry_throttled(self):
+        calls = []
+        class MyCommand(Command):
+            rate_limit = 1
+            rate_burst = 1
+            retry_max = 5
+            retry_delay = .001
+            def run(self):
+                calls.append(1)
+                raise IOError()
+
+        assert isinstance(MyCommand().exception(1), CommandThrottledError)
+        assert len(calls) == 1
+        assert MyCommand.metrics.count('throttled') == 1
+
+    def test_retry_queued(self):
+        calls = []
+        class MyCommand(Command):
+            rate_limit = 20
+            rate_burst = 1
+            rate_mode = 'queue'
+            retry_max = 2
+            retry_delay = .001
+            retry_jitter = False
+            def run(self):
+                calls.append(time.monotonic())
+                if len(calls) < 3:
+                    raise IOError()
+                return 'ok'
+
+        assert MyCommand().result(1) == 'ok'
+        assert len(calls) == 3
+        assert calls[2] - calls[0] >= .09
+
+
+class TestCommandHedge(CleanupMixin):
+
+    def make(self, stall, started=None, **options):
+        def run(self, value):
+            if started is not None:
+                started.append(self)
+            if stall:
+                stall.pop().wait(1)
+            return value
+        ns = dict(hedge_percentile=90, hedge_ratio=1, run=run,
+                  __module__=__name__)
+        ns.update(options)
+        MyCommand = CommandMeta('MyCommand', (Command,), ns)
+        for i in range(10):
+            assert MyCommand(i).result(1) == i
+        return MyCommand
+
+    def test_hedge(self):
+        wakeup = threading.Event()
+        stall = []
+        MyCommand = self.make(stall)
+        try:
+            stall.append(wakeup)
+            start = time.monotonic()
+            assert MyCommand(5).result(1) == 5
+            assert time.monotonic() - start < .5
+            assert MyCommand.metrics.count('hedge') == 1
+            assert MyCommand.metrics.count('hedge_win') == 1
+        finally:
+            wakeup.set()
+
+    def test_hedge_cached(self):
+        wakeup = threading.Event()
+        stall = []
+        MyCommand = self.make(stall, cache_enabled=True)
+        try:
+            stall.append(wakeup)
+            start = time.monotonic()
+            assert MyCommand(50).result(1) == 50
+            assert time.monotonic() - start < .5
+            assert MyCommand.metrics.count('hedge_win') == 1
+            assert MyCommand.metrics.count('cache_hit') == 0
+            assert MyCommand(50).result(1) == 50
+            assert MyCommand.metrics.count('cache_hit') == 1
+        finally:
+            wakeup.set()
+
+    def test_hedge_budget(self):
+        wakeup = threading.Event()
+        stall = []
+        MyCommand = self.make(stall)
+        MyCommand.hedger.ratio = 0
+        try:
+            stall.append(wakeup)
+            task = MyCommand(5).submit()
+            assert not task.wait(.1)
+            assert MyCommand.metrics.count('hedge') == 0
+        finally:
+            wakeup.set()
+        assert task.result(1) == 5
+
+    def test_timer_canceled(self):
+        from pycopine import timer
+        MyCommand = self.make([], hedge_min_delay=10)
+        pending = timer.wheel.pending
+        for i in range(20):
+            assert MyCommand(i).result(1) == i
+        assert timer.wheel.pending <= pending
+        assert MyCommand.metrics.count('hedge') == 0
+
+    def test_copies_canceled(self):
+        stall = []
+        started = []
+        MyCommand = self.make(stall, started)
+        events = [threading.Event(), threading.Event()]
+        try:
+            stall.extend(events)
+            del started[:]
+            task = MyCommand(5).submit()
+            while len(started) < 2:
+                time.sleep(.01)
+            task.cancel()
+            assert task.is_canceled()
+            copies = [t for t in started if t is not task]
+            assert copies and all(copy.is_canceled() for copy in copies)
+            time.sleep(.05)
+            assert MyCommand.metrics.count('hedge_win') == 0
+        finally:
+            for event in events:
+                event.set()
+
+    def test_hedge_inline(self):
+        from pycopine.pool import SemaphorePool
+        CommandGroup().add_executor(SemaphorePool('test.hedge.inline'))
+        stall = []
+        started = []
+        MyCommand = self.make(stall, started, pool='test.hedge.inline')
+        class Slow(Command):
+            timeout = .05
+            def run(self): time.sleep(1)
+
+        events = [threading.Event(), threading.Event()]
+        stall.extend(events)
+        del started[:]
+        primary = threading.Thread(target=MyCommand(5).result)
+        primary.start()
+        try:
+            while len(started) < 2: # The copy is running now
+                time.sleep(.01)
+            start = time.monotonic()
+            assert Slow().submit().wait(1)
+            assert time.monotonic() - start < .2
+        finally:
+            for event in events:
+                event.set()
+        primary.join(1)
@@ -0,0 +1,84 @@
+from pycopine import events
+import threading
+import time
+
+
+class Blocker(events.BaseSink):
+    ''' Sink that blocks the sink thread until released. '''
+    def __init__(self):
+        self.events = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def consume(self, event):
+        self.started.set()
+        self.release.wait(2)
+        self.events.append(event['name'])
+
+
+class TestEventManager(object):
+
+    def make(self, **options):
+        manager = events.EventManager(**options)
+        sink = manager.add_sink(Blocker())
+        manager.emit('first')
+        assert sink.started.wait(2)
+        return manager, sink
+
+    def finish(self, manager, sink):
+        sink.release.set()
+        manager.shutdown()
+        return sink.events[1:]
+
+    def test_deliver(self):
+        manager = events.EventManager()
+        batches = []
+        sink = events.FuncSink(None)
+        sink.consume_batch = batches.append
+        manager.add_sink(sink)
+        for i in range(10):
+            manager.emit('test', value=i)
+        manager.shutdown()
+        received = [e['value'] for batch in batches for e in batch]
+        assert received == list(range(10))
+        assert manager.delivered == 10
+        assert manager.dropped == 0
+
+    def test_drop_oldest(self):
+        manager, sink = self.make(max_size=3)
+        for name in 'abcde':
+            manager.emit(name)
+        assert self.finish(manager, sink) == ['c', 'd', 'e']
+        assert manager.dropped == 2
+
+    def test_drop_newest(self):
+        manager, sink = self.make(max_size=3, policy=events.DROP_NEWEST)
+        for name in 'abcde':
+            manager.emit(name)
+        assert self.finish(manager, sink) == ['a', 'b', 'c']
+        assert manager.dropped == 2
+
+    def test_sample(self):
+        manager, sink = self.make(max_size=2, policy=events.SAMPLE,
+                                  sample_rate=3)
+        for name in 'abcdefgh':
+            manager.emit(name)
+        assert self.finish(manager, sink) == ['c', 'f']
+        assert manager.dropped == 6
+
+    def test_failing_sink(self):
+        manager = events.EventManager()
+        received = []
+        def fail(event):
+            raise ValueError()
+        manager.add_sink(events.FuncSink(fail))
+        manager.add_sink(events.FuncSink(received.append))
+        manager.emit('test')
+        time.sleep(.05)
+        manager.shutdown()
+        assert len(manager.sinks) == 1
+        assert [e['name'] for e in received] == ['test', 'pool.sinkfailed']
+
+    def test_sinks_hashable(self):
+        assert len({events.FuncSink(print), events.FuncSink(print)}) == 1
+        assert len({Blocker(), Blocker()}) == 2
@@ -0,0 +1,140 @@
+from pycopine.pool import Pool
+from pycopine.limits import AIMDLimit, GradientLimit, TokenBucket
+from pycopine import events
+import threading
+import time
+
+
+class Job(object):
+    def __init__(self, delay=0, failure=False):
+        self.delay = delay
+        self.failure = failure
+        self.done = threading.Event()
+
+    def _run(self):
+        time.sleep(self.delay)
+        self.done.set()
+
+    def is_failure(self):
+        return self.failure
+
+
+class TestAIMDLimit(object):
+
+    def test_increase(self):
+        limit = AIMDLimit(initial=2, max_limit=3)
+        assert limit.update(.1, .1, 1, 1, False) == 3
+        assert limit.update(.1, .1, 1, 1, False) == 3
+
+    def test_no_increase_if_idle(self):
+        limit = AIMDLimit(initial=10)
+        assert limit.update(.1, .0001, 1, 0, False) == 10
+
+    def test_increase_on_queue_time(self):
+        limit = AIMDLimit(initial=10, queue_target=.01)
+        assert limit.update(.1, .05, 1, 0, False) == 11
+
+    def test_decrease(self):
+        limit = AIMDLimit(initial=10, backoff=.5, min_limit=2)
+        assert limit.update(.1, 0, 1, 0, True) == 5
+        assert limit.update(.1, 0, 1, 0, True) == 2
+        assert limit.update(.1, 0, 1, 0, True) == 2
+
+    def test_latency_target(self):
+        limit = AIMDLimit(initial=10, backoff=.5, latency_target=.05)
+        assert limit.update(.1, .1, 10, 0, False) == 5
+
+
+class TestGradientLimit(object):
+
+    def test_grow_while_stable(self):
+        limit = GradientLimit(initial=10)
+        for _ in range(20):
+            limit.update(.01, 0, 10, 5, False)
+        assert limit.limit > 10
+
+    def test_idle_unless_queue_time(self):
+        limit = GradientLimit(initial=10)
+        for _ in range(20):
+            limit.update(.01, 0, 1, 0, False)
+        assert limit.limit == 10
+        for _ in range(20):
+            limit.update(.01, .05, 1, 0, False)
+        assert limit.limit > 10
+
+    def test_shrink_on_latency(self):
+        limit = GradientLimit(initial=50, long_window=1000)
+        for _ in range(10):
+            limit.update(.01, 0, 50, 5, False)
+        before = limit.limit
+        for _ in range(20):
+            limit.update(.1, 0, 50, 5, False)
+        assert limit.limit < before
+
+
+class TestTokenBucket(object):
+
+    def test_burst_and_refill(self):
+        now = [0]
+        bucket = TokenBucket(rate=2, burst=3, clock=lambda: now[0])
+        assert [bucket.try_acquire() for _ in range(4)] == [True] * 3 + [False]
+        now[0] = .5
+        assert bucket.try_acquire()
+        assert not bucket.try_acquire()
+        now[0] = 10
+        assert bucket.try_acquire(3)
+        assert not bucket.try_acquire()
+
+    def test_reserve(self):
+        now = [0]
+        bucket = TokenBucket(rate=2, burst=1, clock=lambda: now[0])
+        assert bucket.reserve() == 0
+        assert bucket.reserve() == .5
+        assert bucket.reserve() == 1
+        assert bucket.reserve(max_wait=1) is None
+        assert bucket.reserve(max_wait=0) is None
+
+
+class TestAdaptivePool(object):
+
+    def setUp(self):
+        self.events = []
+        events.root.add_sink(events.FuncSink(self.events.append))
+
+    def tearDown(self):
+        events.root.clear()
+
+    def test_grow(self):
+        pool = Pool('test.adaptive.grow')
+        pool.max_queue_size = 100
+        pool.limiter = AIMDLimit(initial=1, max_limit=4)
+        jobs = [Job(.01) for _ in range(20)]
+        for job in jobs:
+            pool.enqueue(job)
+        assert all(job.done.wait(2) for job in jobs)
+        assert pool.get_pool_limit() == 4
+        time.sleep(.1)
+        assert [e for e in self.events if e['name'] == 'pool.limit'
+                                     and e['pool'] == pool.name]
+
+    def test_no_growth_if_sequential(self):
+        pool = Pool('test.adaptive.sequential')
+        pool.limiter = AIMDLimit(initial=10)
+        for _ in range(50):
+            job = Job()
+            pool.enqueue(job)
+            assert job.done.wait(2)
+        time.sleep(.05)
+        assert pool.get_pool_limit() == 10
+
+    def test_shrink(self):
+        pool = Pool('test.adaptive.shrink')
+        pool.max_queue_size = 100
+        pool.limiter = AIMDLimit(initial=4, backoff=.5)
+        jobs = [Job(.01, failure=True) for _ in range(10)]
+        for job in jobs:
+            pool.enqueue(job)
+        assert all(job.done.wait(2) for job in jobs)
+        time.sleep(.05)
+        assert pool.get_pool_limit() == 1
+        assert len(pool.threads) <= 1
@@ -0,0 +1,214 @@
+from pycopine import *
+from pycopine.metrics import HistogramCounter, LatencyHistogram, RollingLatency
+from pycopine.metrics import RollingSnapshot, RollingMax
+import threading
+import time
+
+
+class Clock(object):
+    def __init__(self):
+        self.t = 1000.0
+    def __call__(self):
+        return self.t
+
+
+class TestHistogramCounter(object):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.counter = HistogramCounter(window=1, buckets=10, clock=self.clock)
+
+    def test_current_bucket(self):
+        self.counter.increment()
+        self.counter.increment(2)
+        assert self.counter.sum() == 0
+        assert self.counter.total() == 3
+
+    def test_rollover(self):
+        self.counter.increment(3)
+        self.clock.t += .1
+        self.counter.increment(1)
+        assert self.counter.bucket_list == [0] * 9 + [3]
+        assert self.counter.sum() == 3
+        assert self.counter.total() == 4
+        self.clock.t += .5
+        assert self.counter.bucket_list == [0] * 4 + [3, 1] + [0] * 4
+        self.clock.t += 1
+        assert self.counter.total() == 0
+
+    def test_rate(self):
+        self.counter.increment(5)
+        self.clock.t += .1
+        assert self.counter.rate() == 5
+        assert self.counter.rate_max() == 50
+        assert self.counter.rate_min() == 0
+
+    def test_increment_many(self):
+        self.counter.increment_many([1, 2, 3])
+        assert self.counter.total() == 6
+
+    def test_freeze(self):
+        self.counter.increment(3)
+        frozen = self.counter.freeze()
+        self.counter.increment(3)
+        self.clock.t += 10
+        assert frozen.total() == 3
+        assert self.counter.total() == 0
+
+    def test_reset(self):
+        self.counter.increment(3)
+        self.counter.reset()
+        assert self.counter.total() == 0
+        self.counter.increment(1)
+        assert self.counter.total() == 1
+
+    def test_threads(self):
+        counter = HistogramCounter(window=60, buckets=10)
+        def work():
+            for _ in range(10000):
+                counter.increment()
+        threads = [threading.Thread(target=work) for _ in range(8)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        assert counter.total() == 80000
+
+
+class TestLatencyHistogram(object):
+
+    def test_empty(self):
+        h = LatencyHistogram()
+        assert h.percentile(99) == 0
+        assert h.mean() == 0
+
+    def test_percentiles(self):
+        h = LatencyHistogram()
+        for ms in range(1, 1001):
+            h.record(ms / 1000.0)
+        assert h.count == 1000
+        for p in (50, 90, 99, 99.9):
+            expected = p / 100.0
+            assert abs(h.percentile(p) - expected) / expected < .04
+        assert h.percentile(100) == 1.0
+        assert abs(h.mean() - .5005) < 1e-9
+
+    def test_clamp(self):
+        h = LatencyHistogram()
+        h.record(0)
+        h.record(1e-9)
+        h.record(1e6)
+        assert h.counts[0] == 2
+        assert h.counts[-1] == 1
+        assert h.percentile(100) == 1e6
+
+    def test_merge(self):
+        a, b = LatencyHistogram(), LatencyHistogram()
+        a.record(.001)
+        b.record(.1)
+        b.record(.1)
+        a.merge(b)
+        assert a.count == 3
+        assert a.max == .1
+        assert b.count == 2
+        a.subtract(b)
+        assert a.count == 1
+        assert a.percentile(100) < .0011
+
+    def test_percentiles_single_pass(self):
+        h = LatencyHistogram()
+        for i in range(1, 1001):
+            h.record(i / 1000)
+        ps = (0, 25, 50, 75, 90, 99, 99.5, 100)
+        assert h.percentiles(ps) == dict((p, h.percentile(p)) for p in ps)
+        assert LatencyHistogram().percentiles((50,)) == {50: 0.0}
+
+
+class TestRollingLatency(object):
+
+    def test_rolling(self):
+        clock = Clock()
+        latency = RollingLatency(window=1, buckets=10, clock=clock)
+        latency.record(.5)
+        clock.t += .5
+        latency.record(.1)
+        assert latency.snapshot().count == 2
+        clock.t += .7
+        assert latency.snapshot().count == 1
+        assert latency.percentiles((50,))[50] < .11
+
+
+class TestRollingMax(object):
+
+    def test_rolling(self):
+        clock = Clock()
+        maximum = RollingMax(window=1, buckets=10, clock=clock)
+        assert maximum.max() == 0
+        maximum.update(3)
+        maximum.update(1)
+        clock.t += .5
+        maximum.update(2)
+        assert maximum.max() == 3
+        clock.t += .7
+        assert maximum.max() == 2
+
+
+class TestRollingSnapshot(object):
+
+    def test_incremental(self):
+        clock = Clock()
+        latency = RollingLatency(window=1, buckets=10, clock=clock)
+        rolling = RollingSnapshot(latency)
+        for step in range(40):
+            for _ in range(step % 3):
+                latency.record(step / 100)
+            if step % 4 == 0:
+                threading.Thread(target=latency.record, args=(1,)).start()
+                time.sleep(.01)
+            expected = latency.snapshot()
+            snapshot = rolling.snapshot()
+            assert snapshot.count == expected.count
+            assert snapshot.counts == expected.counts
+            assert snapshot.max == expected.max
+            clock.t += .07 * (step % 5)
+
+    def test_bucket_combined_once(self):
+        clock = Clock()
+        latency = RollingLatency(window=1, buckets=10, clock=clock)
+        rolling = RollingSnapshot(latency)
+        latency.record(.1)
+        clock.t += .1
+        rolling.snapshot()
+        calls = []
+        bucket = latency._bucket
+        latency._bucket = lambda i: calls.append(i) or bucket(i)
+        rolling.snapshot()
+        rolling.snapshot()
+        assert len(set(calls)) == 1 # Only the current bucket
+
+    def test_reset(self):
+        clock = Clock()
+        latency = RollingLatency(window=1, buckets=10, clock=clock)
+        rolling = RollingSnapshot(latency)
+        latency.record(.1)
+        clock.t += .1
+        assert rolling.snapshot().count == 1
+        latency.reset()
+        assert rolling.snapshot().count == 0
+
+
+class TestCommandLatency(object):
+
+    def setUp(self):
+        CommandGroup.clear_all()
+
+    def tearDown(self):
+        CommandGroup.clear_all()
+
+    def test_recorded(self):
+        class MyCommand(Command):
+            def run(self): time.sleep(.01)
+
+        MyCommand().result()
+        for name in ('queue', 'run', 'total'):
+            assert MyCommand.metrics.latency[name].snapshot().count == 1
+        assert MyCommand.metrics.percentiles('run')[50] >= .009
+        assert Pool('default').metrics.latency['run'].snapshot().count >= 1
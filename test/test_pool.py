@@ -0,0 +1,259 @@
+from pycopine.pool import Pool, SemaphorePool
+from pycopine import *
+import threading
+import time
+
+
+class Job(object):
+    def __init__(self, log=None, priority=0, deadline=None):
+        self.log = log
+        self.priority = priority
+        self.deadline = deadline
+        self.expired = False
+        self.done = threading.Event()
+
+    def _run(self):
+        if self.log is not None:
+            self.log.append(self)
+        self.done.set()
+
+    def _deadline(self):
+        return self.deadline
+
+    def _expire(self):
+        self.expired = True
+        self.done.set()
+
+
+class TestPoolQueue(object):
+
+    def setUp(self):
+        self.pool = Pool('test.queue')
+        self.pool.max_pool_size = 0
+        self.pool.max_queue_size = 10
+
+    def tearDown(self):
+        with self.pool.cond:
+            self.pool.queue.clear()
+
+    def test_dequeue(self):
+        a, b, c = Job(), Job(), Job()
+        for job in (a, b, c):
+            self.pool.enqueue(job)
+        assert self.pool.get_queue_size() == 3
+        assert self.pool.dequeue(b)
+        assert not self.pool.dequeue(b)
+        assert list(self.pool.queue) == [a, c]
+        assert self.pool.get_queue_space() == 8
+
+    def test_queue_full(self):
+        self.pool.max_queue_size = 1
+        self.pool.enqueue(Job())
+        try:
+            self.pool.enqueue(Job())
+        except RuntimeError:
+            pass
+        else:
+            assert False, 'Expected RuntimeError'
+
+
+class TestPoolRun(object):
+
+    def test_fifo(self):
+        pool = Pool('test.fifo')
+        pool.max_pool_size = 0
+        log = []
+        jobs = [Job(log) for _ in range(5)]
+        for job in jobs:
+            pool.enqueue(job)
+        pool.max_pool_size = 1
+        last = Job(log)
+        pool.enqueue(last)
+        assert last.done.wait(1)
+        assert log == jobs + [last]
+        pool.shutdown()
+        assert not pool.running
+        assert not pool.threads
+
+    def run_all(self, pool, jobs, last=None):
+        ''' Queue jobs without workers, then start a single worker. '''
+        pool.max_pool_size = 0
+        pool.max_queue_size = 100
+        for job in jobs:
+            pool.enqueue(job)
+        pool.max_pool_size = 1
+        last = last or Job(jobs[0].log, priority=100)
+        pool.enqueue(last)
+        for job in jobs + [last]:
+            assert job.done.wait(1)
+        pool.shutdown()
+
+    def test_priority(self):
+        log = []
+        low, high = Job(log, priority=1), Job(log, priority=0)
+        self.run_all(Pool('test.priority'), [low, high])
+        assert log[:2] == [high, low]
+
+    def test_deadline(self):
+        log = []
+        now = time.monotonic()
+        late, none, early = Job(log, deadline=now + 20), Job(log), \
+                            Job(log, deadline=now + 10)
+        self.run_all(Pool('test.deadline'), [late, none, early])
+        assert log[:3] == [early, late, none]
+
+    def test_expired(self):
+        log = []
+        pool = Pool('test.expired')
+        stale = Job(log, deadline=time.monotonic() - 1)
+        fresh = Job(log)
+        self.run_all(pool, [stale, fresh])
+        assert stale.expired
+        assert log[0] is fresh
+        assert pool.metrics.count('expired') == 1
+
+    def test_lifo(self):
+        log = []
+        pool = Pool('test.lifo')
+        pool.lifo_threshold = 2
+        jobs = [Job(log) for _ in range(4)]
+        last = Job(log)
+        self.run_all(pool, jobs, last)
+        # LIFO while more than 2 jobs wait, FIFO afterwards
+        assert log == [last, jobs[3], jobs[2], jobs[0], jobs[1]]
+
+    def test_prestart(self):
+        pool = Pool('test.prestart')
+        pool.core_pool_size = 3
+        assert pool.prestart() == 3
+        assert len(pool.threads) == 3
+        assert pool.prestart() == 0
+        assert pool.threads[0].name.startswith('pycopine-test.prestart-')
+        pool.shutdown()
+        assert not pool.threads
+
+    def test_core_workers_stay(self):
+        pool = Pool('test.core')
+        pool.core_pool_size = 1
+        pool.max_worker_idle = .01
+        jobs = [Job() for _ in range(3)]
+        for job in jobs:
+            pool.enqueue(job)
+        assert all(job.done.wait(1) for job in jobs)
+        time.sleep(.1)
+        assert len(pool.threads) == 1
+        pool.shutdown()
+
+    def test_thread_reuse(self):
+        pool = Pool('test.reuse')
+        threads = set()
+        for _ in range(20):
+            job = Job()
+            pool.enqueue(job)
+            assert job.done.wait(1)
+            threads.update(pool.threads)
+        # Workers are reused, not replaced
+        assert len(threads) <= pool.max_pool_size
+        assert all(t.is_alive() for t in threads)
+        pool.shutdown()
+
+    def test_thread_factory(self):
+        names = []
+        def factory(target, name):
+            names.append(name)
+            thread = threading.Thread(target=target, name=name)
+            thread.daemon = True
+            return thread
+
+        class FactoryPool(Pool):
+            thread_factory = factory
+        pool = FactoryPool('test.factory')
+        job = Job()
+        pool.enqueue(job)
+        assert job.done.wait(1)
+        assert names and names[0].startswith('pycopine-test.factory-')
+        pool.shutdown()
+
+        pool = Pool('test.factory.instance')
+        pool.thread_factory = factory
+        pool.prestart(1)
+        assert names[-1].startswith('pycopine-test.factory.instance-')
+        pool.shutdown()
+
+
+class TestSemaphorePool(object):
+
+    def setUp(self):
+        CommandGroup.clear_all()
+        CommandGroup().add_executor(SemaphorePool('test.inline'))
+
+    def tearDown(self):
+        CommandGroup.clear_all()
+
+    def test_inline(self):
+        class Inline(Command):
+            pool = 'test.inline'
+            def run(self): return threading.current_thread()
+
+        task = Inline().submit()
+        assert task.is_success()
+        assert task.result() is threading.current_thread()
+        assert SemaphorePool('test.inline').get_active_count() == 0
+
+    def test_reject(self):
+        class Nested(Command):
+            pool = 'test.inline'
+            def run(self): return Nested().result()
+            def fallback(self): return 'fallback'
+
+        SemaphorePool('test.inline').max_pool_size = 1
+        try:
+            assert Nested().result() == 'fallback'
+            assert Nested.metrics.count('rejected') == 1
+            assert SemaphorePool('test.inline').metrics.count('rejected') == 1
+        finally:
+            SemaphorePool('test.inline').max_pool_size = 10
+
+    def test_fast_path(self):
+        CommandGroup().add_executor(SemaphorePool('test.inline.fast'))
+        cleaned = []
+        class Inline(Command):
+            pool = 'test.inline.fast'
+            def run(self, fail):
+                if fail:
+                    raise IOError()
+                return threading.current_thread()
+            def fallback(self, fail): return 'fallback'
+            def cleanup(self): cleaned.append(self)
+
+        task = Inline(False)
+        assert task.result() is threading.current_thread()
+        assert task.is_success() and cleaned == [task]
+        assert Inline(True).result() == 'fallback'
+        assert Inline.metrics.count('success') == 1
+        assert Inline.metrics.count('failure') == 1
+        assert Inline.metrics.latency['run'].snapshot().count == 2
+        # Not queued
+        assert Inline.metrics.latency['queue'].snapshot().count == 0
+        pool = SemaphorePool('test.inline.fast')
+        assert pool.metrics.count('executed') == 2
+        assert pool.get_active_count() == 0
+
+    def test_fast_path_features(self):
+        class Timed(Command):
+            pool = 'test.inline'
+            timeout = 1
+            def run(self): return 'ok'
+
+        # Tasks with a timeout take the regular path.
+        assert Timed().result() == 'ok'
+        assert Timed.metrics.latency['queue'].snapshot().count == 1
+
+    def test_subclass(self):
+        class MySemaphorePool(SemaphorePool):
+            max_pool_size = 2
+        pool = MySemaphorePool('test.inline.sub')
+        assert isinstance(pool, MySemaphorePool)
+        assert pool.max_pool_size == 2
+        assert MySemaphorePool('test.inline.sub') is pool
+        assert SemaphorePool('test.inline.sub') is not pool
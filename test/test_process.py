@@ -0,0 +1,90 @@
+from pycopine import *
+from pycopine.process import ProcessPool, WorkerError
+import os
+import time
+from nose.tools import raises
+
+
+class Pid(Command):
+    group = 'test.process'
+    pool = 'procs'
+    def run(self, value):
+        return os.getpid(), value * 2
+
+class Fail(Command):
+    group = 'test.process'
+    pool = 'procs'
+    def run(self):
+        raise ValueError('boom')
+    def fallback(self):
+        return 'fallback'
+
+class Stuck(Command):
+    group = 'test.process'
+    pool = 'procs'
+    timeout = .2
+    def run(self):
+        while True: pass
+
+class Crash(Command):
+    group = 'test.process'
+    pool = 'procs'
+    def run(self):
+        os._exit(1)
+
+
+class TestProcessPool(object):
+
+    def setUp(self):
+        self.pool = ProcessPool('procs')
+
+    def test_run(self):
+        pid, value = Pid(21).result()
+        assert value == 42
+        assert pid != os.getpid()
+        assert Pid(1).result()[0] == pid # Worker is reused
+
+    def test_failure(self):
+        task = Fail()
+        assert task.result() == 'fallback'
+        assert isinstance(task.exception(), ValueError)
+
+    def test_timeout(self):
+        task = Stuck()
+        start = time.monotonic()
+        task.submit().wait(5)
+        assert time.monotonic() - start < 2
+        assert task.is_timeout()
+        assert Stuck.metrics.count('timeout') == 1
+        assert Pid(1).result()[1] == 2 # Pool still works
+
+    def test_cancel_running(self):
+        task = Stuck().submit()
+        time.sleep(.05)
+        task.cancel()
+        assert task.is_canceled()
+
+    def test_crash(self):
+        task = Crash()
+        task.submit().wait(5)
+        assert isinstance(task.exception(), WorkerError)
+
+    def test_local_command(self):
+        class Local(Command):
+            group = 'test.process'
+            pool = 'procs'
+            def run(self): return 1
+        try:
+            assert isinstance(Local().exception(5), CommandSetupError)
+        finally:
+            CommandGroup('test.process').commands.pop('Local')
+
+    @raises(CommandSetupError)
+    def test_collapsed_rejected(self):
+        class Collapsed(Command):
+            group = 'test.process'
+            pool = 'procs'
+            collapse_window = .01
+            def run(self, value): pass
+            @classmethod
+            def run_batch(cls, arguments): pass
@@ -0,0 +1,186 @@
+from pycopine import *
+from pycopine.circuit import OPEN, CLOSED
+from pycopine.shared import SharedState, SharedCounter, SharedStateError
+from nose.tools import raises
+import os
+import shutil
+import threading
+import tempfile
+
+
+def fork(func, *args):
+    ''' Run func(*args) in a child process and wait for it to exit. '''
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            func(*args)
+            code = 0
+        finally:
+            os._exit(code)
+    assert os.waitpid(pid, 0)[1] == 0
+
+
+class TestSharedState(object):
+
+    def setUp(self):
+        CommandGroup.clear_all()
+        self.tmpdir = tempfile.mkdtemp()
+        self.shared = SharedState(os.path.join(self.tmpdir, 'state'),
+                                  max_threads=8, max_slots=16)
+
+    def tearDown(self):
+        CommandGroup.clear_all()
+        Command.shared_state = None
+        self.shared.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_counter(self):
+        counter = SharedCounter(self.shared, ('a', 'b'), window=3600)
+        counter.increment(2)
+        assert counter.total() == 2
+        assert SharedCounter(self.shared, ('a', 'b'), window=3600).total() == 2
+        assert SharedCounter(self.shared, ('a', 'c'), window=3600).total() == 0
+        counter.reset()
+        assert counter.total() == 0
+        counter.increment()
+        assert counter.freeze().total() == 1
+
+    def test_counter_forked(self):
+        counter = SharedCounter(self.shared, ('a', 'b'), window=3600)
+        counter.increment()
+        def work():
+            for _ in range(1000):
+                counter.increment()
+        for _ in range(4):
+            fork(work)
+        assert counter.total() == 4001
+        # Rows of exited processes are reused, without losing counts.
+        assert len(self.shared.rows()) <= 2
+
+    def test_counter_threads(self):
+        counter = SharedCounter(self.shared, ('a', 'b'), window=3600)
+        def work():
+            for _ in range(10000):
+                counter.increment()
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert counter.total() == 40000 # No lost updates
+        # Rows of exited threads are reused, without losing counts.
+        thread = threading.Thread(target=counter.increment)
+        thread.start()
+        thread.join()
+        assert counter.total() == 40001
+        assert len(self.shared.rows()) <= 5
+
+    def test_rows_full(self):
+        counter = SharedCounter(self.shared, ('a', 'b'), window=3600)
+        start, stop = threading.Barrier(12), threading.Barrier(12)
+        errors = []
+        def work():
+            start.wait(2) # All threads are alive at the same time
+            try:
+                for _ in range(100):
+                    counter.increment()
+            except Exception as e:
+                errors.append(e)
+            stop.wait(2)
+        threads = [threading.Thread(target=work) for _ in range(12)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert not errors
+        assert counter.total() == 1200 # Threads without a row count locally
+        assert self.shared.full
+        counter.reset()
+        assert counter.total() == 0
+
+    def test_lazy_slots(self):
+        counter = SharedCounter(self.shared, ('a', 'b'), window=3600)
+        assert counter.total() == 0
+        assert self.shared.allocated() == 0
+        other = SharedCounter(self.shared, ('a', 'b'), window=3600)
+        other.increment()
+        assert self.shared.allocated() == 1
+        assert counter.total() == 1
+
+    def test_reopen(self):
+        counter = SharedCounter(self.shared, ('a', 'b'), window=3600)
+        counter.increment(5)
+        other = SharedState(self.shared.path, max_threads=8, max_slots=16)
+        try:
+            assert SharedCounter(other, ('a', 'b'), window=3600).total() == 5
+        finally:
+            other.close()
+
+    @raises(SharedStateError)
+    def test_incompatible(self):
+        SharedState(self.shared.path, max_threads=8, max_slots=32)
+
+    @raises(SharedStateError)
+    def test_full(self):
+        for i in range(17):
+            self.shared.slot(('key', str(i)))
+
+    def test_counter_full(self):
+        for i in range(16):
+            self.shared.slot(('key', str(i)))
+        counter = SharedCounter(self.shared, ('a', 'b'), window=3600)
+        counter.increment(2) # Counted locally
+        assert counter.total() == 2
+        counter.reset()
+        assert counter.total() == 0
+
+    def test_many_commands(self):
+        Command.shared_state = self.shared
+        for i in range(16): # One slot for each circuit
+            CommandMeta('Command%d' % i, (Command,), dict(
+                run=lambda self: None, __module__=__name__))
+        try:
+            class OneTooMany(Command):
+                def run(self): pass
+        except SharedStateError:
+            pass
+        else:
+            assert False
+        assert 'OneTooMany' not in CommandGroup()
+
+    def test_single_probe(self):
+        Command.shared_state = self.shared
+        class MyCommand(Command):
+            circuit_sleep = 60
+            def run(self): pass
+        probes = SharedCounter(self.shared, ('probes',), window=3600)
+        MyCommand.circuit.trip()
+        MyCommand.circuit.opened -= 61
+        def probe():
+            if MyCommand.circuit.allow_request():
+                probes.increment()
+        for _ in range(4):
+            fork(probe)
+        assert probes.total() == 1
+        assert not MyCommand.circuit.allow_request()
+
+    def test_command(self):
+        Command.shared_state = self.shared
+        CommandGroup().add_executor(SemaphorePool('shared'))
+        class MyCommand(Command):
+            pool = 'shared' # Pool threads do not survive a fork
+            circuit_volume = 10
+            def run(self): 1/0
+            def fallback(self): return 'fallback'
+
+        def fail():
+            for _ in range(10):
+                MyCommand().result()
+        fork(fail)
+        assert MyCommand.metrics.count('failure') == 10
+        assert MyCommand.circuit.state == OPEN
+        assert isinstance(MyCommand().exception(), CommandShortCircuitError)
+        MyCommand.circuit.state = CLOSED
+        MyCommand.metrics.reset()
+        assert MyCommand.metrics.count('failure') == 0
@@ -0,0 +1,138 @@
+from pycopine import *
+from pycopine import stream
+import json
+import time
+import urllib.request
+
+
+class TestMetricsStream(object):
+
+    def setUp(self):
+        CommandGroup.clear_all()
+
+    def tearDown(self):
+        CommandGroup.clear_all()
+
+    def parse(self, lines):
+        return dict((e['name'], e) for e in map(json.loads, lines))
+
+    def test_snapshot(self):
+        class MyCommand(Command):
+            def run(self): return 5
+
+        MyCommand().result()
+        events = self.parse(stream.MetricsStream(0).snapshot())
+        command = events['MyCommand']
+        assert command['type'] == 'HystrixCommand'
+        assert command['group'] == 'default'
+        assert command['rollingCountSuccess'] == 1
+        assert command['requestCount'] == 1
+        assert command['isCircuitBreakerOpen'] is False
+        assert command['currentTime'] > 0
+        assert set(command['latencyTotal']) == set(['0', '25', '50', '75',
+                                             '90', '95', '99', '99.5', '100'])
+        pool = events['default']
+        assert pool['type'] == 'HystrixThreadPool'
+        assert pool['currentQueueSize'] == 0
+        assert pool['rollingCountThreadsExecuted'] >= 1
+
+    def test_idle_cached(self):
+        class Idle(Command):
+            def run(self): pass
+
+        metrics_stream = stream.MetricsStream(0)
+        first = metrics_stream.snapshot()
+        cached = metrics_stream.cache[Idle][1]
+        metrics_stream.snapshot()
+        assert metrics_stream.cache[Idle][1] is cached
+        Idle().result()
+        metrics_stream.snapshot()
+        assert metrics_stream.cache[Idle][1] is not cached
+        assert metrics_stream.cache[Idle][0]
+
+    def test_active_once_per_bucket(self):
+        class Busy(Command):
+            metrics_window = 3600
+            def run(self): pass
+
+        metrics_stream = stream.MetricsStream(0)
+        Busy().result()
+        metrics_stream.snapshot()
+        cached = metrics_stream.cache[Busy][1]
+        Busy().result()
+        metrics_stream.snapshot()
+        assert metrics_stream.cache[Busy][1] is cached
+
+        class Fast(Command):
+            metrics_window = .1
+            def run(self): pass
+
+        Fast().result()
+        metrics_stream.snapshot()
+        cached = metrics_stream.cache[Fast][1]
+        time.sleep(.02)
+        metrics_stream.snapshot()
+        assert metrics_stream.cache[Fast][1] is not cached
+
+    def test_circuit_change(self):
+        class Busy(Command):
+            metrics_window = 3600
+            def run(self): pass
+
+        metrics_stream = stream.MetricsStream(0)
+        Busy().result()
+        metrics_stream.snapshot()
+        Busy.circuit.trip()
+        events = self.parse(metrics_stream.snapshot())
+        assert events['Busy']['isCircuitBreakerOpen'] is True
+
+    def test_semaphore_pool(self):
+        from pycopine.pool import SemaphorePool
+        CommandGroup().add_executor(SemaphorePool('test.stream.inline'))
+        class Inline(Command):
+            pool = 'test.stream.inline'
+            def run(self): return 5
+
+        Inline().result()
+        events = self.parse(stream.MetricsStream(0).snapshot())
+        command = events['Inline']
+        assert command['propertyValue_executionIsolationStrategy'] \
+               == 'SEMAPHORE'
+        assert command[
+            'propertyValue_executionIsolationSemaphoreMaxConcurrentRequests'
+            ] == SemaphorePool('test.stream.inline').max_pool_size
+        pool = events['test.stream.inline']
+        assert pool['currentActiveCount'] == 0
+        assert pool['rollingMaxActiveThreads'] == 1
+
+    def test_collapsed(self):
+        class Batched(Command):
+            collapse_window = .01
+            def run(self, value): pass
+            @classmethod
+            def run_batch(cls, arguments):
+                return [a[0] for a, ka in arguments]
+
+        assert gather([Batched(i) for i in range(3)]) == [0, 1, 2]
+        events = self.parse(stream.MetricsStream(0).snapshot())
+        assert events['Batched']['rollingCountCollapsedRequests'] == 3
+        assert events['Batched']['propertyValue_executionIsolationStrategy'] \
+               == 'THREAD'
+
+    def test_server(self):
+        class MyCommand(Command):
+            def run(self): return 5
+
+        MyCommand().result()
+        server = stream.start_server(port=0, interval=.01)
+        try:
+            url = 'http://%s:%d/hystrix.stream' % server.server_address
+            response = urllib.request.urlopen(url, timeout=2)
+            assert response.headers['Content-Type'].startswith(
+                'text/event-stream')
+            line = response.readline().decode('utf8')
+            assert line.startswith('data: ')
+            assert json.loads(line[6:])['type'] == 'HystrixCommand'
+            response.close()
+        finally:
+            server.shutdown()
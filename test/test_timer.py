@@ -0,0 +1,130 @@
+from pycopine import *
+from pycopine.timer import TimerWheel
+import os
+import threading
+import time
+
+
+class Clock(object):
+    def __init__(self):
+        self.t = 1000.0
+    def __call__(self):
+        return self.t
+
+
+class TestTimerWheel(object):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.wheel = TimerWheel(tick=.01, slots=8, clock=self.clock)
+        self.fired = []
+        self.done = threading.Event()
+
+    def callback(self, value):
+        self.fired.append(value)
+        self.done.set()
+
+    def test_fire(self):
+        self.wheel.schedule(.05, self.callback, 1)
+        self.clock.t += .04
+        self.wheel.advance()
+        assert not self.fired
+        self.clock.t += .03
+        self.wheel.advance()
+        assert self.done.wait(1)
+        assert self.fired == [1]
+        assert self.wheel.pending == 0
+
+    def test_rounds(self):
+        self.wheel.schedule(.2, self.callback, 1) # More than one revolution
+        for _ in range(15):
+            self.clock.t += .01
+            self.wheel.advance()
+        assert not self.fired
+        self.clock.t += .1
+        self.wheel.advance()
+        assert self.done.wait(1)
+
+    def test_cancel(self):
+        timeout = self.wheel.schedule(.05, self.callback, 1)
+        assert timeout.cancel()
+        assert not timeout.cancel()
+        self.clock.t += 1
+        self.wheel.advance()
+        assert not self.fired
+        assert self.wheel.pending == 0
+
+    def test_real_clock(self):
+        wheel = TimerWheel(tick=.005)
+        wheel.schedule(.02, self.callback, 1)
+        assert self.done.wait(1)
+
+    def test_blocking(self):
+        wheel = TimerWheel(tick=.005)
+        release = threading.Event()
+        threads = []
+        def block():
+            threads.append(threading.current_thread())
+            release.wait(2)
+        wheel.schedule_blocking(.01, block)
+        wheel.schedule(.03, self.callback, 1)
+        try:
+            assert self.done.wait(.5) # Not delayed by block()
+        finally:
+            release.set()
+        wheel.schedule_blocking(.01, block)
+        time.sleep(.1)
+        assert len(threads) == 2 and threads[0] is threads[1] # Reused
+        assert wheel.thread not in threads
+
+    def test_call_blocking(self):
+        threads = []
+        def handoff():
+            self.wheel.call_blocking(block)
+        def block():
+            threads.append(threading.current_thread())
+            self.done.set()
+        self.wheel.schedule(.01, handoff)
+        self.clock.t += .03
+        self.wheel.advance()
+        assert self.done.wait(1)
+        assert threads[0] is not threading.current_thread()
+
+    def test_fork(self):
+        wheel = TimerWheel(tick=.005)
+        wheel.schedule(.01, self.callback, 1)
+        assert self.done.wait(1)
+        pid = os.fork()
+        if pid == 0:
+            done = threading.Event()
+            wheel.schedule(.01, done.set)
+            os._exit(0 if done.wait(1) else 1)
+        assert os.waitpid(pid, 0)[1] == 0
+
+
+class TestCommandTimeout(object):
+
+    def setUp(self):
+        CommandGroup.clear_all()
+
+    def tearDown(self):
+        CommandGroup.clear_all()
+
+    def test_timeout(self):
+        class Slow(Command):
+            timeout = .05
+            def run(self): time.sleep(.5)
+
+        task = Slow().submit()
+        assert task.wait(1)
+        assert task.is_timeout()
+        assert Slow.metrics.count('timeout') == 1
+
+    def test_no_timeout(self):
+        class Fast(Command):
+            timeout = .05
+            def run(self): return 1
+
+        assert Fast().result() == 1
+        time.sleep(.1)
+        assert Fast.metrics.count('timeout') == 0
@@ -0,0 +1,140 @@
+from pycopine import *
+from pycopine import trace
+import io
+import json
+import time
+
+
+class CleanupMixin(object):
+    def setUp(self):
+        CommandGroup.clear_all()
+
+    def tearDown(self):
+        del trace.hooks[:]
+        trace._install()
+        CommandGroup.clear_all()
+
+
+class TestHooks(CleanupMixin):
+
+    def test_disabled(self):
+        assert Command._trace is None
+
+    def test_transitions(self):
+        class MyCommand(Command):
+            def run(self, value): return 10 / value
+            def fallback(self, value): return 0
+
+        seen = []
+        def hook(task, transition, pool, timestamp):
+            if isinstance(task, MyCommand):
+                seen.append((transition, pool))
+        trace.add_hook(hook)
+        assert Command._trace is not None
+
+        MyCommand(1).result(1)
+        time.sleep(.05)
+        MyCommand(0).result(1)
+        time.sleep(.05)
+        trace.remove_hook(hook)
+        assert Command._trace is None
+        MyCommand(1).result(1)
+
+        # cleanup() runs in the worker, after the result is available.
+        assert sorted(t for t, pool in seen) == sorted([
+            'submit', 'start', 'success', 'cleanup',
+            'submit', 'start', 'failure', 'cleanup', 'fallback'])
+        assert [t for t, pool in seen][:3] == ['submit', 'start', 'success']
+        assert set(pool for t, pool in seen) == set(['default'])
+
+    def test_cancel(self):
+        class MyCommand(Command):
+            def run(self): pass
+        task = MyCommand()
+        seen = []
+        def hook(other, transition, pool, timestamp):
+            if other is task:
+                seen.append(transition)
+        trace.add_hook(hook)
+        task.cancel()
+        assert seen == ['cancel']
+
+    def test_failing_hook(self):
+        def hook(task, transition, pool, timestamp):
+            raise RuntimeError()
+        trace.add_hook(hook)
+        class MyCommand(Command):
+            def run(self): return 5
+        assert MyCommand().result(1) == 5
+
+
+class TestSpanTracer(CleanupMixin):
+
+    def test_spans(self):
+        exporter = trace.MemoryExporter()
+        tracer = trace.SpanTracer(exporter).start()
+        class MyCommand(Command):
+            group = 'trace'
+            def run(self, value): return 10 / value
+        MyCommand(1).result(1)
+        MyCommand(0).exception(1)
+        tracer.stop()
+
+        ok, error = [span for span in exporter.spans
+                     if span['name'] == 'trace.MyCommand']
+        assert ok['name'] == 'trace.MyCommand'
+        assert ok['status'] == 'OK'
+        assert ok['attributes']['pycopine.pool'] == 'default'
+        assert ok['end_time'] >= ok['start_time'] > 0
+        assert [e['name'] for e in ok['events']] == ['start', 'success']
+        assert error['status'] == 'ERROR'
+        assert error['attributes']['exception.type'] == 'ZeroDivisionError'
+        assert not [t for t in tracer.spans if isinstance(t, MyCommand)]
+
+    def test_sample_rate(self):
+        exporter = trace.MemoryExporter()
+        tracer = trace.SpanTracer(exporter, sample_rate=.25).start()
+        class MyCommand(Command):
+            group = 'trace'
+            def run(self): pass
+        for _ in range(8):
+            MyCommand().result(1)
+        tracer.stop()
+        spans = [span for span in exporter.spans
+                 if span['name'] == 'trace.MyCommand']
+        assert 1 <= len(spans) <= 3
+
+    def test_file_exporter(self):
+        out = io.StringIO()
+        tracer = trace.SpanTracer(trace.FileExporter(out)).start()
+        class MyCommand(Command):
+            group = 'trace'
+            def run(self): pass
+        MyCommand().result(1)
+        tracer.stop()
+        names = [json.loads(line)['name']
+                 for line in out.getvalue().splitlines()]
+        assert 'trace.MyCommand' in names
+
+
+class TestProfiler(CleanupMixin):
+
+    def test_profile(self):
+        profiler = trace.Profiler(interval=.005).start()
+        class Slow(Command):
+            group = 'trace'
+            def run(self): time.sleep(.1)
+        class Fast(Command):
+            group = 'trace'
+            def run(self): pass
+        tasks = [Slow().submit()] + [Fast().submit() for _ in range(10)]
+        for task in tasks:
+            task.wait(1)
+        profiler.stop()
+
+        report = [r for r in profiler.report() if r[1].startswith('trace.')]
+        pool, command, samples, share = report[0]
+        assert (pool, command) == ('default', 'trace.Slow')
+        assert samples > 5
+        assert share > .5
+        assert not profiler.running